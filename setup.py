@@ -38,6 +38,11 @@ To download a file, use the ``recv`` method::
     >>> stream = open('output', 'wb')
     >>> modem.recv(stream)
 
+Files can as well be sent and received from the command line::
+
+    $ xmodem send --line /dev/ttyUSB0 --baud 115200 firmware.bin
+    $ xmodem recv --line /dev/ttyUSB0 --mode crc - | tar x
+
 For more information, take a look at the documentation_.
 
 .. _documentation: http://packages.python.org/xmodem/xmodem.html
@@ -47,5 +52,8 @@ For more information, take a look at the documentation_.
     keywords     = 'xmodem protocol',
     packages     = ['xmodem'],
     package_data = {'': ['doc/*.TXT']},
+    entry_points = {
+        'console_scripts': ['xmodem = xmodem.cli:main'],
+    },
 )
 
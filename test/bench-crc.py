@@ -0,0 +1,39 @@
+import os
+import timeit
+import xmodem
+from xmodem import XMODEM
+
+
+def legacy_crc(data, crc=0):
+    # per byte implementation as shipped with xmodem 0.2.4
+    for char in data:
+        crc = (crc << 8) ^ XMODEM.crctable[((crc >> 8) ^ ord(char)) & 0xff]
+    return crc & 0xffff
+
+
+def legacy_checksum(data, checksum=0):
+    return (sum(map(ord, data)) + checksum) % 256
+
+
+if __name__ == '__main__':
+    xmodem._crc16_tables = xmodem._make_crc16_tables()
+    engines = [
+        ('legacy crc', legacy_crc),
+        ('table crc', xmodem._calc_crc_table),
+        ('backend crc', xmodem.calc_crc),
+        ('legacy checksum', legacy_checksum),
+        ('backend checksum', xmodem.calc_checksum),
+    ]
+
+    for size in (128, 1024):
+        block = os.urandom(size)
+        # legacy code works on one character strings
+        chars = block if isinstance(block[0], str) else block.decode('latin-1')
+        number = 200000 // size * 10
+        for name, func in engines:
+            data = chars if name.startswith('legacy') else block
+            seconds = min(timeit.repeat(lambda: func(data), number=number,
+                                        repeat=3))
+            print('%4d bytes %-18s %8.2f us/block %8.2f MB/s' % (
+                size, name, seconds / number * 1e6,
+                size * number / seconds / 1e6))
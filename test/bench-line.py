@@ -0,0 +1,222 @@
+'''
+Measure transfer throughput over a simulated serial line.
+
+Both ends of a transfer run in this process, talking over an in-memory
+loopback line with a configurable baud rate, one-way latency, bit error rate
+and burst drops. Every combination of line profile and mode is transferred
+once, a summary is printed to stderr and the results are written as JSON
+lines, one object per transfer, so they can be compared between revisions.
+
+    $ python test/bench-line.py --output results.jsonl
+    $ python test/bench-line.py --profile noisy --mode 1k --size 65536
+    $ python test/bench-line.py --baud 9600 --latency 0.05 --ber 1e-5
+'''
+
+import argparse
+import collections
+import io
+import json
+import math
+import os
+import random
+import sys
+import threading
+import time
+
+from xmodem import XMODEM
+
+
+# process time is called clock in Python 2
+process_time = getattr(time, 'process_time', getattr(time, 'clock', None))
+
+# line profiles: baud rate (0 is unlimited), one-way latency in seconds, bit
+# error rate, chance of a burst drop per write and the size of the burst
+PROFILES = collections.OrderedDict([
+    ('loopback', dict(baud=0, latency=0.0, ber=0.0, drop=0.0, burst=0)),
+    ('serial', dict(baud=115200, latency=0.001, ber=0.0, drop=0.0, burst=0)),
+    ('noisy', dict(baud=115200, latency=0.001, ber=1e-5, drop=0.0, burst=0)),
+    ('bursty', dict(baud=115200, latency=0.01, ber=0.0, drop=0.02,
+                    burst=64)),
+])
+
+# modem mode and crc_mode of the receiver
+MODES = collections.OrderedDict([
+    ('checksum', ('xmodem', 0)),
+    ('crc', ('xmodem', 1)),
+    ('1k', ('xmodem1k', 1)),
+])
+
+
+class Channel(object):
+    '''
+    One direction of a simulated line. Written bytes are delivered after
+    they have been clocked out at the baud rate and the latency passed, some
+    bits are flipped and some bursts of bytes are lost on the way.
+    '''
+
+    def __init__(self, baud=0, latency=0.0, ber=0.0, drop=0.0, burst=0,
+                 seed=None):
+        self.baud = baud
+        self.latency = latency
+        self.ber = ber
+        self.drop = drop
+        self.burst = burst
+        self.random = random.Random(seed)
+        self.flipped = 0
+        self.dropped = 0
+        self._lock = threading.Condition()
+        self._pending = collections.deque()
+        self._buffer = bytearray()
+        self._idle = 0.0
+
+    def write(self, data, timeout=1):
+        data = self._mangle(bytearray(data))
+        with self._lock:
+            now = time.time()
+            start = max(now, self._idle)
+            # ten bits per byte, a start and a stop bit for eight data bits
+            if self.baud:
+                self._idle = start + len(data) * 10.0 / self.baud
+            else:
+                self._idle = start
+            self._pending.append((self._idle + self.latency, bytes(data)))
+            self._lock.notify_all()
+        return len(data)
+
+    def read(self, size, timeout=1):
+        deadline = time.time() + timeout
+        with self._lock:
+            while True:
+                now = time.time()
+                while self._pending and self._pending[0][0] <= now:
+                    self._buffer.extend(self._pending.popleft()[1])
+                if len(self._buffer) >= size or now >= deadline:
+                    break
+                wait = deadline - now
+                if self._pending:
+                    wait = min(wait, self._pending[0][0] - now)
+                self._lock.wait(wait)
+
+            if not self._buffer:
+                return None
+            # like a serial port, return what arrived before the timeout
+            data = bytes(self._buffer[:size])
+            del self._buffer[:size]
+            return data
+
+    def _mangle(self, data):
+        if data and self.drop and self.random.random() < self.drop:
+            start = self.random.randrange(len(data))
+            lost = data[start:start + self.burst]
+            self.dropped += len(lost)
+            del data[start:start + self.burst]
+
+        if self.ber:
+            # skip ahead to the next flipped bit
+            bit = -1
+            while True:
+                bit += 1 + int(math.log(1.0 - self.random.random()) /
+                               math.log(1.0 - self.ber))
+                if bit >= len(data) * 8:
+                    break
+                data[bit // 8] ^= 1 << (bit % 8)
+                self.flipped += 1
+        return data
+
+
+def run(profile, mode, size, timeout, seed):
+    '''
+    Transfer ``size`` random bytes over a line with the given ``profile``,
+    returns a dictionary with the results.
+    '''
+    name, crc_mode = MODES[mode]
+    line = PROFILES[profile]
+    forward = Channel(seed=seed, **line)
+    reverse = Channel(seed=seed + 1, **line)
+    sender = XMODEM(reverse.read, forward.write, name)
+    receiver = XMODEM(forward.read, reverse.write, name)
+
+    data = os.urandom(size)
+    output = io.BytesIO()
+    thread = threading.Thread(target=receiver.recv, args=(output,),
+                              kwargs=dict(crc_mode=crc_mode, timeout=timeout,
+                                          delay=0, quiet=1))
+
+    started = time.time()
+    cpu = process_time()
+    thread.start()
+    sent = sender.send(io.BytesIO(data), timeout=timeout, quiet=1)
+    thread.join()
+    cpu = process_time() - cpu
+    elapsed = time.time() - started
+
+    ok = bool(sent) and output.getvalue()[:size] == data
+    result = collections.OrderedDict([
+        ('profile', profile),
+        ('mode', mode),
+        ('ok', ok),
+        ('size', size),
+        ('elapsed', elapsed),
+        ('throughput', size / elapsed if ok else 0.0),
+        ('cpu_per_mb', cpu / size * 1e6),
+        ('efficiency', 0.0),
+    ])
+    if ok and line['baud']:
+        # share of the raw line capacity carrying payload
+        result['efficiency'] = result['throughput'] / (line['baud'] / 10.0)
+    for side, modem in (('send', sender), ('recv', receiver)):
+        stats = modem.stats
+        for field in ('naks', 'timeouts', 'retransmits'):
+            result['%s_%s' % (side, field)] = getattr(stats, field)
+    result['flipped'] = forward.flipped + reverse.flipped
+    result['dropped'] = forward.dropped + reverse.dropped
+    result.update(line)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--profile', action='append', choices=PROFILES,
+                        help='line profile, may be repeated (default: all)')
+    parser.add_argument('--mode', action='append', choices=MODES,
+                        help='transfer mode, may be repeated (default: all)')
+    parser.add_argument('--size', type=int, default=32768,
+                        help='bytes per transfer (default: %(default)s)')
+    parser.add_argument('--timeout', type=float, default=10,
+                        help='transfer timeout (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed for the line errors (default: %(default)s)')
+    parser.add_argument('--output', help='write JSON lines to this file '
+                                         'instead of stdout')
+    for name in ('baud', 'latency', 'ber', 'drop', 'burst'):
+        parser.add_argument('--' + name, type=type(PROFILES['bursty'][name]),
+                            help='override the %s of the profiles' % (name,))
+    args = parser.parse_args()
+
+    for profile in PROFILES.values():
+        for name in profile:
+            if getattr(args, name) is not None:
+                profile[name] = getattr(args, name)
+
+    output = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        for profile in args.profile or PROFILES:
+            for mode in args.mode or MODES:
+                result = run(profile, mode, args.size, args.timeout,
+                             args.seed)
+                output.write(json.dumps(result) + '\n')
+                output.flush()
+                sys.stderr.write(
+                    '%-8s %-8s %-4s %9.1f KB/s %7.3f cpu s/MB '
+                    '%3d retransmits %3d timeouts\n' % (
+                        profile, mode, 'ok' if result['ok'] else 'FAIL',
+                        result['throughput'] / 1e3, result['cpu_per_mb'],
+                        result['send_retransmits'], result['send_timeouts'] +
+                        result['recv_timeouts']))
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,43 @@
+'''
+Helpers shared by the tests.
+'''
+
+import time
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+
+def transport(rq, wq, mangle=None):
+    '''
+    Returns the ``getc`` and ``putc`` callables of one end of a line made of
+    two queues, reading from ``rq`` and writing to ``wq``. Every write is
+    passed through ``mangle``, if given, with its number and data.
+    '''
+    buffer = bytearray()
+    writes = [0]
+
+    def getc(size, timeout=1):
+        deadline = time.time() + timeout
+        while len(buffer) < size:
+            try:
+                buffer.extend(rq.get(timeout=max(0, deadline - time.time())))
+            except queue.Empty:
+                # like a serial port, return what arrived before the timeout
+                break
+        if not buffer:
+            return None
+        data = bytes(buffer[:size])
+        del buffer[:size]
+        return data
+
+    def putc(data, timeout=1):
+        writes[0] += 1
+        if mangle is not None:
+            data = mangle(writes[0], data)
+        wq.put(bytes(data))
+        return len(data)
+
+    return getc, putc
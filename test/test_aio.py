@@ -0,0 +1,188 @@
+import asyncio
+import io
+import os
+
+import pytest
+
+import xmodem
+from xmodem import Done
+from xmodem.aio import AsyncXMODEM
+
+
+class MemoryWriter(object):
+    '''
+    Writer half of an in-memory stream pair, feeds the peer reader.
+    '''
+
+    def __init__(self, reader, corrupt=()):
+        self.reader = reader
+        self.corrupt = set(corrupt)
+        self.writes = 0
+
+    def write(self, data):
+        self.writes += 1
+        if self.writes in self.corrupt:
+            # flip a bit in the middle of the frame
+            data = bytearray(data)
+            data[len(data) // 2] ^= 0x01
+            data = bytes(data)
+        self.reader.feed_data(data)
+
+    async def drain(self):
+        await asyncio.sleep(0)
+
+
+def memory_pair(corrupt=()):
+    a, b = asyncio.StreamReader(), asyncio.StreamReader()
+    sender = AsyncXMODEM.from_streams(a, MemoryWriter(b, corrupt), 'xmodem1k')
+    receiver = AsyncXMODEM.from_streams(b, MemoryWriter(a), 'xmodem1k')
+    return sender, receiver
+
+
+async def transfer(data, streaming=0, crc_mode=1, corrupt=()):
+    sender, receiver = memory_pair(corrupt)
+    output = io.BytesIO()
+    sent, size = await asyncio.gather(
+        sender.send(io.BytesIO(data), timeout=5, quiet=1),
+        receiver.recv(output, crc_mode=crc_mode, timeout=5, delay=0.01,
+                      quiet=1, streaming=streaming),
+    )
+    return sent, size, output.getvalue()
+
+
+def padded(data):
+    # the tail of a stream always goes out as 128 byte blocks
+    return data.ljust(-(-len(data) // 128) * 128, b'\xff')
+
+
+@pytest.mark.parametrize('streaming,crc_mode', [(0, 0), (0, 1), (1, 1)])
+def test_transfer(streaming, crc_mode):
+    data = os.urandom(5000)
+    sent, size, output = asyncio.run(transfer(data, streaming, crc_mode))
+    assert sent is True
+    assert output == padded(data)
+    assert size == len(output)
+
+
+def test_retransmit():
+    data = os.urandom(3000)
+    sent, size, output = asyncio.run(transfer(data, corrupt=(2, 4)))
+    assert sent is True
+    assert output == padded(data)
+
+
+def test_concurrent():
+    payloads = [os.urandom(n * 37) for n in range(1, 301)]
+
+    async def main():
+        return await asyncio.gather(*[
+            transfer(data, streaming=n % 2)
+            for n, data in enumerate(payloads)
+        ])
+
+    results = asyncio.run(main())
+    assert len(results) == len(payloads)
+    for data, (sent, size, output) in zip(payloads, results):
+        assert sent is True
+        assert output == padded(data)
+
+
+def test_stats_and_callbacks():
+    progress = []
+    events = []
+
+    async def main():
+        a, b = asyncio.StreamReader(), asyncio.StreamReader()
+        sender = AsyncXMODEM.from_streams(
+            a, MemoryWriter(b, corrupt=(3,)), 'xmodem1k',
+            progress_callback=lambda stats: progress.append(stats.bytes),
+            event_callback=lambda event, stats: events.append(event))
+        receiver = AsyncXMODEM.from_streams(b, MemoryWriter(a))
+        await asyncio.gather(
+            sender.send(io.BytesIO(os.urandom(4096)), timeout=5),
+            receiver.recv(io.BytesIO(), timeout=5, delay=0.01))
+        return sender.stats, receiver.stats
+
+    sent, received = asyncio.run(main())
+    assert progress == [1024, 2048, 3072, 4096]
+    assert [type(event).__name__ for event in events].count('Retransmit') == 1
+    assert events[-1] == Done(True)
+    assert sent.block_size == 1024 and sent.naks == 1
+    # the retransmitted block has no meaningful round-trip time
+    assert sum(sent.rtt.values()) == 3
+    assert received.bytes == 4096 and received.bytes_per_second > 0
+
+
+def test_delta():
+    old = os.urandom(50 * 1024)
+    new = old[:10000] + os.urandom(10) + old[10010:40000]
+
+    async def main():
+        sender, receiver = memory_pair()
+        output = io.BytesIO(old)
+        sent, size = await asyncio.gather(
+            sender.send(io.BytesIO(new), timeout=5, delta=1),
+            receiver.recv(output, timeout=5, delay=0.01, delta=1))
+        return sent, size, output.getvalue(), sender.stats
+
+    sent, size, output, stats = asyncio.run(main())
+    assert sent is True
+    assert size == len(new)
+    assert output == new
+    assert stats.bytes < 4096
+
+
+class BrokenFile(io.BytesIO):
+    def write(self, data):
+        raise IOError('disk full')
+
+
+def test_write_error():
+    async def main():
+        sender, receiver = memory_pair()
+        return await asyncio.gather(
+            sender.send(io.BytesIO(os.urandom(4096)), timeout=5),
+            receiver.recv(BrokenFile(), timeout=5, delay=0.01),
+            return_exceptions=True)
+
+    sent, error = asyncio.run(main())
+    # the receiver cancels the transfer and raises the error
+    assert sent is False
+    assert isinstance(error, IOError)
+
+
+class Prefetcher(xmodem._Prefetcher):
+    stages = []
+
+    def __init__(self, *args):
+        super(Prefetcher, self).__init__(*args)
+        self.stages.append(self)
+
+
+def test_cancel_prefetch(monkeypatch):
+    monkeypatch.setattr(xmodem, '_Prefetcher', Prefetcher)
+    replies = [b'C']
+
+    async def getc(size, timeout=1):
+        if replies:
+            return replies.pop()
+        # the receiver went quiet
+        await asyncio.sleep(timeout)
+
+    async def putc(data, timeout=1):
+        return len(data)
+
+    modem = AsyncXMODEM(getc, putc)
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(asyncio.wait_for(
+            modem.send(io.BytesIO(os.urandom(128 * 40)), prefetch=8), 0.2))
+    # the stage reading ahead is stopped along with the transfer
+    assert len(Prefetcher.stages) == 1
+    assert not Prefetcher.stages[0]._thread.is_alive()
+
+
+def test_checkpoint_compress(tmpdir):
+    modem = AsyncXMODEM(None, None)
+    with pytest.raises(ValueError):
+        asyncio.run(modem.recv(io.BytesIO(), compress=1,
+                                  checkpoint=str(tmpdir.join('journal'))))
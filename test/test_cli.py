@@ -0,0 +1,61 @@
+import io
+import os
+import threading
+
+import pytest
+
+pytest.importorskip('termios')
+
+from xmodem import XMODEM
+from xmodem.cli import main
+from xmodem.transport import TTYTransport
+
+
+@pytest.fixture
+def line():
+    master, slave = os.openpty()
+    transport = TTYTransport(master)
+    yield transport, slave
+    transport.close()
+    os.close(master)
+    os.close(slave)
+
+
+def test_send(line, tmpdir, capsys):
+    transport, fd = line
+    data = os.urandom(5000)
+    path = tmpdir.join('data.bin')
+    path.write_binary(data)
+    output = io.BytesIO()
+    modem = XMODEM(transport.getc, transport.putc)
+    thread = threading.Thread(target=modem.recv, args=(output,),
+                              kwargs=dict(timeout=5))
+    thread.start()
+    assert main(['send', '--fd', str(fd), '--mode', '1k', '--digest',
+                 'crc32', str(path)]) == 0
+    thread.join()
+    assert output.getvalue()[:len(data)] == data
+    summary = capsys.readouterr().err
+    assert summary.startswith('sent 5120 bytes in ')
+    assert 'sent digest ' in summary
+
+
+def test_recv(line, tmpdir, capsys):
+    transport, fd = line
+    data = os.urandom(3000)
+    path = tmpdir.join('data.bin')
+    modem = XMODEM(transport.getc, transport.putc, 'xmodem1k')
+    thread = threading.Thread(target=modem.send, args=(io.BytesIO(data),),
+                              kwargs=dict(timeout=5))
+    thread.start()
+    assert main(['recv', '--fd', str(fd), '--size', str(len(data)),
+                 str(path)]) == 0
+    thread.join()
+    assert path.read_binary() == data
+    assert capsys.readouterr().err.startswith('received 3000 bytes in ')
+
+
+def test_usage(capsys):
+    assert main([]) == 2
+    with pytest.raises(SystemExit):
+        main(['send', '--fd', '0', '-'])
@@ -0,0 +1,66 @@
+import io
+import os
+
+import pytest
+
+from xmodem.delta import Signatures, DeltaEncoder, DeltaPatcher, block_size
+
+
+def patch(old, new, size=512):
+    signatures = Signatures.from_stream(io.BytesIO(old), size)
+    # padded like the last block of a transfer
+    signatures = Signatures.parse(signatures.pack() + b'\xff' * 100)
+    encoder = DeltaEncoder(io.BytesIO(new), signatures, chunk=4096)
+    output = io.BytesIO(old)
+    patcher = DeltaPatcher(output)
+    while True:
+        data = encoder.read(1024)
+        if not data:
+            break
+        patcher.write(data)
+    patcher.write(b'\xff' * 100)
+    assert output.getvalue() == new
+    assert patcher.size == len(new)
+    return encoder
+
+
+OLD = os.urandom(100 * 1024)
+
+CASES = {
+    'same': (OLD, 0),
+    'changed': (OLD[:5000] + os.urandom(100) + OLD[5100:], 512),
+    'deleted': (OLD[:30000] + OLD[31000:], 1024),
+    'appended': (OLD + os.urandom(1000), 1000),
+    'truncated': (OLD[:1000], 488),
+    # blocks moved towards the end can not be copied in place
+    'inserted': (os.urandom(1000) + OLD, 1000 + len(OLD)),
+    'empty': (b'', 0),
+}
+
+
+@pytest.mark.parametrize('case', sorted(CASES))
+def test_patch(case):
+    new, literal = CASES[case]
+    encoder = patch(OLD, new)
+    assert encoder.literal <= literal
+    assert encoder.copied + encoder.literal == len(new)
+
+
+def test_rolling_checksum():
+    # blocks are found at any offset after a deletion
+    encoder = patch(OLD, OLD[:300] + OLD[301:])
+    assert encoder.copied == len(OLD) - 512
+
+
+def test_invalid():
+    with pytest.raises(ValueError):
+        Signatures.parse(b'\x00\x00\x02\x00\x00\x00\x00\x05')
+    patcher = DeltaPatcher(io.BytesIO(OLD))
+    with pytest.raises(ValueError):
+        patcher.write(b'X')
+
+
+def test_block_size():
+    assert block_size(0) == 512
+    assert block_size(1 << 20) == 1024
+    assert block_size(1 << 40) == 65536
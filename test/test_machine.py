@@ -0,0 +1,410 @@
+import hashlib
+import io
+import os
+import time
+import zlib
+
+import pytest
+
+from xmodem import Sender, Receiver, RetransmitTimer, PreparedImage, \
+    BlockAccepted, Retransmit, Done, Aborted, ACK, CAN, CRC, EOT, NAK, D, Z
+
+
+def pump(sender, receiver, corrupt=()):
+    '''
+    Shuttle bytes between two state machines, without any I/O.
+    '''
+    writes = 0
+    output = io.BytesIO()
+    events = []
+    data, more = receiver.start()
+    while not (sender.finished and receiver.finished):
+        if sender.expect is None:
+            break
+        if data or sender.expect == 0:
+            reply, more = sender.feed(data)
+        else:
+            reply, more = sender.timeout()
+        events.extend(more)
+
+        writes += 1
+        if writes in corrupt:
+            reply = bytearray(reply)
+            reply[len(reply) // 2] ^= 0x01
+            reply = bytes(reply)
+        if receiver.expect is None:
+            break
+        data, more = receiver.feed(reply)
+        if receiver.expect == 0:
+            # nothing more on the line, the receiver sends its NAK
+            data, purged = receiver.feed(b'')
+            more += purged
+        events.extend(more)
+        for event in more:
+            if isinstance(event, BlockAccepted):
+                output.write(event.data)
+    return output.getvalue(), events
+
+
+@pytest.mark.parametrize('mode', ['xmodem', 'xmodem1k'])
+@pytest.mark.parametrize('crc_mode,streaming', [(0, 0), (1, 0), (1, 1)])
+def test_transfer(mode, crc_mode, streaming):
+    data = os.urandom(3000)
+    sender = Sender(io.BytesIO(data), mode)
+    receiver = Receiver(crc_mode, streaming, size=len(data))
+    output, events = pump(sender, receiver)
+    assert output == data
+    assert Done(True) in events
+    assert Done(len(data)) in events
+
+
+def test_retransmit():
+    data = os.urandom(1000)
+    sender = Sender(io.BytesIO(data))
+    receiver = Receiver(size=len(data))
+    output, events = pump(sender, receiver, corrupt=(3,))
+    assert output == data
+    assert [e for e in events if isinstance(e, Retransmit)] == \
+        [Retransmit(3, 'damaged block'), Retransmit(3, 'NAK')]
+
+
+def test_frame_buffer():
+    sender = Sender(io.BytesIO(os.urandom(3 * 128)))
+    first, events = sender.feed(CRC)
+    assert bytes(first[:3]) == b'\x01\x01\xfe'
+    # frames are filled into a buffer that is handed out as it is
+    second, events = sender.feed(ACK)
+    assert second is first
+    assert bytes(second[:3]) == b'\x01\x02\xfd'
+
+
+def test_partial_frames():
+    data = os.urandom(300)
+    sender = Sender(io.BytesIO(data))
+    receiver = Receiver(size=len(data))
+    request, events = receiver.start()
+    frame, events = sender.feed(request)
+    # frames may arrive in pieces, or several at once
+    assert receiver.feed(frame[:50]) == (b'', [])
+    reply, events = receiver.feed(frame[50:])
+    assert events == [BlockAccepted(1, 128, data[:128])]
+    frame, events = sender.feed(reply)
+    assert events == [BlockAccepted(1, 128, None)]
+
+
+def test_cancel():
+    sender = Sender(io.BytesIO(b'data'))
+    assert sender.feed(CAN + CAN) == \
+        (b'', [Aborted('transfer cancelled by receiver')])
+    assert sender.expect is None
+
+
+def test_retry():
+    receiver = Receiver(retry=4)
+    requests = [receiver.start()[0]]
+    for attempt in range(4):
+        requests.append(receiver.timeout()[0])
+    assert requests == [b'C', b'C', b'\x15', b'\x15', CAN + CAN]
+    assert receiver.finished
+
+
+def test_streaming_request():
+    # XMODEM-G is requested first, then CRC and checksum mode
+    receiver = Receiver(streaming=1, retry=8)
+    requests = [receiver.start()[0]]
+    for attempt in range(4):
+        requests.append(receiver.timeout()[0])
+    assert requests == [b'G', b'G', b'C', b'C', b'\x15']
+    assert not receiver.streaming
+
+
+def test_stats():
+    data = os.urandom(1000)
+    sender = Sender(io.BytesIO(data), 'xmodem1k')
+    receiver = Receiver(size=len(data))
+    pump(sender, receiver, corrupt=(3,))
+    assert (sender.stats.blocks, sender.stats.bytes) == (8, 1024)
+    assert (receiver.stats.blocks, receiver.stats.bytes) == (8, 1000)
+    assert sender.stats.naks == receiver.stats.naks == 1
+    assert sender.stats.retransmits == 1
+    assert (sender.stats.crc_mode, sender.stats.streaming) == (1, 0)
+    assert sender.stats.block_size == receiver.stats.block_size == 128
+
+
+def test_stats_block_size():
+    data = os.urandom(5000)
+    sender = Sender(io.BytesIO(data), 'xmodem1k')
+    receiver = Receiver(size=len(data))
+    pump(sender, receiver)
+    # the short tail went out in 128 byte blocks
+    assert sender.stats.block_size == receiver.stats.block_size == 1024
+
+
+def test_adaptive_block_size():
+    data = os.urandom(40 * 1024)
+    sender = Sender(io.BytesIO(data), 'xmodem1k')
+    receiver = Receiver(size=len(data))
+    sizes = []
+    feed = sender.feed
+
+    def record(data):
+        reply, events = feed(data)
+        sizes.append(len(reply) - 5)
+        return reply, events
+
+    sender.feed = record
+    # refuse the second frame twice, after the burst of NAKs the refused
+    # block is sent again as it is, and the blocks after it in 128 bytes
+    output, events = pump(sender, receiver, corrupt=(2, 3))
+    assert output == data
+    assert sizes[:5] == [1024, 1024, 1024, 1024, 128]
+    assert sizes[4:4 + Sender.clean_run] == [128] * Sender.clean_run
+    assert sizes[4 + Sender.clean_run] == 1024
+
+
+def test_fallback_after_lost_ack():
+    data = os.urandom(4 * 1024)
+    sender = Sender(io.BytesIO(data), 'xmodem1k')
+    receiver = Receiver(size=len(data))
+    received = []
+
+    def deliver(frame):
+        reply, events = receiver.feed(frame)
+        received.extend(bytes(event.data) for event in events
+                        if isinstance(event, BlockAccepted))
+        return reply
+
+    first, events = sender.feed(receiver.start()[0])
+    # the first block is accepted, but its ACK is lost
+    assert deliver(first) == ACK
+    # NAKs for damaged copies of it make the sender fall back
+    assert sender.feed(NAK)[0] == first
+    again, events = sender.feed(NAK)
+    assert sender.packet_size == 128
+    # the block is sent again as it is, the receiver has it already
+    assert again == first
+    reply = deliver(again)
+    assert reply == ACK
+    while not sender.finished:
+        frame, events = sender.feed(reply)
+        if frame:
+            reply = deliver(frame)
+    assert b''.join(received) == data
+
+
+def test_buffer():
+    data = os.urandom(5000)
+    # sent from slices of the buffer, even when falling back to 128 bytes
+    sender = Sender(bytearray(data), 'xmodem1k')
+    receiver = Receiver(size=len(data))
+    output, events = pump(sender, receiver, corrupt=(2, 3))
+    assert output == data
+    assert sender._view is None
+
+
+@pytest.mark.parametrize('source', [io.BytesIO, bytes])
+def test_prefetch(source):
+    data = os.urandom(40 * 1024 + 100)
+    sender = Sender(source(data), 'xmodem1k', prefetch=4)
+    receiver = Receiver(size=len(data))
+    # blocks read ahead go back to the stream when falling back to 128 bytes
+    output, events = pump(sender, receiver, corrupt=(2, 3, 30))
+    assert output == data
+    assert sender._prefetcher is None
+
+
+def test_prefetch_buffers():
+    data = os.urandom(40 * 1024)
+    sender = Sender(io.BytesIO(data), 'xmodem1k', prefetch=2)
+    frame, events = sender.feed(CRC)
+    sent = bytes(frame)
+    # the stage fills its queue and frames one more block meanwhile
+    deadline = time.time() + 5
+    while not sender._prefetcher.queue.full() and time.time() < deadline:
+        time.sleep(0.01)
+    time.sleep(0.05)
+    assert isinstance(frame, bytearray)
+    assert frame == sent
+    resent, events = sender.feed(NAK)
+    assert resent is frame and resent == sent
+    sender._prefetcher.stop()
+
+
+@pytest.mark.parametrize('mode', ['xmodem', 'xmodem1k'])
+@pytest.mark.parametrize('crc_mode', [0, 1])
+def test_prepared_image(mode, crc_mode, monkeypatch):
+    data = os.urandom(20 * 1024 + 300)
+    image = PreparedImage(io.BytesIO(data))
+    for attempt in range(2):
+        sender = Sender(image, mode)
+        receiver = Receiver(crc_mode, size=len(data))
+        output, events = pump(sender, receiver, corrupt=(3,))
+        assert output == data
+        # the frames are made once
+        monkeypatch.setattr(Sender, '_build_frame', None)
+
+
+def test_prepared_image_fallback():
+    data = os.urandom(40 * 1024)
+    image = PreparedImage(data)
+    image.frame(1, 1024, 1, 0)
+    # blocks after falling back to 128 bytes are framed by the session
+    sender = Sender(image, 'xmodem1k')
+    receiver = Receiver(size=len(data))
+    output, events = pump(sender, receiver, corrupt=(2, 3))
+    assert output == data
+    frame = image.frame(1, 1024, 2, 1024)
+    assert isinstance(frame, memoryview) and frame.readonly
+    assert frame[:3] == b'\x02\x02\xfd' and frame[3:1027] == data[1024:2048]
+    assert image.frame(1, 1024, 3, 1024) is None
+    assert image.frame(1, 1024, 1, 40 * 1024) is None
+
+
+@pytest.mark.parametrize('mode', ['xmodem', 'xmodem1k'])
+def test_compress(mode):
+    data = b'0123456789abcdef' * 4000 + os.urandom(3000)
+    sender = Sender(io.BytesIO(data), mode, compress=1, flush=4096)
+    receiver = Receiver(compress=1)
+    assert receiver.start() == (Z, [])
+    output, events = pump(sender, receiver, corrupt=(3,))
+    assert output == data
+    assert Done(len(data)) in events
+    assert sender.stats.bytes < len(data) / 3
+
+
+def test_compress_refused():
+    data = os.urandom(1000)
+    # a sender without compression does not answer the request
+    sender = Sender(io.BytesIO(data))
+    receiver = Receiver(compress=1, retry=8)
+    assert sender.feed(receiver.start()[0]) == (b'', [])
+    requests = [receiver.timeout()[0] for attempt in range(2)]
+    assert requests == [Z, b'C']
+    output, events = pump(sender, receiver)
+    assert output[:len(data)] == data
+    assert not receiver.compressed
+
+
+@pytest.mark.parametrize('compress', [0, 1])
+def test_digest(compress):
+    data = os.urandom(40 * 1024 + 100)
+    sender = Sender(io.BytesIO(data), 'xmodem1k', compress=compress,
+                    digest='sha256')
+    receiver = Receiver(size=len(data), compress=compress, digest='crc32')
+    # falling back to 128 byte blocks on the way
+    pump(sender, receiver, corrupt=(2, 3))
+    assert sender.stats.digest == hashlib.sha256(data).hexdigest()
+    assert receiver.stats.digest == '%08x' % (zlib.crc32(data) & 0xffffffff,)
+
+
+def test_fixed_block_size():
+    data = os.urandom(8 * 1024)
+    sender = Sender(io.BytesIO(data), 'xmodem1k', adaptive=0)
+    receiver = Receiver(size=len(data))
+    output, events = pump(sender, receiver, corrupt=(2, 3, 4))
+    assert output == data
+    assert sender.stats.blocks == 8
+
+
+def test_retransmit_timer():
+    timer = RetransmitTimer(60, floor=0.5, ceiling=30)
+    assert timer.timeout == 30
+    for rtt in (0.1, 0.12, 0.09, 0.11):
+        timer.sample(rtt)
+    assert timer.timeout == 0.5
+    for rtt in (2.0, 2.5, 2.2):
+        timer.sample(rtt)
+    assert 2.0 < timer.timeout < 30
+    for attempt in range(10):
+        timer.backoff()
+    assert timer.timeout == 30
+
+
+def test_retransmit_timer_margin():
+    timer = RetransmitTimer(10)
+    assert timer.floor == 1
+    for attempt in range(50):
+        timer.sample(1.5)
+    # the variation is gone, the margin is not
+    assert timer.timeout >= 2.25
+    # frames of eight times the size
+    larger = RetransmitTimer(10)
+    larger.scale(timer, 8)
+    assert larger.timeout >= 8 * 2.25
+
+
+def test_duplicate_ack():
+    sender = Sender(io.BytesIO(os.urandom(3 * 1024)), 'xmodem1k')
+    first, events = sender.feed(CRC)
+    # the ACK is late, the block is sent again
+    assert sender.timeout() == (first, [Retransmit(1, 'timeout')])
+    output, events = sender.feed(ACK)
+    assert output == b''
+    assert events == [BlockAccepted(1, 1024, None)]
+    assert sender.state == 'drain'
+    # the ACK for the copy is dropped, the next block goes out
+    second, events = sender.feed(ACK)
+    assert second[:3] == b'\x02\x02\xfd'
+    # without a second ACK the sender moves on after a timeout
+    assert sender.timeout() == (second, [Retransmit(2, 'timeout')])
+    assert sender.feed(ACK)[1] == [BlockAccepted(2, 2048, None)]
+    assert sender.state == 'drain'
+    third, events = sender.timeout()
+    assert third[:3] == b'\x02\x03\xfc'
+    assert sender.stats.timeouts == 2
+    assert sender.feed(ACK)[0] == EOT
+    assert sender.feed(ACK)[1] == [Done(True)]
+
+
+def test_duplicate_acks():
+    sender = Sender(io.BytesIO(os.urandom(2 * 128)))
+    first, events = sender.feed(CRC)
+    # two copies of the block were sent after timeouts
+    sender.timeout()
+    sender.timeout()
+    assert sender.feed(ACK) == (b'', [BlockAccepted(1, 128, None)])
+    # and all three are acknowledged
+    assert sender.feed(ACK) == (b'', [])
+    second, events = sender.feed(ACK)
+    assert second[:3] == b'\x01\x02\xfd'
+    assert sender.feed(ACK) == (EOT, [BlockAccepted(2, 256, None)])
+
+
+def test_late_blocks():
+    sender = Sender(io.BytesIO(os.urandom(2 * 128)))
+    receiver = Receiver()
+    first, events = sender.feed(receiver.start()[0])
+    assert receiver.feed(first)[0] == ACK
+    second, events = sender.feed(ACK)
+    # both timeouts were answered with a NAK, both copies are dropped
+    assert receiver.timeout()[0] == receiver.timeout()[0] == NAK
+    assert receiver.feed(second)[0] == ACK
+    assert receiver.feed(second) == receiver.feed(second) == (b'', [])
+    assert receiver.feed(second) == (ACK, [])
+
+
+def test_late_block():
+    sender = Sender(io.BytesIO(os.urandom(256)))
+    receiver = Receiver()
+    request, events = receiver.start()
+    first, events = sender.feed(request)
+    assert receiver.feed(first)[0] == ACK
+    second, events = sender.feed(ACK)
+    # the second block is late, the receiver asks for it again
+    assert receiver.timeout() == (NAK, [])
+    assert receiver.feed(second)[0] == ACK
+    # the copy sent for the NAK is dropped
+    assert receiver.feed(second) == (b'', [])
+    # later copies are acknowledged, the ACK may have been lost
+    assert receiver.feed(second) == (ACK, [])
+    assert receiver.stats.retransmits == 2
+
+
+def test_delta_request():
+    # signatures are only sent when asked for with D
+    sender = Sender(b'signatures', delta=1)
+    assert sender.feed(b'C') == (b'', [])
+    receiver = Receiver(delta=1)
+    assert receiver.start() == (D, [])
+    output, events = pump(sender, receiver)
+    assert output.rstrip(b'\xff') == b'signatures'
@@ -0,0 +1,154 @@
+import io
+import mmap
+import os
+import threading
+import time
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+from xmodem import XMODEM, PreparedImage
+from xmodem.manager import TransferManager
+
+from helpers import transport
+
+
+def device(output):
+    '''
+    Start a receiving device, returns the transport of the port it is on.
+    '''
+    a, b = queue.Queue(), queue.Queue()
+    getc, putc = transport(b, a)
+    modem = XMODEM(getc, putc)
+    thread = threading.Thread(target=modem.recv, args=(output,),
+                              kwargs=dict(timeout=1, quiet=1))
+    thread.daemon = True
+    thread.start()
+    return transport(a, b)
+
+
+class FakeModem(object):
+    '''
+    Modem recording the order and overlap of the jobs it runs.
+    '''
+    log = []
+    active = {}
+    overlap = []
+    failures = {}
+    lock = threading.Lock()
+
+    def __init__(self, getc, putc, mode='xmodem'):
+        self.port = getc
+
+    def send(self, name, hold=0.0):
+        with self.lock:
+            self.log.append(name)
+            self.active[self.port] = self.active.get(self.port, 0) + 1
+            self.overlap.append(self.active[self.port])
+        time.sleep(hold)
+        with self.lock:
+            self.active[self.port] -= 1
+            if self.failures.get(name):
+                self.failures[name] -= 1
+                return False
+        return True
+
+
+def fake_submit(manager, port, name, **kwargs):
+    return manager.submit(port, (port, None), 'send', name, modem=FakeModem,
+                          **kwargs)
+
+
+def test_send():
+    manager = TransferManager(workers=3)
+    payloads = [os.urandom(n * 500) for n in range(1, 7)]
+    outputs = [io.BytesIO() for data in payloads]
+    futures = [
+        manager.send('port%d' % n, device(output), io.BytesIO(data),
+                     timeout=1, quiet=1)
+        for n, (data, output) in enumerate(zip(payloads, outputs))
+    ]
+    assert [future.result(timeout=30) for future in futures] == [True] * 6
+    manager.shutdown()
+
+    for data, output in zip(payloads, outputs):
+        assert output.getvalue()[:len(data)] == data
+    progress = manager.progress()
+    assert progress['done'] == 6
+    assert progress['failed'] == 0
+    # the blocks acknowledged, the padding of the last block included
+    assert progress['bytes'] == sum(-(-len(data) // 128) * 128
+                                    for data in payloads)
+    assert progress['throughput'] > 0
+
+
+def test_mmap(tmpdir):
+    data = os.urandom(5000)
+    path = tmpdir.join('image')
+    path.write_binary(data)
+    with open(str(path), 'rb') as stream:
+        source = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+    manager = TransferManager()
+    output = io.BytesIO()
+    future = manager.send('port', device(output), source, timeout=1,
+                          quiet=1)
+    assert future.result(timeout=30) is True
+    manager.shutdown()
+
+    assert output.getvalue()[:len(data)] == data
+    # sent from the buffer, not read through the stream
+    assert source.tell() == 0
+    assert manager.progress()['bytes'] == 5120
+    source.close()
+
+
+def test_prepared_image():
+    data = os.urandom(5000)
+    image = PreparedImage(data)
+    manager = TransferManager(workers=8)
+    outputs = [io.BytesIO() for n in range(8)]
+    futures = [
+        manager.send('port%d' % n, device(output), image, timeout=1,
+                     quiet=1)
+        for n, output in enumerate(outputs)
+    ]
+    assert [future.result(timeout=30) for future in futures] == [True] * 8
+    manager.shutdown()
+
+    for output in outputs:
+        assert output.getvalue()[:len(data)] == data
+    # counted from the stats, the padding of the last block included
+    assert manager.progress()['bytes'] == 8 * 5120
+
+
+def test_port_limits_and_priority():
+    del FakeModem.log[:], FakeModem.overlap[:]
+    manager = TransferManager(workers=4, port_limits={'b': 2})
+    futures = [fake_submit(manager, 'a', 'first', hold=0.1)]
+    futures += [fake_submit(manager, 'a', 'low%d' % n) for n in range(3)]
+    futures += [fake_submit(manager, 'a', 'high', priority=10)]
+    futures += [fake_submit(manager, 'b', 'b%d' % n, hold=0.05)
+                for n in range(4)]
+    for future in futures:
+        assert future.result(timeout=10)
+    manager.shutdown()
+
+    jobs = [name for name in FakeModem.log if not name.startswith('b')]
+    assert jobs == ['first', 'high', 'low0', 'low1', 'low2']
+    assert max(FakeModem.overlap) == 2
+
+
+def test_retry():
+    FakeModem.failures['flaky'] = 2
+    FakeModem.failures['broken'] = 5
+    manager = TransferManager()
+    flaky = fake_submit(manager, 'a', 'flaky', retries=2, backoff=0.01)
+    broken = fake_submit(manager, 'b', 'broken', retries=1, backoff=0.01)
+    assert flaky.result(timeout=10) is True
+    assert broken.result(timeout=10) is False
+    manager.shutdown()
+    assert FakeModem.failures == {'flaky': 0, 'broken': 3}
+    progress = manager.progress()
+    assert (progress['done'], progress['failed']) == (1, 1)
@@ -0,0 +1,100 @@
+import io
+import os
+import threading
+import time
+
+import pytest
+
+termios = pytest.importorskip('termios')
+
+from xmodem import XMODEM, FrameReader
+from xmodem.transport import TTYTransport
+
+
+@pytest.fixture
+def pty():
+    master, slave = os.openpty()
+    a, b = TTYTransport(master), TTYTransport(slave)
+    yield a, b
+    for transport in (a, b):
+        transport.close()
+    os.close(master)
+    os.close(slave)
+
+
+def test_raw_mode():
+    master, slave = os.openpty()
+    original = termios.tcgetattr(slave)
+    transport = TTYTransport(slave, baudrate=115200)
+    attributes = termios.tcgetattr(slave)
+    assert not attributes[3] & (termios.ICANON | termios.ECHO)
+    assert attributes[6][termios.VMIN] == 0
+    assert attributes[5] == termios.B115200
+
+    transport.close()
+    # the original settings are restored
+    assert termios.tcgetattr(slave) == original
+    os.close(master)
+    os.close(slave)
+
+
+def test_getc_putc(pty):
+    a, b = pty
+    data = bytes(bytearray(range(256))) * 16
+    assert a.putv([data[:100], b'', data[100:]]) == len(data)
+    assert b.getc(10) == data[:10]
+    assert b.getc(len(data)) == data[10:]
+
+    started = time.time()
+    assert b.getc(1, timeout=0.2) is None
+    # waits out the timeout, the upper bound only catches a hang as a
+    # loaded machine may be slow to wake the reader up
+    assert 0.15 < time.time() - started < 5
+
+    # what arrived in time is returned
+    a.putc(b'abc')
+    assert b.getc(10, timeout=0.2) == b'abc'
+
+
+def test_read1(pty):
+    a, b = pty
+    a.putc(b'abc')
+    started = time.time()
+    # returns what the line has, without waiting for more
+    assert b.read1(4096, timeout=5) == b'abc'
+    assert time.time() - started < 4
+    assert b.read1(10, timeout=0.1) is None
+
+
+def test_transfer(pty):
+    a, b = pty
+    data = os.urandom(50000)
+    output = io.BytesIO()
+    receiver = XMODEM(b.getc, b.putc, 'xmodem1k')
+    thread = threading.Thread(target=receiver.recv, args=(output,),
+                              kwargs=dict(timeout=5, quiet=1))
+    thread.start()
+    sender = XMODEM(a.getc, a.putc, 'xmodem1k')
+    assert sender.send(io.BytesIO(data), timeout=5, quiet=1) is True
+    thread.join()
+    assert output.getvalue()[:len(data)] == data
+
+
+@pytest.mark.parametrize('read1', [0, 1])
+def test_frame_reader(pty, read1):
+    a, b = pty
+    data = os.urandom(20 * 1024)
+    output = io.BytesIO()
+    reader = FrameReader(b.getc, read1=b.read1 if read1 else None)
+    receiver = XMODEM(reader, b.putc, 'xmodem1k')
+    thread = threading.Thread(target=receiver.recv, args=(output,),
+                              kwargs=dict(timeout=5, quiet=1))
+    thread.start()
+    started = time.time()
+    sender = XMODEM(a.getc, a.putc, 'xmodem1k')
+    assert sender.send(io.BytesIO(data), timeout=5, quiet=1) is True
+    thread.join()
+    assert output.getvalue() == data
+    # reads never wait out the timeout
+    assert time.time() - started < 2
+    assert receiver.stats.timeouts == 0
@@ -0,0 +1,716 @@
+import hashlib
+import io
+import mmap
+import os
+import random
+import threading
+import time
+
+import pytest
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+import xmodem
+from xmodem import XMODEM, YMODEM, Checkpoint, PreparedImage, WriteBehind, \
+    SOH, STX, EOT, calc_crc, calc_checksum
+
+from helpers import transport
+
+
+def transfer(data, mangle=None, timeout=10, source=io.BytesIO,
+             output=None, prefetch=0, recv=None, send=None, reply=None,
+             **kwargs):
+    a, b = queue.Queue(), queue.Queue()
+    sender = XMODEM(*transport(a, b, mangle), **kwargs)
+    receiver = XMODEM(*transport(b, a, reply), **kwargs)
+    if output is None:
+        output = io.BytesIO()
+    result = []
+    options = dict(timeout=timeout, quiet=1, **(recv or {}))
+
+    def run():
+        try:
+            result.append(receiver.recv(output, **options))
+        except Exception as error:
+            result.append(error)
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    started = time.time()
+    sent = sender.send(source(data), timeout=timeout, quiet=1,
+                       prefetch=prefetch, **(send or {}))
+    thread.join()
+    receiver.result = result[0]
+    if hasattr(output, 'getvalue'):
+        output = output.getvalue()
+    return sent, output, time.time() - started, sender, receiver
+
+
+def test_truncated_frame():
+    def truncate(count, data):
+        # cut the tenth frame short
+        return data[:60] if count == 10 else data
+
+    data = os.urandom(128 * 20)
+    sent, output, elapsed, sender, receiver = transfer(data, truncate)
+    assert sent is True
+    assert output == data
+    # the receiver refused the frame long before the configured timeout
+    assert elapsed < 5
+
+
+def test_lost_ack():
+    def drop(count, data):
+        # an ACK lost on the line
+        return b'' if count == 8 else data
+
+    a, b = queue.Queue(), queue.Queue()
+    sender = XMODEM(*transport(a, b))
+    receiver = XMODEM(*transport(b, a, drop))
+    output = io.BytesIO()
+    data = os.urandom(128 * 20)
+    thread = threading.Thread(target=receiver.recv, args=(output,),
+                              kwargs=dict(timeout=10, quiet=1))
+    thread.start()
+    started = time.time()
+    assert sender.send(io.BytesIO(data), timeout=10, quiet=1) is True
+    thread.join()
+    assert output.getvalue() == data
+    assert sender.stats.timeouts == 1
+    assert time.time() - started < 5
+
+
+def test_fixed_timeout():
+    def truncate(count, data):
+        return data[:60] if count == 3 else data
+
+    data = os.urandom(128 * 4)
+    sent, output, elapsed, sender, receiver = transfer(
+        data, truncate, timeout=1, min_timeout=None)
+    assert sent is True
+    assert output == data
+    assert elapsed >= 1
+
+
+def test_buffers():
+    data = os.urandom(10000)
+    source = mmap.mmap(-1, len(data))
+    source.write(data)
+    source.seek(0)
+    output = bytearray(len(data))
+    sent, output, elapsed, sender, receiver = transfer(
+        data, source=lambda data: source, output=output, mode='xmodem1k')
+    assert sent is True
+    # the padding of the last block does not fit and is dropped
+    assert output == data
+    # both sides let go of the mmap
+    source.close()
+
+    destination = mmap.mmap(-1, 2 * len(data))
+    destination.seek(100)
+    sent, output, elapsed, sender, receiver = transfer(
+        data, source=bytes, output=destination)
+    assert sent is True
+    assert destination[100:100 + len(data)] == data
+    assert destination.tell() == 100 + len(data) + 112
+    destination.close()
+
+
+class SlowStream(io.BytesIO):
+    def read(self, size=-1):
+        time.sleep(0.005)
+        return io.BytesIO.read(self, size)
+
+
+def test_prefetch():
+    data = os.urandom(128 * 40)
+    sent, output, elapsed, sender, receiver = transfer(
+        data, source=SlowStream, prefetch=8)
+    assert sent is True
+    assert output == data
+
+
+class Prefetcher(xmodem._Prefetcher):
+    stages = []
+
+    def __init__(self, *args):
+        super(Prefetcher, self).__init__(*args)
+        self.stages.append(self)
+
+
+def test_prefetch_error(monkeypatch):
+    monkeypatch.setattr(xmodem, '_Prefetcher', Prefetcher)
+
+    def putc(data, timeout=1):
+        raise IOError('line gone')
+
+    modem = XMODEM(lambda size, timeout=1: b'C', putc)
+    with pytest.raises(IOError):
+        modem.send(SlowStream(os.urandom(128 * 40)), prefetch=8)
+    # the stage reading ahead is stopped along with the transfer
+    assert len(Prefetcher.stages) == 1
+    assert not Prefetcher.stages[0]._thread.is_alive()
+
+
+class SyncedFile(io.FileIO):
+    writes = []
+
+    def write(self, data):
+        self.writes.append(len(data))
+        return io.FileIO.write(self, data)
+
+
+def test_write_behind(tmpdir, monkeypatch):
+    synced = []
+    monkeypatch.setattr(os, 'fsync', synced.append)
+    data = os.urandom(200 * 1024)
+    path = str(tmpdir.join('output'))
+    output = SyncedFile(path, 'w')
+    sent, output, elapsed, sender, receiver = transfer(
+        data, output=output, mode='xmodem1k',
+        recv=dict(write_behind=1, fsync=65536))
+    output.close()
+    assert sent is True
+    assert receiver.result == len(data)
+    assert open(path, 'rb').read() == data
+    # blocks are coalesced into large writes
+    assert SyncedFile.writes[0] == 65536
+    # every 64 KiB, and the tail at the end of the transfer
+    assert len(synced) == 4
+
+
+class BrokenFile(io.BytesIO):
+    def write(self, data):
+        raise IOError('disk full')
+
+
+def test_write_behind_error():
+    sent, output, elapsed, sender, receiver = transfer(
+        os.urandom(1024), output=BrokenFile(), timeout=1,
+        recv=dict(write_behind=1))
+    assert sent is False
+    assert isinstance(receiver.result, IOError)
+
+
+def test_write_behind_policy():
+    with pytest.raises(ValueError):
+        WriteBehind(io.BytesIO(), fsync='always')
+
+
+@pytest.mark.parametrize('source', [io.BytesIO, bytearray])
+def test_compress(source):
+    data = b''.join(b'line %d of a log file\n' % (n,) for n in range(5000))
+    sent, output, elapsed, sender, receiver = transfer(
+        data, source=source, send=dict(compress=1, flush=8192),
+        recv=dict(compress=1))
+    assert sent is True
+    # no padding, the compressed stream marks its own end
+    assert output == data
+    assert receiver.result == len(data)
+    assert sender.stats.compressed == receiver.stats.compressed == 1
+    assert sender.stats.uncompressed == receiver.stats.uncompressed == \
+        len(data)
+    assert sender.stats.bytes < len(data) / 3
+
+
+def test_compress_plain_sender():
+    data = os.urandom(1000)
+    sent, output, elapsed, sender, receiver = transfer(
+        data, timeout=10, recv=dict(compress=1, retry=8), min_timeout=0.2)
+    assert sent is True
+    assert output[:len(data)] == data
+    assert receiver.stats.compressed == 0
+    # the requests for compression are not given the whole timeout
+    assert elapsed < 5
+
+
+def test_compress_checkpoint(tmpdir):
+    modem = XMODEM(None, None)
+    with pytest.raises(ValueError):
+        modem.recv(io.BytesIO(), compress=1,
+                   checkpoint=str(tmpdir.join('journal')))
+
+
+@pytest.mark.parametrize('compress', [0, 1])
+def test_delta(tmpdir, compress):
+    old = os.urandom(200 * 1024)
+    new = bytearray(old)
+    new[5000:5100] = os.urandom(100)
+    new = bytes(new[:150 * 1024] + new[151 * 1024:] + os.urandom(300))
+    path = tmpdir.join('image.bin')
+    path.write_binary(old)
+    with open(str(path), 'r+b') as output:
+        sent, output, elapsed, sender, receiver = transfer(
+            new, output=output, send=dict(delta=1, compress=compress),
+            recv=dict(delta=1, compress=compress))
+    assert sent is True
+    assert receiver.result == len(new)
+    assert path.read_binary() == new
+    # the signatures and the changed blocks
+    assert sender.stats.bytes < 10 * 1024
+
+
+@pytest.mark.parametrize('source', [io.BytesIO, bytes])
+def test_digest(source):
+    data = os.urandom(10000)
+    sent, output, elapsed, sender, receiver = transfer(
+        data, source=source, send=dict(digest='sha256'),
+        recv=dict(size=len(data), digest='sha256'))
+    assert sent is True
+    # the padding of the last block is left out
+    assert output == data
+    assert sender.stats.digest == receiver.stats.digest == \
+        hashlib.sha256(data).hexdigest()
+
+
+def test_delta_digest(tmpdir):
+    old = os.urandom(50 * 1024)
+    new = old[:20000] + os.urandom(10) + old[20010:]
+    path = tmpdir.join('image.bin')
+    path.write_binary(old)
+    with open(str(path), 'r+b') as output:
+        sent, output, elapsed, sender, receiver = transfer(
+            new, output=output, send=dict(delta=1, digest='sha256'),
+            recv=dict(delta=1, digest='sha256'))
+    assert sent is True
+    assert sender.stats.digest == receiver.stats.digest == \
+        hashlib.sha256(new).hexdigest()
+
+
+def record(writes):
+    def mangle(count, data):
+        writes.append(bytes(data))
+        return data
+    return mangle
+
+
+@pytest.mark.parametrize('crc_mode', [0, 1])
+def test_xmodem1k_tail(crc_mode):
+    writes = []
+    data = os.urandom(2 * 1024 + 300)
+    sent, output, elapsed, sender, receiver = transfer(
+        data, record(writes), mode='xmodem1k', recv=dict(crc_mode=crc_mode))
+    assert sent is True
+    assert output[:len(data)] == data
+    if crc_mode:
+        # 1024 byte blocks, the tail in 128 byte blocks and the EOT
+        assert [len(write) for write in writes] == \
+            [1029, 1029, 133, 133, 133, 1]
+        assert [write[:1] for write in writes[:3]] == [STX, STX, SOH]
+    else:
+        # 1k blocks are only sent in CRC mode
+        assert [len(write) for write in writes] == [132] * 19 + [1]
+    # at most 127 bytes of padding
+    assert len(output) == 2 * 1024 + 3 * 128
+
+
+def test_fixed_block_size():
+    writes = []
+
+    def corrupt(count, data):
+        writes.append(len(data))
+        if count in (2, 3, 4):
+            data = bytearray(data)
+            data[60] ^= 0x01
+        return data
+
+    data = os.urandom(4 * 1024)
+    sent, output, elapsed, sender, receiver = transfer(
+        data, corrupt, mode='xmodem1k', send=dict(adaptive=0))
+    assert sent is True
+    assert output == data
+    # a burst of NAKs does not change the block size
+    assert writes == [1029] * 7 + [1]
+
+
+def test_calc_crc(monkeypatch):
+    # the CRC-16/XMODEM check value
+    assert calc_crc(b'123456789') == 0x31c3
+    assert calc_crc(b'world', calc_crc(b'hello')) == calc_crc(b'helloworld')
+    # the fallback without binascii.crc_hqx, on odd and even lengths
+    monkeypatch.setattr(xmodem, '_crc16_tables',
+                        xmodem._make_crc16_tables(), raising=False)
+    for size in (0, 1, 127, 128, 1024):
+        data = os.urandom(size)
+        assert xmodem._calc_crc_table(data) == calc_crc(data)
+        assert xmodem._calc_crc_table(data, 0x1234) == calc_crc(data, 0x1234)
+
+
+def test_calc_checksum():
+    assert calc_checksum(b'hello') == 532 & 0xff
+    assert calc_checksum(b'world', calc_checksum(b'hello')) == 0x3c
+    assert calc_checksum(bytearray(b'\xff' * 128)) == 0x80
+
+
+def test_single_write_frames():
+    writes = []
+
+    def corrupt(count, data):
+        writes.append(bytes(data))
+        if count == 3:
+            data = bytearray(data)
+            data[60] ^= 0x01
+        return data
+
+    data = os.urandom(128 * 5)
+    sent, output, elapsed, sender, receiver = transfer(data, corrupt)
+    assert sent is True
+    assert output == data
+    # every frame is written at once, header, data and CRC
+    assert [len(write) for write in writes] == [133] * 6 + [1]
+    # and written again as it is after a NAK
+    assert writes[3] == writes[2]
+    assert writes[3][1:3] == b'\x03\xfc'
+
+
+def test_streaming():
+    writes = []
+    data = os.urandom(10000)
+    sent, output, elapsed, sender, receiver = transfer(
+        data, record(writes), mode='xmodem1k',
+        recv=dict(streaming=1, size=len(data)))
+    assert sent is True
+    assert output == data
+    assert sender.stats.streaming == receiver.stats.streaming == 1
+    # blocks go out back to back, only the EOT is acknowledged
+    assert len(writes) == 9 + 7 + 1
+    assert sender.stats.rtt == {}
+
+
+def test_streaming_error():
+    def corrupt(count, data):
+        if count == 3:
+            data = bytearray(data)
+            data[60] ^= 0x01
+        return data
+
+    sent, output, elapsed, sender, receiver = transfer(
+        os.urandom(5000), corrupt, timeout=2, recv=dict(streaming=1))
+    # streams can not recover, the receiver cancels the transfer
+    assert sent is False
+    assert receiver.result is None
+    assert sender.stats.cancels >= 1
+    assert elapsed < 2
+
+
+def batch(files, tmpdir, mangle=None, **kwargs):
+    a, b = queue.Queue(), queue.Queue()
+    sender = YMODEM(*transport(a, b, mangle))
+    receiver = YMODEM(*transport(b, a))
+    result = []
+    thread = threading.Thread(target=lambda: result.append(
+        receiver.recv(str(tmpdir), timeout=10, quiet=1, **kwargs)))
+    thread.start()
+    sent = sender.send(files, timeout=10, quiet=1)
+    thread.join()
+    return sent, result[0]
+
+
+class Unsized(io.BytesIO):
+    def seek(self, offset, whence=0):
+        raise IOError('not seekable')
+
+
+@pytest.mark.parametrize('streaming', [0, 1])
+def test_ymodem(tmpdir, streaming):
+    source = tmpdir.mkdir('source')
+    source.join('a.bin').write_binary(os.urandom(3000))
+    files = [str(source.join('a.bin')),
+             ('empty', io.BytesIO(b'')),
+             ('dir/b.txt', io.BytesIO(b'hello world\n'))]
+    output = tmpdir.mkdir('output')
+    sent, received = batch(files, output, streaming=streaming)
+    assert sent is True
+    assert received == [str(output.join(name))
+                        for name in ('a.bin', 'empty', 'b.txt')]
+    # the size in the header drops the padding of the last block
+    assert output.join('a.bin').read_binary() == \
+        source.join('a.bin').read_binary()
+    assert output.join('empty').read_binary() == b''
+    assert output.join('b.txt').read_binary() == b'hello world\n'
+
+
+def test_ymodem_unsized(tmpdir):
+    # without a size in the header the padding is kept
+    sent, received = batch([('pipe', Unsized(b'hello'))], tmpdir)
+    assert sent is True
+    assert tmpdir.join('pipe').read_binary() == \
+        b'hello' + b'\xff' * 123
+
+
+def test_ymodem_end_of_batch(tmpdir):
+    writes = []
+    sent, received = batch([], tmpdir, record(writes))
+    assert sent is True
+    assert received == []
+    # a header without a file name ends the batch
+    assert writes == [SOH + b'\x00\xff' + b'\x00' * 128 +
+                      b'\x00\x00']
+
+
+def test_checkpoint(tmpdir):
+    path = str(tmpdir.join('journal'))
+    checkpoint = Checkpoint(path, 'firmware.bin')
+    assert checkpoint.load() is None
+    checkpoint.save(1, 128)
+    checkpoint.save(2, 256)
+    # the record is overwritten in place
+    assert Checkpoint(path, 'firmware.bin').load() == (2, 256)
+    # a journal of another transfer is ignored
+    assert Checkpoint(path, 'other.bin').load() is None
+    checkpoint.clear()
+    assert not os.path.exists(path)
+
+    with open(path, 'w') as journal:
+        journal.write('firmware.bin\ndamaged\n')
+    assert Checkpoint(path, 'firmware.bin').load() is None
+
+
+def resumable(tmpdir, data, mangle=None, **kwargs):
+    '''
+    Transfer ``data`` between files with checkpoint journals on both sides,
+    with fixed timeouts and few retries so an interrupted attempt gives up
+    quickly.
+    '''
+    source = tmpdir.join('source.bin')
+    source.write_binary(data)
+    target = tmpdir.join('target.bin')
+    target.ensure()
+    with open(str(source), 'rb') as stream:
+        with open(str(target), 'r+b') as output:
+            sent, output, elapsed, sender, receiver = transfer(
+                data, mangle, timeout=0.5, source=lambda data: stream,
+                output=output, min_timeout=None,
+                send=dict(retry=4, checkpoint=str(tmpdir.join('sent'))),
+                recv=dict(retry=4, checkpoint=str(tmpdir.join('received')),
+                          **kwargs))
+    return sent, target.read_binary(), sender, receiver
+
+
+def cut(after):
+    # the line goes down after a number of writes of the sender
+    return lambda count, data: b'' if count > after else data
+
+
+def test_resume(tmpdir):
+    data = os.urandom(128 * 20 + 50)
+    sent, output, sender, receiver = resumable(tmpdir, data, cut(8))
+    assert sent is False
+    assert receiver.result is None
+    assert Checkpoint(str(tmpdir.join('sent')), tmpdir.join(
+        'source.bin')).load() == (8, 8 * 128)
+
+    sent, output, sender, receiver = resumable(tmpdir, data)
+    assert sent is True
+    assert output[:len(data)] == data
+    # the blocks that arrived before are not sent again
+    assert sender.stats.blocks == 21 - 8
+    # the bytes received by both attempts
+    assert receiver.result == 21 * 128
+    assert not tmpdir.join('sent').exists()
+    assert not tmpdir.join('received').exists()
+
+
+def test_resume_lost_ack(tmpdir):
+    data = os.urandom(128 * 10)
+    tmpdir.join('target.bin').write_binary(data[:5 * 128])
+    # the ACK of block 5 got lost, the receiver journal is one block ahead
+    Checkpoint(str(tmpdir.join('sent')),
+               tmpdir.join('source.bin')).save(4, 4 * 128)
+    Checkpoint(str(tmpdir.join('received')),
+               tmpdir.join('target.bin')).save(5, 5 * 128)
+    sent, output, sender, receiver = resumable(tmpdir, data)
+    assert sent is True
+    assert output == data
+    # block 5 is sent again and only acknowledged
+    assert receiver.stats.retransmits == 1
+    assert receiver.result == len(data)
+
+
+def test_resume_streaming(tmpdir):
+    data = os.urandom(128 * 40)
+    sent, output, sender, receiver = resumable(tmpdir, data, cut(20),
+                                               streaming=1)
+    assert sent is False
+    assert receiver.result is None
+    # neither side recorded any of the streamed blocks
+    assert not tmpdir.join('sent').exists()
+    assert not tmpdir.join('received').exists()
+
+    sent, output, sender, receiver = resumable(tmpdir, data, streaming=1)
+    assert sent is True
+    assert output == data
+    assert receiver.result == len(data)
+
+
+class CountingXMODEM(XMODEM):
+    calls = 0
+
+    def calc_crc(self, data, crc=0):
+        CountingXMODEM.calls += 1
+        return XMODEM.calc_crc(self, data, crc) ^ 0x5555
+
+
+def test_calc_crc_override():
+    a, b = queue.Queue(), queue.Queue()
+    sender = CountingXMODEM(*transport(a, b))
+    receiver = CountingXMODEM(*transport(b, a))
+    output = io.BytesIO()
+    data = os.urandom(1000)
+    thread = threading.Thread(target=receiver.recv, args=(output,),
+                              kwargs=dict(timeout=5))
+    thread.start()
+    # frames of a prepared image have the standard CRC, they are not used
+    assert sender.send(PreparedImage(data), timeout=5) is True
+    thread.join()
+    assert output.getvalue()[:len(data)] == data
+    # blocks are framed and checked with the CRC of the subclass
+    assert CountingXMODEM.calls == 2 * 8
+
+    # which a plain receiver refuses
+    a, b = queue.Queue(), queue.Queue()
+    sender = CountingXMODEM(*transport(a, b))
+    receiver = XMODEM(*transport(b, a))
+    thread = threading.Thread(target=receiver.recv, args=(io.BytesIO(),),
+                              kwargs=dict(timeout=1, retry=4))
+    thread.start()
+    assert sender.send(io.BytesIO(data), timeout=1, retry=4) is False
+    thread.join()
+
+
+class Line(object):
+    '''
+    One direction of a serial line at ``baud``, a write arrives once its
+    last byte has been clocked out.
+    '''
+
+    def __init__(self, baud, mangle=None):
+        self.baud = baud
+        self.mangle = mangle
+        self.writes = 0
+        self._lock = threading.Condition()
+        self._pending = []
+        self._buffer = bytearray()
+        self._idle = 0
+
+    def write(self, data, timeout=1):
+        self.writes += 1
+        if self.mangle is not None:
+            data = self.mangle(self.writes, data)
+        with self._lock:
+            # ten bits per byte, a start and a stop bit for eight data bits
+            self._idle = max(time.time(), self._idle) + \
+                len(data) * 10.0 / self.baud
+            self._pending.append((self._idle, bytes(data)))
+            self._lock.notify_all()
+        return len(data)
+
+    def read(self, size, timeout=1):
+        deadline = time.time() + timeout
+        with self._lock:
+            while True:
+                now = time.time()
+                while self._pending and self._pending[0][0] <= now:
+                    self._buffer.extend(self._pending.pop(0)[1])
+                if len(self._buffer) >= size or now >= deadline:
+                    break
+                wait = deadline - now
+                if self._pending:
+                    wait = min(wait, self._pending[0][0] - now)
+                self._lock.wait(wait)
+            if not self._buffer:
+                return None
+            data = bytes(self._buffer[:size])
+            del self._buffer[:size]
+            return data
+
+
+def test_slow_line(monkeypatch):
+    # a long run of 128 byte blocks before going back to 1024 byte blocks
+    monkeypatch.setattr(xmodem.Sender, 'clean_run', 40)
+    writes = []
+
+    def corrupt(count, data):
+        writes.append(len(data))
+        if count in (4, 5):
+            # the fourth block is refused twice, the sender falls back to
+            # 128 byte blocks
+            data = bytearray(data)
+            data[100] ^= 0x01
+        return data
+
+    # without the one second floor, the timeouts rely on the round-trip
+    # times measured for each block size
+    forward, reverse = Line(38400, corrupt), Line(38400)
+    sender = XMODEM(reverse.read, forward.write, 'xmodem1k', min_timeout=0.05)
+    receiver = XMODEM(forward.read, reverse.write, min_timeout=0.05)
+    data = os.urandom(12 * 1024)
+    output = io.BytesIO()
+    thread = threading.Thread(target=receiver.recv, args=(output,),
+                              kwargs=dict(timeout=10, quiet=1))
+    thread.start()
+    assert sender.send(io.BytesIO(data), timeout=10, quiet=1) is True
+    thread.join()
+    assert output.getvalue()[:len(data)] == data
+    # after the 128 byte blocks, the first 1024 byte block takes eight times
+    # as long, which is no reason to send it again
+    assert writes.index(133) < writes.index(1029, writes.index(133))
+    assert sender.stats.timeouts == 0
+    assert receiver.stats.timeouts == 0
+    assert sender.stats.retransmits == 2
+
+
+def noisy(seed, p, frames=1):
+    '''
+    Returns a mangle for a noisy line, where writes are lost with a chance
+    of ``p``. With ``frames`` enabled, as many are damaged and as many are
+    cut short.
+    '''
+    line = random.Random(seed)
+
+    def mangle(count, data):
+        chance = line.random()
+        if chance < p:
+            return b''
+        data = bytearray(data)
+        if frames and chance < 2 * p:
+            data[line.randrange(len(data))] ^= 1 << line.randrange(8)
+        elif frames and chance < 3 * p and len(data) > 1:
+            del data[line.randrange(1, len(data)):]
+        return data
+    return mangle
+
+
+@pytest.mark.parametrize('seed', [2, 10, 22])
+def test_noisy_line(seed):
+    data = random.Random(seed).getrandbits(8 * 16 * 1024)
+    data = bytes(bytearray((data >> (8 * i)) & 0xff
+                           for i in range(16 * 1024)))
+    frames, replies = noisy(seed, 0.05), noisy(seed + 1, 0.05, 0)
+    ended = []
+
+    def send(count, data):
+        if count == 1:
+            # a receiver asking again with C is a protocol error
+            return data
+        if data == EOT:
+            ended.append(count)
+        return frames(count, data)
+
+    def reply(count, data):
+        if ended:
+            # nobody answers an EOT after the receiver is done
+            return data
+        return replies(count, data)
+
+    # frames are damaged, lost and cut short, ACKs and NAKs are lost
+    sent, output, elapsed, sender, receiver = transfer(
+        data, send, timeout=5, reply=reply, mode='xmodem1k', min_timeout=0.1,
+        send=dict(retry=32), recv=dict(retry=32))
+    assert sent is True
+    # all of the data, once and in order
+    assert output[:len(data)] == data
+    assert len(output) - len(data) < 128
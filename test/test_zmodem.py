@@ -0,0 +1,159 @@
+import io
+import os
+import struct
+import threading
+
+import pytest
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+from xmodem.zmodem import ZMODEM, escape, ZRPOS, ZRINIT, ZDATA, ZCAN, \
+    ZCRCE, ZCRCG, ZCRCW, CANFDX, CANOVIO
+
+from helpers import transport
+
+
+def line():
+    '''
+    Returns a pair of modems talking to each other without any delay.
+    '''
+    a, b = queue.Queue(), queue.Queue()
+    return ZMODEM(*transport(a, b)), ZMODEM(*transport(b, a))
+
+
+def batch(files, directory, mangle=None, crc32=1, send=None, recv=None):
+    a, b = queue.Queue(), queue.Queue()
+    sender = ZMODEM(*transport(a, b, mangle))
+    receiver = ZMODEM(*transport(b, a))
+    if not crc32:
+        # a receiver that only does CRC-16
+        receiver._send_zrinit = lambda: receiver._send_hex_header(
+            ZRINIT, struct.pack('<HBB', 0, 0, CANFDX | CANOVIO))
+    result = []
+    thread = threading.Thread(target=lambda: result.append(
+        receiver.recv(str(directory), timeout=5, **(recv or {}))))
+    thread.start()
+    sent = sender.send(files, timeout=5, **(send or {}))
+    thread.join()
+    return sent, result[0], sender
+
+
+def test_escape():
+    assert escape(b'\x18hello') == b'\x18Xhello'
+    assert escape(b'\x10\x11\x13\x90\x91\x93') == \
+        b'\x18P\x18Q\x18S\x18\xd0\x18\xd1\x18\xd3'
+    # nothing to escape
+    data = bytes(bytearray(range(0x20, 0x80)))
+    assert escape(data) == data
+
+
+def test_hex_header():
+    sender, receiver = line()
+    written = []
+    sender.putc = lambda data, timeout=1: written.append(data)
+    sender._send_hex_header(ZRPOS, struct.pack('<I', 0x12345))
+    assert written[0].startswith(b'**\x18B0945230100')
+    assert written[0].endswith(b'\r\x8a\x11')
+    receiver.getc = lambda size, timeout=1: written.pop(0) \
+        if written else None
+    assert receiver._recv_header(1) == (ZRPOS, struct.pack('<I', 0x12345))
+
+
+@pytest.mark.parametrize('crc32', [0, 1])
+def test_bin_header(crc32):
+    sender, receiver = line()
+    sender._txcrc32 = crc32
+    # header data that has to be escaped
+    sender._send_bin_header(ZDATA, b'\x18\x11\x93\x00')
+    assert receiver._recv_header(1) == (ZDATA, b'\x18\x11\x93\x00')
+    assert receiver._rxcrc32 == crc32
+
+
+@pytest.mark.parametrize('crc32', [0, 1])
+def test_data_subpacket(crc32):
+    sender, receiver = line()
+    sender._txcrc32 = receiver._rxcrc32 = crc32
+    data = bytes(bytearray(range(256))) * 4
+    sender._send_data(data, ZCRCG)
+    sender._send_data(b'', ZCRCE)
+    assert receiver._recv_data(1) == (data, ZCRCG)
+    assert receiver._recv_data(1) == (b'', ZCRCE)
+
+
+@pytest.mark.parametrize('crc32', [0, 1])
+def test_damaged_subpacket(crc32):
+    sender, receiver = line()
+    sender._txcrc32 = receiver._rxcrc32 = crc32
+    written = []
+    sender.putc = lambda data, timeout=1: written.append(data)
+    sender._send_data(b'hello world', ZCRCW)
+    receiver.getc = lambda size, timeout=1: written.pop(0) \
+        if written else None
+    written[0] = written[0].replace(b'hello', b'jello')
+    assert receiver._recv_data(0.1) is None
+
+
+def test_cancel():
+    sender, receiver = line()
+    sender.abort()
+    assert receiver._recv_header(1)[0] == ZCAN
+
+
+@pytest.mark.parametrize('crc32', [0, 1])
+def test_transfer(tmpdir, crc32):
+    source = tmpdir.mkdir('source')
+    data = bytes(bytearray(range(256))) * 40 + os.urandom(5000)
+    source.join('a.bin').write_binary(data)
+    files = [str(source.join('a.bin')), ('dir/b.txt', io.BytesIO(b'hello')),
+             ('empty', io.BytesIO(b''))]
+    output = tmpdir.mkdir('output')
+    sent, received, sender = batch(files, output, crc32=crc32)
+    assert sent is True
+    assert received == [str(output.join(name))
+                        for name in ('a.bin', 'b.txt', 'empty')]
+    assert sender._txcrc32 == (0x20 if crc32 else 0)
+    assert output.join('a.bin').read_binary() == data
+    assert output.join('b.txt').read_binary() == b'hello'
+    assert output.join('empty').read_binary() == b''
+
+
+def test_damaged_transfer(tmpdir):
+    subpackets = []
+
+    def corrupt(count, data):
+        if len(data) > 1000:
+            subpackets.append(count)
+            if len(subpackets) == 3:
+                # a line hit in the middle of the third subpacket
+                data = bytearray(data)
+                data[500] ^= 0x01
+        return data
+
+    data = b'0123456789abcdef' * 1024
+    sent, received, sender = batch([('a.bin', io.BytesIO(data))], tmpdir,
+                                   corrupt)
+    assert sent is True
+    assert tmpdir.join('a.bin').read_binary() == data
+    # the receiver asked for the damaged subpacket again with a ZRPOS
+    assert len(subpackets) > 16
+
+
+@pytest.mark.parametrize('side', ['send', 'recv'])
+def test_resume(tmpdir, side):
+    data = os.urandom(10000)
+    tmpdir.join('a.bin').write_binary(data[:6000])
+    written = []
+
+    def count(number, chunk):
+        written.append(len(chunk))
+        return chunk
+
+    sent, received, sender = batch([('a.bin', io.BytesIO(data))], tmpdir,
+                                   count, **{side: dict(resume=1)})
+    assert sent is True
+    assert tmpdir.join('a.bin').read_binary() == data
+    # only the missing part was sent
+    assert sum(written) < 5000
@@ -6,10 +6,18 @@
 .. $Id$
 
 This is a literal implementation of XMODEM.TXT_, XMODEM1K.TXT_ and
-XMODMCRC.TXT_, support for YMODEM and ZMODEM is pending. YMODEM should
-be fairly easy to implement as it is a hack on top of the XMODEM
-protocol using sequence bytes ``0x00`` for sending file names (and some
-meta data).
+XMODMCRC.TXT_. YMODEM batch transfers are implemented as a hack on top of
+the XMODEM protocol using sequence bytes ``0x00`` for sending file names
+(and some meta data). ZMODEM is implemented in :mod:`xmodem.zmodem`.
+
+The protocol logic lives in the :class:`Sender` and :class:`Receiver` state
+machines, which do no I/O of their own: they are fed the bytes read from the
+line and return the bytes to write back, along with events for accepted and
+retransmitted blocks and the end of the transfer. :class:`XMODEM` drives them
+with blocking ``getc`` and ``putc`` callables, :mod:`xmodem.aio` with
+coroutines, and they can as well be driven from a ``select`` or ``epoll``
+loop serving many lines at once. :mod:`xmodem.transport` provides ``getc``
+and ``putc`` for serial ports and pseudo terminals.
 
 .. _XMODEM.TXT: doc/XMODEM.TXT
 .. _XMODEM1K.TXT: doc/XMODEM1K.TXT
@@ -80,6 +88,68 @@ Mixed 1024 and 128 byte Blocks
     EOT                                     -->
                                             <-- ACK
 
+XMODEM-G streaming, CRC mode
+----------------------------
+
+The receiver requests streaming with ``G`` instead of ``C``, blocks are not
+acknowledged and any error aborts the transfer.
+
+::
+
+    SENDER                                      RECEIVER
+
+                                            <-- G
+    STX 01 FE Data[1024] CRC CRC            -->
+    STX 02 FD Data[1024] CRC CRC            -->
+    SOH 03 FC Data[100] CPMEOF[28] CRC CRC  -->
+    EOT                                     -->
+                                            <-- ACK
+
+Compressed transfers, CRC mode
+------------------------------
+
+An extension for peers that both run this library: the receiver requests a
+zlib compressed stream with ``Z`` instead of ``C``. Plain XMODEM senders do
+not know ``Z`` and ignore it, the receiver then falls back to ``C`` and
+``NAK`` as usual. The blocks carry the compressed stream, which marks its own
+end, so the padding of the last block is dropped by the receiver.
+
+::
+
+    SENDER                                      RECEIVER
+
+                                            <-- Z
+    STX 01 FE Zlib[1024] CRC CRC            -->
+                                            <-- ACK
+    SOH 02 FD Zlib[100] CPMEOF[28] CRC CRC  -->
+                                            <-- ACK
+    EOT                                     -->
+                                            <-- ACK
+
+Delta transfers
+---------------
+
+Another extension for peers that both run this library, described in
+:mod:`xmodem.delta`. The sender requests the block signatures of the copy
+the receiver already has with ``D``, and the receiver sends them as a
+regular transfer. The receiver then requests the data as usual, and the
+sender sends the instructions to rebuild it out of the unchanged blocks.
+
+::
+
+    SENDER                                      RECEIVER
+
+    D                                       -->
+                                            <-- SOH 01 FE Sigs[128] CRC CRC
+    ACK                                     -->
+                                            <-- EOT
+    ACK                                     -->
+                                            <-- C
+    SOH 01 FE Delta[128] CRC CRC            -->
+                                            <-- ACK
+    EOT                                     -->
+                                            <-- ACK
+
 YMODEM Batch Transmission Session (1 file)
 ------------------------------------------
 
@@ -113,325 +183,2529 @@ __copyright__ = ['Copyright (c) 2010 Wijnand Modderman',
 __license__ = 'MIT'
 __version__ = '0.2.4'
 
+import bisect
+import hashlib
+import io
 import logging
+import mmap
+import os
+import struct
+import threading
 import time
-import sys
+import zlib
+from array import array
+from collections import namedtuple
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from xmodem.delta import DeltaEncoder, DeltaPatcher, Signatures
 
 # Loggerr
 log = logging.getLogger('xmodem')
 
 # Protocol bytes
-SOH = chr(0x01)
-STX = chr(0x02)
-EOT = chr(0x04)
-ACK = chr(0x06)
-NAK = chr(0x15)
-CAN = chr(0x18)
-CRC = chr(0x43)
+SOH = b'\x01'
+STX = b'\x02'
+EOT = b'\x04'
+ACK = b'\x06'
+NAK = b'\x15'
+CAN = b'\x18'
+CRC = b'\x43'
+D = b'\x44'
+G = b'\x47'
+Z = b'\x5a'
 
+# Protocol bytes as integers, as found when indexing a bytearray
+_SOH, _STX, _EOT, _ACK, _NAK, _CAN, _CRC, _D, _G, _Z = \
+    bytearray(SOH + STX + EOT + ACK + NAK + CAN + CRC + D + G + Z)
 
-class XMODEM(object):
+# Frame header and checksum fields
+_HEADER = struct.Struct('BBB')
+_SEQUENCE = struct.Struct('BB')
+_CRC16 = struct.Struct('>H')
+_CHECKSUM = struct.Struct('B')
+
+
+def calc_checksum(data, checksum=0):
     '''
-    XMODEM Protocol handler, expects an object to read from and an object to
-    write to.
+    Calculate the 8 bit arithmetic checksum for a given block of data.
+    '''
+    return (sum(bytearray(data)) + checksum) & 0xff
 
-    >>> def getc(size, timeout=1):
-    ...     return data or None
-    ...
-    >>> def putc(data, timeout=1):
-    ...     return size or None
-    ...
-    >>> modem = XMODEM(getc, putc)
 
+def _make_crc16_tables():
     '''
+    Build the CRC-CCITT lookup tables for single bytes and for 16 bit words,
+    the latter allows the fallback CRC to process two bytes per lookup.
+    '''
+    table = [0] * 0x100
+    for index in range(0x100):
+        crc = index << 8
+        for bit in range(8):
+            crc = ((crc << 1) ^ 0x1021) if crc & 0x8000 else (crc << 1)
+        table[index] = crc & 0xffff
 
-    # crctab calculated by Mark G. Mendel, Network Systems Corporation
-    crctable = [
-        0x0000, 0x1021, 0x2042, 0x3063, 0x4084, 0x50a5, 0x60c6, 0x70e7,
-        0x8108, 0x9129, 0xa14a, 0xb16b, 0xc18c, 0xd1ad, 0xe1ce, 0xf1ef,
-        0x1231, 0x0210, 0x3273, 0x2252, 0x52b5, 0x4294, 0x72f7, 0x62d6,
-        0x9339, 0x8318, 0xb37b, 0xa35a, 0xd3bd, 0xc39c, 0xf3ff, 0xe3de,
-        0x2462, 0x3443, 0x0420, 0x1401, 0x64e6, 0x74c7, 0x44a4, 0x5485,
-        0xa56a, 0xb54b, 0x8528, 0x9509, 0xe5ee, 0xf5cf, 0xc5ac, 0xd58d,
-        0x3653, 0x2672, 0x1611, 0x0630, 0x76d7, 0x66f6, 0x5695, 0x46b4,
-        0xb75b, 0xa77a, 0x9719, 0x8738, 0xf7df, 0xe7fe, 0xd79d, 0xc7bc,
-        0x48c4, 0x58e5, 0x6886, 0x78a7, 0x0840, 0x1861, 0x2802, 0x3823,
-        0xc9cc, 0xd9ed, 0xe98e, 0xf9af, 0x8948, 0x9969, 0xa90a, 0xb92b,
-        0x5af5, 0x4ad4, 0x7ab7, 0x6a96, 0x1a71, 0x0a50, 0x3a33, 0x2a12,
-        0xdbfd, 0xcbdc, 0xfbbf, 0xeb9e, 0x9b79, 0x8b58, 0xbb3b, 0xab1a,
-        0x6ca6, 0x7c87, 0x4ce4, 0x5cc5, 0x2c22, 0x3c03, 0x0c60, 0x1c41,
-        0xedae, 0xfd8f, 0xcdec, 0xddcd, 0xad2a, 0xbd0b, 0x8d68, 0x9d49,
-        0x7e97, 0x6eb6, 0x5ed5, 0x4ef4, 0x3e13, 0x2e32, 0x1e51, 0x0e70,
-        0xff9f, 0xefbe, 0xdfdd, 0xcffc, 0xbf1b, 0xaf3a, 0x9f59, 0x8f78,
-        0x9188, 0x81a9, 0xb1ca, 0xa1eb, 0xd10c, 0xc12d, 0xf14e, 0xe16f,
-        0x1080, 0x00a1, 0x30c2, 0x20e3, 0x5004, 0x4025, 0x7046, 0x6067,
-        0x83b9, 0x9398, 0xa3fb, 0xb3da, 0xc33d, 0xd31c, 0xe37f, 0xf35e,
-        0x02b1, 0x1290, 0x22f3, 0x32d2, 0x4235, 0x5214, 0x6277, 0x7256,
-        0xb5ea, 0xa5cb, 0x95a8, 0x8589, 0xf56e, 0xe54f, 0xd52c, 0xc50d,
-        0x34e2, 0x24c3, 0x14a0, 0x0481, 0x7466, 0x6447, 0x5424, 0x4405,
-        0xa7db, 0xb7fa, 0x8799, 0x97b8, 0xe75f, 0xf77e, 0xc71d, 0xd73c,
-        0x26d3, 0x36f2, 0x0691, 0x16b0, 0x6657, 0x7676, 0x4615, 0x5634,
-        0xd94c, 0xc96d, 0xf90e, 0xe92f, 0x99c8, 0x89e9, 0xb98a, 0xa9ab,
-        0x5844, 0x4865, 0x7806, 0x6827, 0x18c0, 0x08e1, 0x3882, 0x28a3,
-        0xcb7d, 0xdb5c, 0xeb3f, 0xfb1e, 0x8bf9, 0x9bd8, 0xabbb, 0xbb9a,
-        0x4a75, 0x5a54, 0x6a37, 0x7a16, 0x0af1, 0x1ad0, 0x2ab3, 0x3a92,
-        0xfd2e, 0xed0f, 0xdd6c, 0xcd4d, 0xbdaa, 0xad8b, 0x9de8, 0x8dc9,
-        0x7c26, 0x6c07, 0x5c64, 0x4c45, 0x3ca2, 0x2c83, 0x1ce0, 0x0cc1,
-        0xef1f, 0xff3e, 0xcf5d, 0xdf7c, 0xaf9b, 0xbfba, 0x8fd9, 0x9ff8,
-        0x6e17, 0x7e36, 0x4e55, 0x5e74, 0x2e93, 0x3eb2, 0x0ed1, 0x1ef0,
+    wide = [
+        ((table[high] << 8) & 0xffff) ^ table[(table[high] >> 8) ^ low]
+        for high in range(0x100)
+        for low in range(0x100)
     ]
+    return table, wide
 
-    def __init__(self, getc, putc):
-        self.getc = getc
-        self.putc = putc
 
-    def abort(self, count=2, timeout=60):
+def _calc_crc_table(data, crc=0):
+    '''
+    Calculate the CRC-CCITT using a 16 bit word lookup table.
+    '''
+    table, wide = _crc16_tables
+    data = bytearray(data)
+    crc &= 0xffff
+    size = len(data) & ~1
+    for offset in range(0, size, 2):
+        crc = wide[crc ^ ((data[offset] << 8) | data[offset + 1])]
+    if size < len(data):
+        crc = ((crc << 8) & 0xffff) ^ table[(crc >> 8) ^ data[size]]
+    return crc
+
+
+# Pick the fastest available CRC-CCITT backend once, binascii.crc_hqx
+# implements the XMODEM CRC in C
+try:
+    from binascii import crc_hqx as _crc_hqx
+except ImportError:
+    _crc_hqx = None
+
+if _crc_hqx is None:
+    _crc16_tables = _make_crc16_tables()
+    calc_crc = _calc_crc_table
+else:
+    def calc_crc(data, crc=0):
         '''
-        Send an abort sequence using CAN bytes.
+        Calculate the CRC-CCITT for a given block of data.
         '''
-        for counter in xrange(0, count):
-            self.putc(CAN, timeout)
+        return _crc_hqx(data, crc)
 
-    def send(self, stream, retry=16, timeout=60, quiet=0):
-        '''
-        Send a stream via the XMODEM protocol.
 
-            >>> stream = file('/etc/issue', 'rb')
-            >>> print modem.send(stream)
-            True
+def _stream_size(stream):
+    '''
+    Determine the number of bytes left to read from a stream, returns ``None``
+    if the stream is not seekable.
+    '''
+    if isinstance(stream, PreparedImage):
+        stream = stream.data
+    view = _buffer_view(stream)
+    if view is not None and not hasattr(stream, 'tell'):
+        return view.nbytes
+    try:
+        offset = stream.tell()
+        stream.seek(0, os.SEEK_END)
+        size = stream.tell()
+        stream.seek(offset)
+    except (AttributeError, IOError, OSError):
+        return None
+    return size - offset
 
-        Returns ``True`` upon succesful transmission or ``False`` in case of
-        failure.
+
+def _joined(output):
+    '''
+    Returns the pieces of ``output`` as a single string, a single frame is
+    returned as it is, without copying it.
+    '''
+    if len(output) == 1:
+        return output[0]
+    return b''.join(piece.tobytes() if isinstance(piece, memoryview)
+                    else bytes(piece) for piece in output)
+
+
+def _buffer_view(stream):
+    '''
+    Returns a ``memoryview`` on a stream that is a buffer, such as ``bytes``,
+    a ``bytearray`` or an ``mmap``, or ``None`` for file like objects. Blocks
+    are then sliced from, or copied into, the buffer in place.
+    '''
+    if hasattr(stream, 'read') and not isinstance(stream, mmap.mmap):
+        return None
+    try:
+        return memoryview(stream)
+    except TypeError:
+        # mmap objects do not export their buffer in Python 2
+        return None
+
+
+class CRC32(object):
+    '''
+    Running CRC-32 of some data, with the interface of the :mod:`hashlib`
+    objects, for checking transfers against manifests listing a CRC-32.
+
+    >>> crc = CRC32()
+    >>> crc.update(b'hello world')
+    >>> crc.hexdigest()
+    '0d4a1185'
+
+    '''
+
+    name = 'crc32'
+    digest_size = 4
+
+    def __init__(self, data=b''):
+        self.crc = zlib.crc32(data) & 0xffffffff
+
+    def update(self, data):
+        self.crc = zlib.crc32(data, self.crc) & 0xffffffff
+
+    def digest(self):
+        return struct.pack('>I', self.crc)
+
+    def hexdigest(self):
+        return '%08x' % (self.crc,)
+
+
+def _new_digest(digest):
+    '''
+    Returns a running digest for ``digest``, the name of a :mod:`hashlib`
+    algorithm or ``crc32``, or the object itself if it is one already.
+    '''
+    if digest is None or hasattr(digest, 'update'):
+        return digest
+    elif digest == 'crc32':
+        return CRC32()
+    return hashlib.new(digest)
+
+
+def _update_digest(digest, data):
+    try:
+        digest.update(data)
+    except TypeError:
+        # memoryviews are not taken in Python 2
+        digest.update(data.tobytes())
+
+
+# Events emitted by the protocol state machines
+BlockAccepted = namedtuple('BlockAccepted', 'sequence offset data')
+Retransmit = namedtuple('Retransmit', 'sequence reason')
+Done = namedtuple('Done', 'result')
+Aborted = namedtuple('Aborted', 'reason')
+
+
+class TransferStats(object):
+    '''
+    Metrics of a single transfer, kept up to date by the protocol state
+    machines and exposed as the ``stats`` attribute of the modem.
+
+    >>> modem.send(stream)
+    True
+    >>> modem.stats.naks, modem.stats.bytes_per_second
+    (2, 1412.5)
+
+    The ``rtt`` histogram counts the time between sending a block and
+    receiving its ``ACK``, keyed by the upper bound of each bucket in
+    milliseconds. For compressed transfers ``bytes`` counts the compressed
+    data on the line and ``uncompressed`` the data it was made from. The
+    ``block_size`` is the largest block size used, a 1024 byte transfer with
+    a short tail sent in 128 byte blocks counts as 1024. The ``digest`` of
+    the data is set at the end of a transfer, when asked for.
+    '''
+
+    def __init__(self):
+        self.bytes = 0
+        self.blocks = 0
+        self.naks = 0
+        self.timeouts = 0
+        self.retransmits = 0
+        self.cancels = 0
+        self.crc_mode = None
+        self.streaming = None
+        self.compressed = None
+        self.uncompressed = 0
+        self.digest = None
+        self.block_size = None
+        self.rtt = {}
+        self.started = None
+        self.finished = None
+
+    def __repr__(self):
+        return '<TransferStats %d bytes, %d blocks, %d NAKs, ' \
+            '%d timeouts, %.1f bytes/s>' % (self.bytes, self.blocks,
+            self.naks, self.timeouts, self.bytes_per_second)
+
+    @property
+    def elapsed(self):
         '''
+        Number of seconds the transfer took, or is taking so far.
+        '''
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.time()) - self.started
 
-        # initialize protocol
-        error_count = 0
-        crc_mode = 0
-        cancel = 0
-        while True:
-            char = self.getc(1)
-            if char:
-                if char == NAK:
-                    crc_mode = 0
-                    break
-                elif char == CRC:
-                    crc_mode = 1
-                    break
-                elif char == CAN:
-                    if not quiet:
-                        print >> sys.stderr, 'received CAN'
-                    if cancel:
-                        return False
-                    else:
-                        cancel = 1
-                else:
-                    log.error('send ERROR expected NAK/CRC, got %s' % \
-                        (ord(char),))
+    @property
+    def bytes_per_second(self):
+        '''
+        Effective throughput of the transfer.
+        '''
+        elapsed = self.elapsed
+        if not elapsed:
+            return 0.0
+        return self.bytes / elapsed
 
-            error_count += 1
-            if error_count >= retry:
-                self.abort(timeout=timeout)
-                return False
+    def add_rtt(self, seconds):
+        '''
+        Record a block round-trip time in the ``rtt`` histogram.
+        '''
+        bucket = 1
+        while bucket < seconds * 1000:
+            bucket <<= 1
+        self.rtt[bucket] = self.rtt.get(bucket, 0) + 1
 
-        # send data
-        error_count = 0
-        packet_size = 128
-        sequence = 1
-        while True:
-            data = stream.read(packet_size)
-            if not data:
-                log.info('sending EOS')
-                # end of stream
-                break
+    def as_dict(self):
+        '''
+        Returns the metrics as a dictionary, for logging or serialisation.
+        '''
+        return {
+            'bytes': self.bytes,
+            'blocks': self.blocks,
+            'naks': self.naks,
+            'timeouts': self.timeouts,
+            'retransmits': self.retransmits,
+            'cancels': self.cancels,
+            'crc_mode': self.crc_mode,
+            'streaming': self.streaming,
+            'compressed': self.compressed,
+            'uncompressed': self.uncompressed,
+            'digest': self.digest,
+            'block_size': self.block_size,
+            'rtt': dict(self.rtt),
+            'elapsed': self.elapsed,
+            'bytes_per_second': self.bytes_per_second,
+        }
 
-            data = data.ljust(packet_size, '\xff')
-            if crc_mode:
-                crc = self.calc_crc(data)
-            else:
-                crc = self.calc_checksum(data)
 
-            # emit packet
-            while True:
-                self.putc(SOH)
-                self.putc(chr(sequence))
-                self.putc(chr(0xff - sequence))
-                self.putc(data)
-                if crc_mode:
-                    self.putc(chr(crc >> 8))
-                    self.putc(chr(crc & 0xff))
-                else:
-                    self.putc(chr(crc))
+class RetransmitTimer(object):
+    '''
+    Derive a timeout from measured round-trip times, like the TCP
+    retransmission timer of RFC 6298. The timeout is the smoothed round-trip
+    time plus four times its variation, but at least half the round-trip
+    time more, so a steady line still leaves a margin. It is kept between
+    ``floor`` and ``ceiling`` seconds, and doubles every time it expires.
 
-                char = self.getc(1, timeout)
-                if char == ACK:
-                    break
-                if char == NAK:
-                    error_count += 1
-                    if error_count >= retry:
-                        # excessive amounts of retransmissions requested,
-                        # abort transfer
-                        self.abort(timeout=timeout)
-                        log.warning('excessive NAKs, transfer aborted')
-                        return False
-
-                    # return to loop and resend
-                    continue
+    >>> timer = RetransmitTimer(60, floor=0.5)
+    >>> timer.sample(0.2)
+    >>> timer.timeout
+    0.6000000000000001
 
-                # protocol error
-                self.abort(timeout=timeout)
-                log.error('protocol error')
-                return False
+    '''
 
-            # keep track of sequence
-            sequence = (sequence + 1) % 0x100
+    def __init__(self, initial, floor=1, ceiling=60):
+        self.floor = floor
+        self.ceiling = ceiling
+        self.srtt = None
+        self.rttvar = None
+        self.timeout = max(floor, min(ceiling, initial))
 
-        # end of transmission
-        self.putc(EOT)
-        return True
+    def sample(self, rtt):
+        '''
+        Update the timeout with a measured round-trip time.
+        '''
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2.0
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self._update()
 
-    def recv(self, stream, crc_mode=1, retry=16, timeout=60, delay=1, quiet=0):
+    def scale(self, timer, factor):
         '''
-        Receive a stream via the XMODEM protocol.
+        Start out from the round-trip times measured by another ``timer``,
+        for frames that take ``factor`` times as long on the line.
+        '''
+        self.srtt = timer.srtt * factor
+        self.rttvar = timer.rttvar * factor
+        self._update()
 
-            >>> stream = file('/etc/issue', 'wb')
-            >>> print modem.recv(stream)
-            2342
+    def backoff(self):
+        '''
+        Double the timeout after it expired.
+        '''
+        self.timeout = min(self.ceiling, self.timeout * 2)
 
-        Returns the number of bytes received on success or ``None`` in case of
-        failure.
+    def _update(self):
+        margin = max(4 * self.rttvar, self.srtt / 2.0)
+        self.timeout = max(self.floor, min(self.ceiling, self.srtt + margin))
+
+
+class _Session(object):
+    '''
+    Bookkeeping of a driver running a state machine: acts upon its events and
+    times the waits for the other side.
+    '''
+
+    def __init__(self, modem, machine, timeout, stream=None,
+                 checkpoint=None):
+        self.modem = modem
+        self.machine = machine
+        self.stream = stream
+        self.checkpoint = checkpoint
+        self.stats = machine.stats
+        self.result = None
+        if self.stats.started is None:
+            self.stats.started = time.time()
+
+        cls = type(modem)
+        if (cls.calc_crc != XMODEM.calc_crc or
+                cls.calc_checksum != XMODEM.calc_checksum):
+            # blocks are framed with the checksums of the subclass, which
+            # the frames of a prepared image do not have
+            machine.calc_crc = modem.calc_crc
+            machine.calc_checksum = modem.calc_checksum
+            if isinstance(machine, Sender):
+                machine.image = None
+
+        if modem.min_timeout is None:
+            # fixed timeouts
+            floor = ceiling = timeout
+        else:
+            ceiling = modem.max_timeout or timeout
+            floor = min(modem.min_timeout, ceiling)
+        self._limits = timeout, floor, ceiling
+        # timers for the replies to our writes and for the data of frames
+        # already started, by the size of the blocks exchanged
+        self._timers = {}
+        self._written = None
+        self._retransmitted = 0
+        self._reading = None
+        # received data is copied straight into mmaps and other buffers
+        self._view = None
+        if isinstance(machine, Receiver) and stream is not None:
+            self._view = _buffer_view(stream)
+            self._position = machine.offset
+            if self._view is not None and hasattr(stream, 'tell'):
+                self._position = stream.tell()
+
+    def wait(self):
+        '''
+        Returns the number of seconds to wait for the other side.
         '''
+        machine = self.machine
+        if machine.state == 'frame':
+            timer = self._timer('frame')
+        else:
+            timer = self._timer('reply')
+        self._reading = timer, time.time()
+        if (machine.state == 'start' and isinstance(machine, Receiver) and
+                machine.compress):
+            # plain senders never answer a request for compression, do not
+            # wait long before asking for a CRC transfer instead
+            return min(timer.timeout, self._limits[1])
+        return timer.timeout
 
-        # initiate protocol
-        error_count = 0
-        char = 0
-        cancel = 0
-        while True:
-            # first try CRC mode, if this fails,
-            # fall back to checksum mode
-            if error_count >= retry:
-                self.abort(timeout=timeout)
-                return None
-            elif crc_mode and error_count < (retry / 2):
-                if not self.putc(CRC):
-                    time.sleep(delay)
-                    error_count += 1
-            else:
-                crc_mode = 0
-                if not self.putc(NAK):
-                    time.sleep(delay)
-                    error_count += 1
-
-            char = self.getc(1, timeout)
-            if not char:
-                error_count += 1
-                continue
-            elif char == SOH:
-                #crc_mode = 0
-                break
-            elif char in [STX, CAN]:
-                break
-            elif char == CAN:
-                if cancel:
-                    return None
-                else:
-                    cancel = 1
-            else:
-                error_count += 1
+    def wrote(self):
+        self._written = time.time(), self._timer('reply')
 
-        # read data
-        error_count = 0
-        income_size = 0
-        packet_size = 128
-        sequence = 1
-        cancel = 0
-        while True:
-            while True:
-                if char == SOH:
-                    packet_size = 128
-                    break
-                elif char == STX:
-                    packet_size = 1024
-                    break
-                elif char == EOT:
-                    return income_size
-                elif char == CAN:
-                    # cancel at two consecutive cancels
-                    if cancel:
-                        return None
-                    else:
-                        cancel = 1
-                else:
-                    if not quiet:
-                        print >> sys.stderr, \
-                            'recv ERROR expected SOH/EOT, got', ord(char)
-                    error_count += 1
-                    if error_count >= retry:
-                        self.abort()
-                        return None
-
-            # read sequence
-            error_count = 0
-            cancel = 0
-            seq1 = ord(self.getc(1))
-            seq2 = 0xff - ord(self.getc(1))
-            if seq1 == sequence and seq2 == sequence:
-                # sequence is ok, read packet
-                # packet_size + checksum
-                data = self.getc(packet_size + 1 + crc_mode)
-                if crc_mode:
-                    csum = (ord(data[-2]) << 8) + ord(data[-1])
-                    data = data[:-2]
-                    log.debug('CRC (%04x <> %04x)' % \
-                        (csum, self.calc_crc(data)))
-                    valid = csum == self.calc_crc(data)
-                else:
-                    csum = data[-1]
-                    data = data[:-1]
-                    log.debug('checksum (checksum(%02x <> %02x)' % \
-                        (ord(csum), self.calc_checksum(data)))
-                    valid = ord(csum) == self.calc_checksum(data)
-
-                # valid data, append chunk
-                if valid:
-                    income_size += len(data)
-                    stream.write(data)
-                    self.putc(ACK)
-                    sequence = (sequence + 1) % 0x100
-                    char = self.getc(1, timeout)
-                    continue
-            else:
-                # consume data
-                self.getc(packet_size + 1 + crc_mode)
-                self.debug('expecting sequence %d, got %d/%d' % \
-                    (sequence, seq1, seq2))
+    def timed_out(self):
+        timer, started = self._reading
+        if self.machine.state != 'drain':
+            timer.backoff()
+            self._retransmitted = 1
+        return self.machine.timeout()
 
-            # something went wrong, request retransmission
-            self.putc(NAK)
+    def read(self, data):
+        '''
+        Feed data read from the line to the machine.
+        '''
+        timer, started = self._reading
+        if self.machine.state == 'frame' and len(data) == self.machine.expect:
+            # the rest of a frame arrived in one go
+            timer.sample(time.time() - started)
+        return self.machine.feed(data)
 
-    def calc_checksum(self, data, checksum=0):
+    def _timer(self, kind, size=None):
         '''
-        Calculate the checksum for a given block of data, can also be used to
-        update a checksum.
+        Returns the timer of the ``reply`` or ``frame`` waits for blocks of
+        ``size``, by default the current size. Round-trip times grow with the
+        time a frame takes on the line, so a timer for larger blocks starts
+        out from those of smaller blocks scaled up by their size, never the
+        other way around.
+        '''
+        machine = self.machine
+        if size is None:
+            size = machine.packet_size
+            if kind == 'reply' and isinstance(machine, Receiver):
+                # the next frame may be as large as any frame before
+                size = max(size, machine.stats.block_size or 0)
+        timer = self._timers.get((kind, size))
+        if timer is None:
+            timer = self._timers[kind, size] = RetransmitTimer(*self._limits)
+            known = [(other, measured)
+                     for (name, other), measured in self._timers.items()
+                     if name == kind and other and measured.srtt is not None]
+            if size and known:
+                other, measured = max(known, key=lambda item: item[0])
+                timer.scale(measured, max(1.0, float(size) / other))
+        return timer
 
-            >>> csum = modem.calc_checksum('hello')
-            >>> csum = modem.calc_checksum('world', csum)
-            >>> hex(csum)
-            '0x3c'
+    def handle(self, events):
+        '''
+        Act upon the events of the state machine, accepted blocks are written
+        to the stream and recorded in the checkpoint journal before they are
+        acknowledged.
+        '''
+        modem = self.modem
+        stats = self.stats
+        for event in events:
+            if isinstance(event, BlockAccepted):
+                if self._written is not None and not self._retransmitted:
+                    written, timer = self._written
+                    rtt = time.time() - written
+                    if event.data is not None:
+                        # the reply was a frame of this size
+                        timer = self._timer('reply', self.machine.packet_size)
+                    timer.sample(rtt)
+                    if event.data is None:
+                        # acknowledged by the receiver
+                        stats.add_rtt(rtt)
+                self._written = None
+                self._retransmitted = 0
+                if self.stream is not None:
+                    self._store(event.data)
+                if self.checkpoint is not None and not self.machine.streaming:
+                    # streamed blocks are never acknowledged, the sender has
+                    # no record of them
+                    self.checkpoint.save(event.sequence, event.offset)
+                if modem.progress_callback is not None:
+                    modem.progress_callback(stats)
+            elif isinstance(event, Retransmit):
+                self._retransmitted = 1
+            elif isinstance(event, Done):
+                if isinstance(self.stream, WriteBehind):
+                    # all data is written before the EOT is acknowledged
+                    self.stream.finish()
+                self.result = event.result
+            if modem.event_callback is not None:
+                modem.event_callback(event, stats)
+
+    def finish(self):
+        self.stats.finished = time.time()
+        if self._view is not None:
+            # let go of the buffer, an mmap can not be closed while viewed
+            self._view = None
+            if hasattr(self.stream, 'seek'):
+                self.stream.seek(min(self._position, len(self.stream)))
+        return self.result
+
+    def _store(self, data):
+        if self._view is None:
+            try:
+                self.stream.write(data)
+            except TypeError:
+                # mmap objects in Python 2 only take strings
+                self.stream.write(data.tobytes())
+            return
 
+        # copy into the buffer in place, dropping what does not fit, which
+        # usually is the padding of the last block
+        start = self._position
+        data = data[:max(0, len(self._view) - start)]
+        self._view[start:start + len(data)] = data
+        self._position = start + len(data)
+
+
+class _Machine(object):
+    '''
+    Bookkeeping shared by the :class:`Sender` and :class:`Receiver` state
+    machines. Blocks are checked with ``calc_crc`` and ``calc_checksum``,
+    which may be replaced on an instance.
+    '''
+
+    calc_crc = staticmethod(calc_crc)
+    calc_checksum = staticmethod(calc_checksum)
+
+    @property
+    def finished(self):
         '''
-        return (sum(map(ord, data)) + checksum) % 256
+        Whether the transfer is done or aborted.
+        '''
+        return self.state in ('done', 'aborted')
 
-    def calc_crc(self, data, crc=0):
+    def close(self):
+        '''
+        Release what the machine holds on to, when the transfer is given up
+        before it finished, like when writing to the line failed.
         '''
-        Calculate the Cyclic Redundancy Check for a given block of data, can
-        also be used to update a CRC.
 
-            >>> crc = modem.calc_crc('hello')
-            >>> crc = modem.calc_crc('world', crc)
-            >>> hex(crc)
-            '0xd5e3'
+    def _error(self, reason, output, events):
+        self.error_count += 1
+        if self.error_count >= self.retry:
+            self._abort(reason, output, events)
+
+    def _abort(self, reason, output, events):
+        output.append(CAN * 2)
+        self._finish(Aborted(reason), events)
+
+    def _finish(self, event, events):
+        if isinstance(event, Aborted):
+            log.warning(event.reason)
+            self.state = 'aborted'
+        else:
+            self.state = 'done'
+            if self.digest is not None:
+                self.stats.digest = self.digest.hexdigest()
+        events.append(event)
+
+
+class Sender(_Machine):
+    '''
+    Protocol state machine for the sending side of a transfer, without any
+    I/O of its own. Bytes received from the line are passed to :meth:`feed`
+    and expired timeouts are reported with :meth:`timeout`, both return a
+    tuple of the bytes to write to the line and a list of events. The
+    ``expect`` attribute tells how many bytes the machine is waiting for.
+
+    >>> machine = Sender(open('/etc/issue', 'rb'))
+    >>> machine.feed(CRC)
+    (bytearray(b'\\x01\\x01\\xfe...'), [])
+    >>> machine.feed(ACK)
+    (b'\\x04', [BlockAccepted(sequence=1, offset=128, data=None)])
+    >>> machine.feed(ACK)
+    (b'', [Done(result=True)])
+
+    A ``header`` is sent as block ``0`` before the stream, like YMODEM does
+    with the file name and size. Without a ``stream`` the transfer ends
+    after the header has been acknowledged. The ``sequence`` and ``offset``
+    of the first block are given when resuming a transfer. Metrics are
+    collected in ``stats``, a :class:`TransferStats`.
+
+    In ``xmodem1k`` mode the block size adapts to the line. After a burst of
+    ``nak_burst`` NAKs without a clean ``ACK`` in between, the data is sent
+    in 128 byte blocks, starting after the block that was refused, which is
+    sent again as it is. After a run of ``clean_run`` blocks acknowledged at
+    the first attempt, 1024 byte blocks are sent again. Set ``adaptive`` to
+    ``0`` to always send 1024 byte blocks.
+
+    A block sent again after a timeout may cross the ``ACK`` of the block
+    sent before, the receiver then acknowledges every copy. Before the next
+    block is sent, the sender waits for the ``ACK`` of every copy sent after
+    a timeout and drops them, in the ``drain`` state.
 
+    With ``prefetch`` set, a background thread reads and frames up to that
+    many blocks ahead while the line waits for an ``ACK``, so the next frame
+    is ready as soon as the ``ACK`` arrives. This pays off for slow streams,
+    like files on a network share or decompressing streams.
+
+    The ``stream`` may be a :class:`PreparedImage`, the frames it holds are
+    then sent as they are, instead of framing every block again.
+
+    With ``compress`` enabled, a receiver asking for a compressed stream
+    with ``Z`` gets the stream compressed with zlib at ``level``. With
+    ``flush`` set, the compressor is flushed after every that many bytes of
+    the stream, so the receiver can write out all data sent up to that
+    point. Other receivers get the stream as it is.
+
+    With ``delta`` enabled, the stream holds the block signatures of a delta
+    transfer and is only sent when requested with ``D``, see
+    :mod:`xmodem.delta`.
+
+    With ``digest`` set, to the name of a :mod:`hashlib` algorithm, to
+    ``crc32`` or to a running digest object, the data is added to the
+    digest as it is sent, without the padding of the last block, and the
+    ``digest`` of the stats is set to the hex digest at the end.
+    '''
+
+    # NAKs before falling back to 128 byte blocks
+    nak_burst = 2
+    # clean ACKs before going back to 1024 byte blocks
+    clean_run = 16
+
+    def __init__(self, stream, mode='xmodem', retry=16, header=None,
+                 sequence=1, offset=0, stats=None, adaptive=1, prefetch=0,
+                 compress=0, level=6, flush=None, delta=0, digest=None):
+        if mode not in XMODEM.packet_sizes:
+            raise ValueError('unknown mode %r' % (mode,))
+        self.image = None
+        if isinstance(stream, PreparedImage):
+            self.image = stream
+            stream = stream.data
+        self.stream = stream
+        self.mode = mode
+        self.retry = retry
+        self.header = header
+        self.sequence = sequence
+        self.offset = offset
+        self.crc_mode = 0
+        self.streaming = 0
+        self.state = 'start'
+        self.error_count = 0
+        self.adaptive = adaptive
+        self.prefetch = prefetch
+        self.compress = compress
+        self.level = level
+        self.flush = flush
+        self.compressed = 0
+        self.delta = delta
+        self.digest = _new_digest(digest)
+        self.packet_size = None
+        self._cancel = 0
+        self._prefetcher = None
+        self._frames = {}
+        self._packet = None
+        self._data = b''
+        self._read = 0
+        self._pending = b''
+        # buffers are sent from slices of a view, without copying
+        self._view = _buffer_view(stream)
+        self._position = offset
+        if self._view is not None and hasattr(stream, 'tell'):
+            self._position = stream.tell()
+        self._nak = 0
+        self._naks = 0
+        self._clean = 0
+        self._timed_out = 0
+        self.stats = stats if stats is not None else TransferStats()
+
+    @property
+    def expect(self):
         '''
-        for char in data:
-            crc = (crc << 8) ^ self.crctable[((crc >> 8) ^ ord(char)) & 0xff]
-        return crc & 0xffff
+        Number of bytes to read before calling :meth:`feed`, ``0`` if blocks
+        are streamed and the line only has to be polled, or ``None`` if the
+        transfer has finished.
+        '''
+        if self.finished:
+            return None
+        elif self.state == 'block' and self.streaming:
+            return 0
+        return 1
+
+    def start(self):
+        '''
+        Start the transfer, the sender waits for the receiver to go first.
+        '''
+        return b'', []
+
+    def feed(self, data):
+        '''
+        Process bytes received from the line.
+        '''
+        output = []
+        events = []
+        for byte in bytearray(data):
+            if self.finished:
+                break
+            self._handle(byte, output, events)
+
+        if self.state == 'block' and self.streaming and not output:
+            # nobody waits for us, stream the next block
+            self._next_block(output, events)
+        return _joined(output), events
+
+    def timeout(self):
+        '''
+        Process an expired timeout while waiting for the receiver.
+        '''
+        output = []
+        events = []
+        if self.state == 'drain':
+            # no more duplicate ACKs came, the line is quiet
+            self._timed_out = 0
+            self._next_block(output, events)
+            return _joined(output), events
+        self.stats.timeouts += 1
+        if self.state == 'start':
+            self._error('timeout waiting for receiver', output, events)
+        elif self.state in ('header', 'block') and not self.streaming:
+            if self.state == 'block':
+                # one more copy of the block on the line
+                self._timed_out += 1
+            self._resend('timeout', output, events)
+        elif self.state == 'eot':
+            self._resend_eot(output, events)
+        elif self.state == 'block':
+            return self.feed(b'')
+        return _joined(output), events
+
+    def _handle(self, byte, output, events):
+        if self.state == 'start':
+            if self.delta and byte in (_NAK, _CRC, _G, _Z):
+                log.error('send ERROR expected D, got %d' % (byte,))
+                self._error('protocol error', output, events)
+                return
+            elif byte == _D and self.delta:
+                self.crc_mode, self.streaming = 1, 0
+            elif byte == _NAK:
+                self.crc_mode, self.streaming = 0, 0
+            elif byte == _CRC:
+                self.crc_mode, self.streaming = 1, 0
+            elif byte == _G:
+                self.crc_mode, self.streaming = 1, 1
+            elif byte == _Z and self.compress and self.stream is not None:
+                self.crc_mode, self.streaming = 1, 0
+                self._deflate()
+            elif byte == _CAN:
+                self.stats.cancels += 1
+                if self._cancel:
+                    self._finish(Aborted('transfer cancelled by receiver'),
+                                 events)
+                else:
+                    self._cancel = 1
+                return
+            else:
+                log.error('send ERROR expected NAK/CRC/G, got %d' % \
+                    (byte,))
+                self._error('protocol error', output, events)
+                return
+
+            self._cancel = 0
+            self.error_count = 0
+            self.stats.crc_mode = self.crc_mode
+            self.stats.streaming = self.streaming
+            self.stats.compressed = self.compressed
+            if self.header is not None:
+                self._send_header(output)
+            else:
+                self._next_block(output, events)
+
+        elif self.state == 'block' and self.streaming:
+            # the receiver only ever talks to cancel the transfer
+            if byte == _CAN:
+                self.stats.cancels += 1
+                self._finish(Aborted('transfer cancelled by receiver'),
+                             events)
+            else:
+                self._abort('protocol error', output, events)
+
+        elif self.state in ('header', 'block'):
+            if byte == _ACK:
+                self._acknowledged(output, events)
+            elif byte == _NAK:
+                self.stats.naks += 1
+                if self.state == 'block':
+                    self._refused()
+                self._resend('NAK', output, events)
+            else:
+                self._abort('protocol error', output, events)
+
+        elif self.state == 'drain':
+            if byte == _CAN:
+                self.stats.cancels += 1
+                self._finish(Aborted('transfer cancelled by receiver'),
+                             events)
+                return
+            elif byte == _ACK:
+                log.debug('dropped duplicate ACK for block %d' % \
+                    ((self.sequence - 1) % 0x100,))
+                self._timed_out -= 1
+                if self._timed_out:
+                    # more copies may still be acknowledged
+                    return
+            elif byte == _NAK:
+                # the receiver already asks for the next block
+                self.stats.naks += 1
+                self._timed_out = 0
+            else:
+                self._abort('protocol error', output, events)
+                return
+            self._next_block(output, events)
+
+        elif self.state == 'eot':
+            if byte == _ACK:
+                self._finish(Done(True), events)
+            elif byte == _CAN:
+                self.stats.cancels += 1
+                self._finish(Aborted('transfer cancelled by receiver'),
+                             events)
+            else:
+                self._resend_eot(output, events)
+
+    def _acknowledged(self, output, events):
+        self.error_count = 0
+        if self.state == 'header':
+            self.header = None
+            if self.stream is None:
+                self._finish(Done(True), events)
+            else:
+                # the receiver requests the data like a regular transfer
+                self.state = 'start'
+            return
+
+        self.offset += len(self._data)
+        self.stats.blocks += 1
+        self.stats.bytes += len(self._data)
+        if self.compressed:
+            self.stats.uncompressed = self.stream.consumed
+        elif self.digest is not None:
+            _update_digest(self.digest, self._data[:self._read])
+        events.append(BlockAccepted(self.sequence, self.offset, None))
+        self.sequence = (self.sequence + 1) % 0x100
+
+        if not self._nak:
+            self._naks = 0
+            self._clean += 1
+        if (self._clean >= self.clean_run and self.packet_size == 128 and
+                self.adaptive and self.crc_mode and self.mode == 'xmodem1k'):
+            log.info('line is clean, sending 1024 byte blocks')
+            self.packet_size = 1024
+            self._clean = 0
+        if self._timed_out:
+            # the copies sent again after timeouts may have been on their way
+            # along with the first, the receiver then acknowledges each of
+            # them. Wait for those ACKs first, or they are taken for the ACK
+            # of the next block
+            self.state = 'drain'
+            return
+        self._next_block(output, events)
+
+    def _deflate(self):
+        '''
+        Switch to sending the stream compressed, before the first block is
+        read from it.
+        '''
+        if self.compressed:
+            return
+        log.info('sending compressed stream')
+        self.compressed = 1
+        self.stream = _Deflater(self.stream, self.level, self.flush,
+                                self.digest)
+        # the compressed data is read from the stream like any other stream
+        self.image = None
+        self._view = None
+
+    def _send_header(self, output):
+        '''
+        Send the block with sequence number ``0``, padded with ``NUL`` bytes.
+        '''
+        if len(self.header) > 128:
+            start, data = STX, self.header.ljust(1024, b'\x00')
+        else:
+            start, data = SOH, self.header.ljust(128, b'\x00')
+        frame = bytearray(3 + len(data) + 1 + self.crc_mode)
+        self._packet = self._build_frame(frame, start, 0, data)
+        self.state = 'header'
+        output.append(self._packet)
+
+    def _next_block(self, output, events):
+        if self.packet_size is None:
+            # 1k blocks are only allowed in CRC mode
+            if self.crc_mode:
+                self.packet_size = XMODEM.packet_sizes[self.mode]
+            else:
+                self.packet_size = 128
+
+        if self.prefetch:
+            block = self._prefetched()
+        else:
+            block = self._read_block(self.packet_size)
+        if block is None:
+            log.info('sending EOS')
+            self.state = 'eot'
+            self.error_count = 0
+            output.append(EOT)
+            return
+
+        start, data, self._read = block[:3]
+        self._frame_block(start, data, *block[3:])
+        self._nak = 0
+        self.state = 'block'
+        output.append(self._packet)
+        if self.streaming:
+            # streamed blocks are never acknowledged
+            self.stats.blocks += 1
+            self.stats.bytes += len(data)
+            self.offset += len(data)
+            self.sequence = (self.sequence + 1) % 0x100
+            if self.digest is not None:
+                _update_digest(self.digest, data[:self._read])
+
+    def _frame_block(self, start, data, packet=None):
+        if packet is None and self.image is not None:
+            packet = self.image.frame(self.crc_mode, self.packet_size,
+                                      self.sequence, self.offset)
+        if packet is None:
+            packet = self._make_frame(self._frames, start, self.sequence,
+                                      data)
+        self._packet = packet
+        self._data = data
+        if len(data) > (self.stats.block_size or 0):
+            self.stats.block_size = len(data)
+
+    def _make_frame(self, frames, start, sequence, data):
+        # frame buffers are allocated once per block size and reused
+        frame = frames.get(len(data))
+        if frame is None:
+            frame = frames[len(data)] = bytearray(
+                3 + len(data) + 1 + self.crc_mode)
+        return self._build_frame(frame, start, sequence, data)
+
+    def _prefetched(self):
+        '''
+        Take the next block from the background stage, which is (re)started
+        for the current block size.
+        '''
+        if (self._prefetcher is not None and
+                self._prefetcher.packet_size != self.packet_size):
+            self._unread(self._prefetcher.stop())
+            self._prefetcher = None
+        if self._prefetcher is None:
+            self._prefetcher = _Prefetcher(self, self.packet_size,
+                                           self.prefetch)
+        return self._prefetcher.get()
+
+    def _unread(self, blocks):
+        '''
+        Put the data of blocks read but not sent back in front of the stream.
+        '''
+        if self._view is not None:
+            self._position -= sum(len(data) for data in blocks)
+        elif blocks:
+            self._pending = b''.join(bytes(data) for data in blocks) + \
+                self._pending
+
+    def close(self):
+        '''
+        Stop the background stage reading ahead, if any.
+        '''
+        if self._prefetcher is not None:
+            self._prefetcher.stop()
+            self._prefetcher = None
+
+    def _finish(self, event, events):
+        self.close()
+        # let go of the buffer, an mmap can not be closed while viewed
+        self._view = None
+        self._data = b''
+        if self.compressed:
+            self.stats.uncompressed = self.stream.consumed
+            self.stream = self.stream.stream
+        _Machine._finish(self, event, events)
+
+    def _refused(self):
+        '''
+        Keep track of the NAKs, after a burst of them fall back to 128 byte
+        blocks, from the next block on. The refused block itself is sent
+        again as it is, the receiver may have accepted it already, and a
+        shorter block under the same sequence number would be taken for it.
+        '''
+        self._nak = 1
+        self._naks += 1
+        self._clean = 0
+        if (self.packet_size == 1024 and self.adaptive and
+                self._naks >= self.nak_burst):
+            log.info('line is noisy, sending 128 byte blocks')
+            self.packet_size = 128
+            self._naks = 0
+
+    def _resend(self, reason, output, events):
+        self.error_count += 1
+        if self.error_count >= self.retry:
+            # excessive amounts of retransmissions requested, abort transfer
+            self._abort('excessive %ss, transfer aborted' % (reason,),
+                        output, events)
+            return
+        self.stats.retransmits += 1
+        events.append(Retransmit(0 if self.state == 'header' else
+                                 self.sequence, reason))
+        output.append(self._packet)
+
+    def _resend_eot(self, output, events):
+        # some receivers NAK the first EOT to make sure we really are done
+        self.error_count += 1
+        if self.error_count >= self.retry:
+            self._finish(Aborted('expected ACK for EOT'), events)
+        else:
+            output.append(EOT)
+
+    def _build_frame(self, frame, start, sequence, data):
+        '''
+        Fill the ``frame`` buffer with the header, data and checksum of a
+        block, returns the buffer, which is written to the line as it is.
+        '''
+        _HEADER.pack_into(frame, 0, ord(start), sequence, 0xff - sequence)
+        frame[3:3 + len(data)] = data
+        if self.crc_mode:
+            _CRC16.pack_into(frame, len(frame) - 2, self.calc_crc(data))
+        else:
+            _CHECKSUM.pack_into(frame, len(frame) - 1,
+                                self.calc_checksum(data))
+        return frame
+
+    def _read_block(self, size):
+        '''
+        Read the next block from the stream, returns a tuple of the start of
+        header byte, the padded block data and the number of bytes read, or
+        ``None`` at the end of the stream. If a 1024 byte block comes up
+        short, its data is sent as 128 byte blocks instead, to limit the
+        amount of padding at the end of the stream. Only the padded last
+        block is copied when sending a buffer.
+        '''
+        if self._view is not None:
+            data = self._view[self._position:self._position + size]
+        else:
+            data = self._pending
+            if len(data) < size:
+                data += self.stream.read(size - len(data))
+        if not len(data):
+            # end of stream
+            return None
+
+        if size == 1024 and len(data) < size:
+            # tail of the stream, fall back to 128 byte blocks
+            size = 128
+        if self._view is not None:
+            self._position += min(size, len(data))
+        else:
+            self._pending = data[size:]
+        data = data[:size]
+        read = len(data)
+        if size == 1024:
+            return STX, data, read
+        elif read < size:
+            data = bytearray(data).ljust(size, b'\xff')
+        return SOH, data, read
+
+
+class _Prefetcher(object):
+    '''
+    Background stage of a :class:`Sender`, reading and framing the blocks of
+    ``packet_size`` bytes ahead into a queue of ``depth`` blocks. The stream
+    belongs to the stage until it is stopped.
+    '''
+
+    def __init__(self, sender, packet_size, depth):
+        self.sender = sender
+        self.packet_size = packet_size
+        self.queue = queue.Queue(depth)
+        self._held = None
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run,
+                                        args=(sender.sequence,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def get(self):
+        '''
+        Returns the next block as a tuple of the start of header byte, the
+        padded block data, the number of bytes read and the frame, or ``None``
+        at the end of the stream. Errors reading the stream are raised here.
+        '''
+        block = self.queue.get()
+        if isinstance(block, Exception):
+            raise block
+        return block
+
+    def stop(self):
+        '''
+        Stop reading ahead, returns the data of the blocks read but not taken.
+        '''
+        self._stopped.set()
+        blocks = []
+        while True:
+            try:
+                block = self.queue.get_nowait()
+            except queue.Empty:
+                if not self._thread.is_alive():
+                    break
+                # unblock a worker waiting for room in the queue
+                self._thread.join(0.01)
+                continue
+            if isinstance(block, tuple):
+                blocks.append(block)
+        if self._held is not None:
+            blocks.append(self._held)
+        return [data[:read] for start, data, read, packet in blocks]
+
+    def _run(self, sequence):
+        sender = self.sender
+        # frames are built into a ring of buffers, one for every frame in
+        # the queue, the frame being sent and the frame waiting for room
+        ring = [{} for index in range(self.queue.maxsize + 2)]
+        count = 0
+        try:
+            while not self._stopped.is_set():
+                block = sender._read_block(self.packet_size)
+                if block is not None:
+                    start, data, read = block
+                    packet = sender._make_frame(ring[count % len(ring)],
+                                                start, sequence, data)
+                    block = start, data, read, packet
+                    sequence = (sequence + 1) % 0x100
+                    count += 1
+                if not self._put(block) or block is None:
+                    return
+        except Exception as error:
+            self._put(error)
+
+    def _put(self, block):
+        while not self._stopped.is_set():
+            try:
+                self.queue.put(block, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        if isinstance(block, tuple):
+            # read, but never queued
+            self._held = block
+        return False
+
+
+class _Deflater(object):
+    '''
+    Stream of the data read from ``stream`` compressed with zlib at
+    ``level``, read by a :class:`Sender` sending a compressed stream. With
+    ``flush`` set, the compressor is flushed after every that many bytes
+    read. The stream is read ``chunk`` bytes at a time, so only a chunk and
+    the compressed data not yet sent are held in memory. The data read is
+    added to the running ``digest``, if any.
+    '''
+
+    def __init__(self, stream, level=6, flush=None, digest=None,
+                 chunk=16384):
+        self.stream = stream
+        self.flush = flush
+        self.digest = digest
+        self.chunk = chunk
+        # number of bytes read from the stream
+        self.consumed = 0
+        self._view = _buffer_view(stream)
+        self._position = 0
+        if self._view is not None and hasattr(stream, 'tell'):
+            self._position = stream.tell()
+        self._compressor = zlib.compressobj(level)
+        self._buffer = bytearray()
+        self._unflushed = 0
+        self._eof = 0
+
+    def read(self, size):
+        while len(self._buffer) < size and not self._eof:
+            want = self.chunk
+            if self.flush:
+                want = min(want, self.flush - self._unflushed)
+            data = self._read(want)
+            if not data:
+                # the end of the compressed stream
+                self._buffer += self._compressor.flush()
+                self._eof = 1
+                break
+            self.consumed += len(data)
+            if self.digest is not None:
+                self.digest.update(data)
+            self._buffer += self._compressor.compress(data)
+            self._unflushed += len(data)
+            if self.flush and self._unflushed >= self.flush:
+                self._buffer += self._compressor.flush(zlib.Z_SYNC_FLUSH)
+                self._unflushed = 0
+
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def _read(self, size):
+        if self._view is None:
+            return self.stream.read(size)
+        data = self._view[self._position:self._position + size].tobytes()
+        self._position += len(data)
+        return data
+
+
+class Receiver(_Machine):
+    '''
+    Protocol state machine for the receiving side of a transfer, without any
+    I/O of its own. It is driven like the :class:`Sender`, the received data
+    is handed out with the :class:`BlockAccepted` events, as a
+    ``memoryview`` on the frame. The frame may be a buffer the driver reuses
+    for its next read, so copy the data to hold on to it.
+
+    >>> machine = Receiver()
+    >>> machine.start()
+    (b'C', [])
+    >>> machine.feed(frame)
+    (b'\\x06', [BlockAccepted(sequence=1, offset=128, data=<memory ...>)])
+    >>> machine.feed(EOT)
+    (b'\\x06', [Done(result=128)])
+
+    With ``streaming`` enabled, XMODEM-G is requested first. If the ``size``
+    of the stream is known, the padding of the last block is not handed out.
+    With ``header`` enabled, only block ``0`` is received and its data is the
+    result of the transfer, like YMODEM does with the file name and size.
+    Metrics are collected in ``stats``, a :class:`TransferStats`.
+
+    With ``compress`` enabled, a compressed stream is requested with ``Z``
+    first, the blocks are then decompressed as they arrive and the events
+    hand out the decompressed data. The ``offset`` and the result count the
+    decompressed bytes. This can not be combined with ``streaming``.
+
+    With ``delta`` enabled, the block signatures of a delta transfer are
+    requested with ``D`` instead, see :mod:`xmodem.delta`.
+
+    With ``digest`` set, like for the :class:`Sender`, the data handed out
+    is added to the digest. Without a ``size`` it includes the padding of
+    the last block, unless the stream is compressed.
+
+    A block that arrives after the timeouts waiting for it were answered
+    with ``NAK``, is sent again for every ``NAK``. Those copies are dropped
+    without an ``ACK``, the sender already has the ``ACK`` for the first.
+    '''
+
+    def __init__(self, crc_mode=1, streaming=0, retry=16, size=None,
+                 header=0, sequence=1, offset=0, stats=None, compress=0,
+                 delta=0, digest=None):
+        if compress and streaming:
+            raise ValueError('compression can not be combined with '
+                             'streaming')
+        self.crc_mode = crc_mode
+        self.streaming = streaming
+        self.retry = retry
+        self.size = size
+        self.header = header
+        self.sequence = 0 if header else sequence
+        self.offset = offset
+        self.compress = compress
+        self.compressed = 0
+        self.delta = delta
+        self.digest = _new_digest(digest)
+        self.packet_size = 128
+        self.state = 'start'
+        self.error_count = 0
+        self._cancel = 0
+        self._timed_out = 0
+        self._duplicate = 0
+        self._buffer = bytearray()
+        self._inflater = None
+        self.stats = stats if stats is not None else TransferStats()
+
+    @property
+    def expect(self):
+        '''
+        Number of bytes to read before calling :meth:`feed`, ``0`` if the
+        line only has to be polled, or ``None`` if the transfer has finished.
+        '''
+        if self.finished:
+            return None
+        elif self.state == 'frame':
+            return self._frame_size() - len(self._buffer)
+        elif self.state == 'purge':
+            return 0
+        return 1
+
+    def start(self):
+        '''
+        Start the transfer, returns the request for the sender.
+        '''
+        return self._request(), []
+
+    def feed(self, data):
+        '''
+        Process bytes received from the line.
+        '''
+        output = []
+        events = []
+        if (self.state == 'frame' and not self._buffer and
+                len(data) == self._frame_size()):
+            # the common case, a driver reading exactly one frame
+            self._frame(data, output, events)
+            return b''.join(output), events
+
+        if self.state == 'purge':
+            self._purge(data, output)
+            return b''.join(output), events
+
+        self._buffer += data
+        while self._buffer and not self.finished:
+            if self.state == 'purge':
+                self._purge(b'', output)
+            elif self.state == 'frame':
+                size = self._frame_size()
+                if len(self._buffer) < size:
+                    break
+                frame = self._buffer[:size]
+                del self._buffer[:size]
+                self._frame(frame, output, events)
+            else:
+                byte = self._buffer[0]
+                del self._buffer[:1]
+                self._handle(byte, output, events)
+        return b''.join(output), events
+
+    def timeout(self):
+        '''
+        Process an expired timeout while waiting for the sender.
+        '''
+        output = []
+        events = []
+        self.stats.timeouts += 1
+        if self.state == 'start':
+            self._error('timeout waiting for sender', output, events)
+            if not self.finished:
+                output.append(self._request())
+        elif self.state == 'data':
+            log.warning('recv timeout waiting for SOH/EOT')
+            if self.streaming:
+                self._abort('timeout in streaming mode', output, events)
+                return b''.join(output), events
+            self._error('timeout waiting for SOH/EOT', output, events)
+            if not self.finished:
+                self.stats.naks += 1
+                self._timed_out += 1
+                output.append(NAK)
+        elif self.state == 'frame':
+            # incomplete frame
+            del self._buffer[:]
+            self.state = 'data'
+            self._reject('timeout', output, events)
+        return b''.join(output), events
+
+    def _request(self):
+        # first try compression or streaming and CRC mode, if this fails,
+        # fall back to checksum mode
+        if self.delta:
+            # only a peer sending a delta knows what to do with this
+            self.crc_mode = 1
+            return D
+        elif self.compress and self.error_count < (self.retry / 4):
+            self.crc_mode = 1
+            return Z
+        elif self.streaming and self.error_count < (self.retry / 4):
+            self.crc_mode = 1
+            return G
+        elif self.crc_mode and self.error_count < (self.retry / 2):
+            self.compress = 0
+            self.streaming = 0
+            return CRC
+        else:
+            self.crc_mode = 0
+            self.compress = 0
+            self.streaming = 0
+            return NAK
+
+    def _frame_size(self):
+        return 2 + self.packet_size + 1 + self.crc_mode
+
+    def _handle(self, byte, output, events):
+        if self.state == 'start':
+            if byte not in (_SOH, _STX, _CAN, _EOT):
+                self._error('protocol error', output, events)
+                if not self.finished:
+                    output.append(self._request())
+                return
+            self.state = 'data'
+            if self.compress:
+                # the sender went along with our request
+                self.compressed = 1
+                self._inflater = zlib.decompressobj()
+            self.stats.crc_mode = self.crc_mode
+            self.stats.streaming = self.streaming
+            self.stats.compressed = self.compressed
+
+        if byte == _SOH:
+            self.packet_size = 128
+            self.state = 'frame'
+            self._cancel = 0
+        elif byte == _STX:
+            self.packet_size = 1024
+            self.state = 'frame'
+            self._cancel = 0
+        elif byte == _EOT and not self.header:
+            output.append(ACK)
+            if self._inflater is not None and \
+                    not getattr(self._inflater, 'eof', True):
+                self._finish(Aborted('compressed stream ended early'),
+                             events)
+                return
+            self._finish(Done(self.offset), events)
+        elif byte == _CAN:
+            # cancel at two consecutive cancels
+            self.stats.cancels += 1
+            if self._cancel:
+                self._finish(Aborted('transfer cancelled by sender'), events)
+            self._cancel = 1
+        else:
+            log.error('recv ERROR expected SOH/EOT, got %d' % (byte,))
+            if self.streaming:
+                self._abort('protocol error', output, events)
+                return
+            self._error('protocol error', output, events)
+
+    def _frame(self, frame, output, events):
+        self.state = 'data'
+        seq, data = self._check_frame(frame)
+        if data is not None and seq == self.sequence:
+            # valid data, if it was only late, it is sent again for our NAK
+            self.error_count = 0
+            self._duplicate, self._timed_out = self._timed_out, 0
+            if self.header:
+                output.append(ACK)
+                self._finish(Done(data.tobytes()), events)
+                return
+            if self._inflater is not None:
+                self.stats.bytes += len(data)
+                try:
+                    data = self._inflate(data)
+                except zlib.error as error:
+                    self._abort('invalid compressed data: %s' % (error,),
+                                output, events)
+                    return
+            if self.size is not None:
+                data = data[:max(0, self.size - self.offset)]
+            self.offset += len(data)
+            self.stats.blocks += 1
+            if self._inflater is not None:
+                self.stats.uncompressed += len(data)
+            else:
+                self.stats.bytes += len(data)
+            if self.digest is not None:
+                _update_digest(self.digest, data)
+            if self.packet_size > (self.stats.block_size or 0):
+                self.stats.block_size = self.packet_size
+            events.append(BlockAccepted(self.sequence, self.offset, data))
+            if not self.streaming:
+                output.append(ACK)
+            self.sequence = (self.sequence + 1) % 0x100
+        elif (data is not None and not self.streaming and
+              seq == (self.sequence - 1) % 0x100):
+            # our ACK got lost, the sender repeated the last block
+            self.stats.retransmits += 1
+            if self._duplicate:
+                log.debug('dropped duplicate of block %d' % (seq,))
+                self._duplicate -= 1
+            else:
+                output.append(ACK)
+        else:
+            if data is not None:
+                log.debug('expecting sequence %d, got %d' % \
+                    (self.sequence, seq))
+            self._reject('damaged block', output, events)
+
+    def _inflate(self, data):
+        try:
+            return self._inflater.decompress(data)
+        except TypeError:
+            # zlib in Python 2 only takes strings
+            return self._inflater.decompress(data.tobytes())
+
+    def _check_frame(self, frame):
+        '''
+        Verify the sequence bytes and checksum of a frame, returns a tuple of
+        the sequence number and a view of the data. The data is ``None`` if
+        the frame is damaged.
+        '''
+        seq1, seq2 = _SEQUENCE.unpack_from(frame)
+        if seq1 != 0xff - seq2:
+            log.debug('sequence %d does not match complement %d' % \
+                (seq1, seq2))
+            return None, None
+
+        offset = 2 + self.packet_size
+        data = memoryview(frame)[2:offset]
+        if self.crc_mode:
+            csum, = _CRC16.unpack_from(frame, offset)
+            ours = self.calc_crc(data)
+        else:
+            csum, = _CHECKSUM.unpack_from(frame, offset)
+            ours = self.calc_checksum(data)
+
+        if csum != ours:
+            log.debug('%s (%04x <> %04x)' % \
+                ('CRC' if self.crc_mode else 'checksum', csum, ours))
+            return seq1, None
+        return seq1, data
+
+    def _purge(self, data, output):
+        # bytes still arriving after a refused frame, such as the rest of a
+        # frame we gave up on, are discarded before asking for the block
+        # again, or they would be taken for the start of the next frame
+        if data or self._buffer:
+            log.debug('discarding %d bytes' % (len(data) + len(self._buffer),))
+            del self._buffer[:]
+        else:
+            self.stats.naks += 1
+            self.state = 'data'
+            output.append(NAK)
+
+    def _reject(self, reason, output, events):
+        # something went wrong, streams can not recover
+        if self.streaming:
+            self._abort('error in streaming mode, transfer aborted',
+                        output, events)
+            return
+
+        # request retransmission
+        self._error(reason, output, events)
+        if not self.finished:
+            events.append(Retransmit(self.sequence, reason))
+            self.state = 'purge'
+
+
+class XMODEM(object):
+    '''
+    XMODEM Protocol handler, expects an object to read from and an object to
+    write to.
+
+    >>> def getc(size, timeout=1):
+    ...     return data or None
+    ...
+    >>> def putc(data, timeout=1):
+    ...     return size or None
+    ...
+    >>> modem = XMODEM(getc, putc)
+
+    The ``mode`` selects the block size used for sending, ``xmodem`` sends
+    128 byte ``SOH`` blocks, ``xmodem1k`` sends 1024 byte ``STX`` blocks if
+    the receiver requests CRC mode, and falls back to 128 byte blocks for the
+    tail of the stream. On a noisy line ``xmodem1k`` switches to 128 byte
+    blocks until the line is clean again, as described for the
+    :class:`Sender`.
+
+    Frames are handed to ``putc`` in buffers that are reused for the next
+    frames once it returns, a ``putc`` holding on to the data has to copy
+    it.
+
+    The metrics of the last transfer are kept in ``stats``, a
+    :class:`TransferStats`. The optional ``progress_callback`` is called with
+    the stats after every block, the optional ``event_callback`` with every
+    :class:`BlockAccepted`, :class:`Retransmit`, :class:`Done` or
+    :class:`Aborted` event and the stats. Problems are no longer printed,
+    they are reported through these callbacks and the ``xmodem`` logger, the
+    ``quiet`` arguments of ``send`` and ``recv`` are kept for compatibility.
+
+    The ``timeout`` passed to ``send`` and ``recv`` is only used until the
+    round-trip time of the line is known, the timeouts are then derived from
+    the measured round-trip times by a :class:`RetransmitTimer`, between
+    ``min_timeout`` and ``max_timeout`` seconds. The ``min_timeout`` defaults
+    to one second, like RFC 6298 has, and the ``max_timeout`` to the
+    ``timeout`` passed. Round-trip times are measured for each block size,
+    as 1024 byte blocks take eight times as long on a slow line as 128 byte
+    blocks. A receiver waits for the rest of a frame that has started to
+    arrive based on how long frames took so far, so truncated frames are
+    refused quickly. Set ``min_timeout`` to ``None`` to always wait
+    ``timeout`` seconds.
+
+    Blocks are checked with the fast module level :func:`calc_crc` and
+    :func:`calc_checksum`, unless a subclass overrides the ``calc_crc`` or
+    ``calc_checksum`` methods, its transfers then use those methods. The
+    ``crctable`` is no longer used and only kept for compatibility.
+
+    >>> def progress(stats):
+    ...     print('%d bytes' % (stats.bytes,))
+    ...
+    >>> modem = XMODEM(getc, putc, progress_callback=progress)
+
+    '''
+
+    # crctab calculated by Mark G. Mendel, Network Systems Corporation, no
+    # longer used
+    crctable = [
+        0x0000, 0x1021, 0x2042, 0x3063, 0x4084, 0x50a5, 0x60c6, 0x70e7,
+        0x8108, 0x9129, 0xa14a, 0xb16b, 0xc18c, 0xd1ad, 0xe1ce, 0xf1ef,
+        0x1231, 0x0210, 0x3273, 0x2252, 0x52b5, 0x4294, 0x72f7, 0x62d6,
+        0x9339, 0x8318, 0xb37b, 0xa35a, 0xd3bd, 0xc39c, 0xf3ff, 0xe3de,
+        0x2462, 0x3443, 0x0420, 0x1401, 0x64e6, 0x74c7, 0x44a4, 0x5485,
+        0xa56a, 0xb54b, 0x8528, 0x9509, 0xe5ee, 0xf5cf, 0xc5ac, 0xd58d,
+        0x3653, 0x2672, 0x1611, 0x0630, 0x76d7, 0x66f6, 0x5695, 0x46b4,
+        0xb75b, 0xa77a, 0x9719, 0x8738, 0xf7df, 0xe7fe, 0xd79d, 0xc7bc,
+        0x48c4, 0x58e5, 0x6886, 0x78a7, 0x0840, 0x1861, 0x2802, 0x3823,
+        0xc9cc, 0xd9ed, 0xe98e, 0xf9af, 0x8948, 0x9969, 0xa90a, 0xb92b,
+        0x5af5, 0x4ad4, 0x7ab7, 0x6a96, 0x1a71, 0x0a50, 0x3a33, 0x2a12,
+        0xdbfd, 0xcbdc, 0xfbbf, 0xeb9e, 0x9b79, 0x8b58, 0xbb3b, 0xab1a,
+        0x6ca6, 0x7c87, 0x4ce4, 0x5cc5, 0x2c22, 0x3c03, 0x0c60, 0x1c41,
+        0xedae, 0xfd8f, 0xcdec, 0xddcd, 0xad2a, 0xbd0b, 0x8d68, 0x9d49,
+        0x7e97, 0x6eb6, 0x5ed5, 0x4ef4, 0x3e13, 0x2e32, 0x1e51, 0x0e70,
+        0xff9f, 0xefbe, 0xdfdd, 0xcffc, 0xbf1b, 0xaf3a, 0x9f59, 0x8f78,
+        0x9188, 0x81a9, 0xb1ca, 0xa1eb, 0xd10c, 0xc12d, 0xf14e, 0xe16f,
+        0x1080, 0x00a1, 0x30c2, 0x20e3, 0x5004, 0x4025, 0x7046, 0x6067,
+        0x83b9, 0x9398, 0xa3fb, 0xb3da, 0xc33d, 0xd31c, 0xe37f, 0xf35e,
+        0x02b1, 0x1290, 0x22f3, 0x32d2, 0x4235, 0x5214, 0x6277, 0x7256,
+        0xb5ea, 0xa5cb, 0x95a8, 0x8589, 0xf56e, 0xe54f, 0xd52c, 0xc50d,
+        0x34e2, 0x24c3, 0x14a0, 0x0481, 0x7466, 0x6447, 0x5424, 0x4405,
+        0xa7db, 0xb7fa, 0x8799, 0x97b8, 0xe75f, 0xf77e, 0xc71d, 0xd73c,
+        0x26d3, 0x36f2, 0x0691, 0x16b0, 0x6657, 0x7676, 0x4615, 0x5634,
+        0xd94c, 0xc96d, 0xf90e, 0xe92f, 0x99c8, 0x89e9, 0xb98a, 0xa9ab,
+        0x5844, 0x4865, 0x7806, 0x6827, 0x18c0, 0x08e1, 0x3882, 0x28a3,
+        0xcb7d, 0xdb5c, 0xeb3f, 0xfb1e, 0x8bf9, 0x9bd8, 0xabbb, 0xbb9a,
+        0x4a75, 0x5a54, 0x6a37, 0x7a16, 0x0af1, 0x1ad0, 0x2ab3, 0x3a92,
+        0xfd2e, 0xed0f, 0xdd6c, 0xcd4d, 0xbdaa, 0xad8b, 0x9de8, 0x8dc9,
+        0x7c26, 0x6c07, 0x5c64, 0x4c45, 0x3ca2, 0x2c83, 0x1ce0, 0x0cc1,
+        0xef1f, 0xff3e, 0xcf5d, 0xdf7c, 0xaf9b, 0xbfba, 0x8fd9, 0x9ff8,
+        0x6e17, 0x7e36, 0x4e55, 0x5e74, 0x2e93, 0x3eb2, 0x0ed1, 0x1ef0,
+    ]
+
+    # block sizes per sending mode
+    packet_sizes = {
+        'xmodem':   128,
+        'xmodem1k': 1024,
+    }
+
+    def __init__(self, getc, putc, mode='xmodem', progress_callback=None,
+                 event_callback=None, min_timeout=1, max_timeout=None):
+        if mode not in self.packet_sizes:
+            raise ValueError('unknown mode %r' % (mode,))
+        self.getc = getc
+        self.putc = putc
+        self.mode = mode
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.progress_callback = progress_callback
+        self.event_callback = event_callback
+        self.stats = None
+        # a FrameReader hands out views on its buffer instead of copies
+        self._getv = getattr(getc, 'getv', getc)
+
+    def abort(self, count=2, timeout=60):
+        '''
+        Send an abort sequence using CAN bytes.
+        '''
+        for counter in range(0, count):
+            self.putc(CAN, timeout)
+
+    def send(self, stream, retry=16, timeout=60, quiet=0, checkpoint=None,
+             prefetch=0, compress=0, level=6, flush=None, delta=0,
+             digest=None, adaptive=1):
+        '''
+        Send a stream via the XMODEM protocol.
+
+            >>> stream = file('/etc/issue', 'rb')
+            >>> print modem.send(stream)
+            True
+
+        Returns ``True`` upon succesful transmission or ``False`` in case of
+        failure.
+
+        The ``stream`` may as well be a buffer, such as ``bytes`` or an
+        ``mmap``, its blocks are then framed straight from slices of the
+        buffer, without copying them first.
+
+        With ``prefetch`` set, that many blocks are read and framed ahead in
+        a background thread while waiting for the receiver, see
+        :class:`Sender`.
+
+        If the receiver asks for XMODEM-G streaming, blocks are sent back to
+        back without waiting for an ``ACK``, the transfer fails as soon as
+        the receiver cancels.
+
+        With a ``checkpoint`` journal, given as a :class:`Checkpoint` or a
+        file name, the last acknowledged block is recorded and a retried
+        transfer continues after it. The receiver has to keep a checkpoint
+        journal as well.
+
+        With ``compress`` enabled, the stream is sent compressed with zlib at
+        ``level`` if the receiver asks for it, see :class:`Sender` for the
+        ``flush`` policy. This can not be combined with a ``checkpoint``
+        journal.
+
+        With ``delta`` enabled, the receiver reports the block signatures of
+        the copy it already has first, only the blocks that changed are then
+        sent along with instructions to copy the others, see
+        :mod:`xmodem.delta`. The receiver has to enable ``delta`` as well.
+        This can not be combined with a ``checkpoint`` journal.
+
+        With ``digest`` set, to the name of a :mod:`hashlib` algorithm such
+        as ``sha256``, to ``crc32`` or to a running digest object, the data
+        sent is added to the digest and its hex digest is kept in the
+        ``digest`` of the ``stats``. This can not be combined with a
+        ``checkpoint`` journal.
+
+        In ``xmodem1k`` mode the block size falls back to 128 bytes on a
+        noisy line, set ``adaptive`` to ``0`` to always send 1024 byte
+        blocks, see :class:`Sender`.
+        '''
+        return self._drive(self._send_steps(
+            stream, retry, timeout, checkpoint, prefetch, compress, level,
+            flush, delta, digest, adaptive))
+
+    def recv(self, stream, crc_mode=1, retry=16, timeout=60, delay=1, quiet=0,
+             streaming=0, checkpoint=None, write_behind=0, fsync=None,
+             compress=0, delta=0, size=None, digest=None):
+        '''
+        Receive a stream via the XMODEM protocol.
+
+            >>> stream = file('/etc/issue', 'wb')
+            >>> print modem.recv(stream)
+            2342
+
+        Returns the number of bytes received on success or ``None`` in case of
+        failure.
+
+        The ``stream`` may as well be a writable buffer, such as a
+        preallocated ``bytearray`` or an ``mmap``, the blocks are then copied
+        into it in place. Data that does not fit, usually the padding of the
+        last block, is dropped.
+
+        With ``streaming`` enabled, XMODEM-G is requested first, blocks are
+        then not acknowledged and the transfer is aborted on the first error.
+        Only use this on error free lines.
+
+        With a ``checkpoint`` journal, given as a :class:`Checkpoint` or a
+        file name, each block written is recorded and a retried transfer
+        continues after it. The stream has to be opened for updating, using
+        mode ``r+b``, and the number of bytes returned includes the bytes
+        received by earlier attempts. Blocks streamed with XMODEM-G are not
+        recorded, like on the sending side, so an interrupted stream is
+        received again from its start.
+
+        With ``write_behind`` enabled, blocks are acknowledged as soon as they
+        check out and written to the stream in large chunks by a background
+        thread, see :class:`WriteBehind` for the ``fsync`` policies. All data
+        is written before the end of the transfer is acknowledged, errors
+        writing the stream cancel the transfer and are raised. This can not
+        be combined with a ``checkpoint`` journal.
+
+        With ``compress`` enabled, a zlib compressed stream is requested from
+        the sender first, only peers running this library go along with it.
+        The blocks are decompressed as they arrive, the number of bytes
+        returned is the size of the decompressed stream. This can not be
+        combined with ``streaming`` or a ``checkpoint`` journal. A plain
+        sender does not answer the request, it is asked a quarter of
+        ``retry`` times, waiting at most ``min_timeout`` seconds each time,
+        before a CRC transfer is requested instead.
+
+        With ``delta`` enabled, the data already in the stream, from its
+        current position on, is updated in place to the data sent. Only the
+        blocks that changed are received, after sending the block signatures
+        of the data to the sender, see :mod:`xmodem.delta`. The stream has to
+        be a file opened for updating, using mode ``r+b``, and the sender has
+        to enable ``delta`` as well. The number of bytes returned is the size
+        of the updated data. This can not be combined with a ``checkpoint``
+        journal.
+
+        With a ``size``, data beyond it, the padding of the last block, is
+        dropped. With ``digest`` set, like for :meth:`send`, the data written
+        is added to the digest as it arrives, and its hex digest is kept in
+        the ``digest`` of the ``stats``, so the stream does not have to be
+        read back to verify it. The padding of the last block is included,
+        unless the ``size`` is given or the stream is compressed or a delta.
+        This can not be combined with a ``checkpoint`` journal.
+        '''
+        return self._drive(self._recv_steps(
+            stream, crc_mode, retry, timeout, delay, streaming, checkpoint,
+            write_behind, fsync, compress, delta, size, digest))
+
+    def _send_steps(self, stream, retry, timeout, checkpoint, prefetch,
+                    compress, level, flush, delta, digest, adaptive=1):
+        '''
+        The steps of sending a stream, shared by the blocking and asyncio
+        drivers. A generator yielding the arguments of each run of a state
+        machine, receiving its result in return, :class:`Aborted` to have an
+        abort sequence sent, and the :class:`Done` result at the end.
+        '''
+        if checkpoint is not None and not isinstance(checkpoint, Checkpoint):
+            checkpoint = Checkpoint(checkpoint, getattr(stream, 'name', ''))
+        self._check_resume(checkpoint, compress, delta, digest)
+
+        sequence, offset = self._resume(stream, checkpoint)
+        self.stats = TransferStats()
+        digest = _new_digest(digest)
+        if delta:
+            signatures = io.BytesIO()
+            machine = Receiver(retry=retry, stats=self.stats, delta=1)
+            result = yield machine, timeout, 0, signatures
+            if result is None:
+                yield Done(False)
+                return
+            stream = self._delta_encoder(stream, signatures.getvalue(),
+                                         digest)
+            if stream is None:
+                yield Aborted('invalid block signatures')
+                yield Done(False)
+                return
+
+        machine = Sender(stream, self.mode, retry, sequence=sequence,
+                         offset=offset, stats=self.stats, adaptive=adaptive,
+                         prefetch=prefetch, compress=compress, level=level,
+                         flush=flush, digest=None if delta else digest)
+        result = yield machine, timeout, 0, None, checkpoint
+        if not result:
+            yield Done(False)
+            return
+        if delta and digest is not None:
+            self.stats.digest = digest.hexdigest()
+
+        if checkpoint is not None:
+            checkpoint.clear()
+        yield Done(True)
+
+    def _recv_steps(self, stream, crc_mode, retry, timeout, delay, streaming,
+                    checkpoint, write_behind, fsync, compress, delta, size,
+                    digest):
+        '''
+        The steps of receiving a stream, shared by the blocking and asyncio
+        drivers like those of :meth:`_send_steps`.
+        '''
+        if checkpoint is not None and not isinstance(checkpoint, Checkpoint):
+            checkpoint = Checkpoint(checkpoint, getattr(stream, 'name', ''))
+        self._check_resume(checkpoint, compress, delta, digest)
+
+        sequence, offset = self._resume(stream, checkpoint, truncate=1)
+        self.stats = TransferStats()
+        digest = _new_digest(digest)
+        if delta:
+            machine = self._signature_sender(stream, retry)
+            result = yield machine, timeout, delay
+            if not result:
+                yield Done(None)
+                return
+            stream = DeltaPatcher(stream, digest=digest)
+            # the size and digest are those of the data rebuilt
+            size = digest = None
+
+        machine = Receiver(crc_mode, streaming, retry, size, sequence=sequence,
+                           offset=offset, stats=self.stats, compress=compress,
+                           digest=digest)
+        writer = self._write_behind(stream, checkpoint, write_behind, fsync)
+        try:
+            income_size = yield (machine, timeout, delay, writer or stream,
+                                 checkpoint)
+        except Exception as error:
+            # cancel, rather than leave the sender waiting for us
+            yield Aborted(str(error))
+            raise error
+        finally:
+            if writer is not None:
+                writer.finish()
+        if income_size is not None and delta:
+            income_size = self._patched(stream)
+        if income_size is not None and checkpoint is not None:
+            checkpoint.clear()
+        yield Done(income_size)
+
+    def _drive(self, steps):
+        '''
+        Carry out the steps of a transfer with the ``getc`` and ``putc``
+        callables, returns the result of the transfer.
+        '''
+        step = next(steps)
+        while not isinstance(step, Done):
+            try:
+                if isinstance(step, Aborted):
+                    result = self.abort()
+                else:
+                    result = self._run(*step)
+            except Exception as error:
+                step = steps.throw(error)
+            else:
+                step = steps.send(result)
+        steps.close()
+        return step.result
+
+    def _run(self, machine, timeout, delay=0, stream=None, checkpoint=None):
+        '''
+        Drive a :class:`Sender` or :class:`Receiver` state machine with the
+        ``getc`` and ``putc`` callables. Returns the result of the transfer,
+        or ``None`` in case of failure.
+        '''
+        session = _Session(self, machine, timeout, stream, checkpoint)
+        try:
+            data, events = machine.start()
+            while True:
+                if events:
+                    session.handle(events)
+                if data:
+                    if not self.putc(data) and delay:
+                        time.sleep(delay)
+                    session.wrote()
+
+                size = machine.expect
+                if size is None:
+                    return session.finish()
+                elif size == 0:
+                    # nothing to wait for, poll the line
+                    data, events = machine.feed(self.getc(1, 0) or b'')
+                    continue
+
+                char = self._getv(size, session.wait())
+                if char is None:
+                    data, events = session.timed_out()
+                else:
+                    data, events = session.read(char)
+        finally:
+            # a failing getc or putc leaves the machine unfinished
+            machine.close()
+
+    def _write_behind(self, stream, checkpoint, write_behind, fsync):
+        '''
+        Returns a :class:`WriteBehind` wrapper for the ``stream`` if writing
+        behind is enabled, or ``None``.
+        '''
+        if not write_behind or _buffer_view(stream) is not None:
+            return None
+        elif checkpoint is not None:
+            raise ValueError('write behind can not be combined with a '
+                             'checkpoint')
+        return WriteBehind(stream, fsync)
+
+    def _check_resume(self, checkpoint, compress, delta, digest):
+        '''
+        Compressed streams, delta transfers and digests can not be resumed
+        at an offset, as the state of the compressor, the delta or the digest
+        is lost.
+        '''
+        if checkpoint is None:
+            return
+        elif compress:
+            raise ValueError('compression can not be combined with a '
+                             'checkpoint')
+        elif delta:
+            raise ValueError('delta transfers can not be combined with a '
+                             'checkpoint')
+        elif digest is not None:
+            raise ValueError('a digest can not be combined with a '
+                             'checkpoint')
+
+    def _signature_sender(self, stream, retry):
+        '''
+        Returns a :class:`Sender` for the block signatures of the data in
+        ``stream``, the first part of receiving a delta transfer.
+        '''
+        signatures = Signatures.from_stream(stream)
+        log.info('sending %d block signatures' % (len(signatures),))
+        return Sender(signatures.pack(), self.mode, retry, stats=self.stats,
+                      delta=1)
+
+    def _delta_encoder(self, stream, data, digest=None):
+        '''
+        Returns a :class:`~xmodem.delta.DeltaEncoder` for the ``stream``,
+        against the block signatures received, or ``None`` if the signatures
+        are invalid.
+        '''
+        try:
+            signatures = Signatures.parse(data)
+        except ValueError as error:
+            log.error('invalid block signatures: %s' % (error,))
+            return None
+        log.info('received %d block signatures' % (len(signatures),))
+        if isinstance(stream, PreparedImage):
+            stream = stream.data
+        return DeltaEncoder(stream, signatures, digest=digest)
+
+    def _patched(self, patcher):
+        '''
+        Returns the size of the data rebuilt by a delta transfer, or ``None``
+        if the delta ended early.
+        '''
+        if patcher.size is None:
+            log.error('delta transfer ended early')
+        elif patcher.digest is not None:
+            self.stats.digest = patcher.digest.hexdigest()
+        return patcher.size
+
+    def _resume(self, stream, checkpoint, truncate=0):
+        '''
+        Returns a tuple of the sequence number and stream offset of the first
+        block, after the block recorded in the ``checkpoint`` journal.
+        '''
+        state = None
+        if checkpoint is not None:
+            state = checkpoint.load()
+        if state is None:
+            return 1, 0
+
+        sequence, offset = state
+        sequence = (sequence + 1) % 0x100
+        log.info('resuming at block %d, offset %d' % (sequence, offset))
+        if _buffer_view(stream) is not None:
+            # buffers are addressed by the offset of the transfer
+            if hasattr(stream, 'seek'):
+                stream.seek(stream.tell() + offset)
+            return sequence, offset
+        stream.seek(stream.tell() + offset)
+        if truncate:
+            stream.truncate()
+        return sequence, offset
+
+    def calc_checksum(self, data, checksum=0):
+        '''
+        Calculate the checksum for a given block of data, can also be used to
+        update a checksum.
+
+            >>> csum = modem.calc_checksum('hello')
+            >>> csum = modem.calc_checksum('world', csum)
+            >>> hex(csum)
+            '0x3c'
+
+        '''
+        return calc_checksum(data, checksum)
+
+    def calc_crc(self, data, crc=0):
+        '''
+        Calculate the Cyclic Redundancy Check for a given block of data, can
+        also be used to update a CRC.
+
+            >>> crc = modem.calc_crc('hello')
+            >>> crc = modem.calc_crc('world', crc)
+            >>> hex(crc)
+            '0xd5e3'
+
+        '''
+        return calc_crc(data, crc & 0xffff)
+
+
+class YMODEM(XMODEM):
+    '''
+    YMODEM batch protocol handler, sends and receives multiple files in one
+    session. Every file is preceded by a block with sequence number ``0``
+    holding the file name and size, an empty file name ends the batch.
+
+    >>> modem = YMODEM(getc, putc)
+    >>> modem.send(['/etc/fstab', '/etc/issue'])
+    True
+
+    '''
+
+    def __init__(self, getc, putc, mode='xmodem1k', progress_callback=None,
+                 event_callback=None, min_timeout=1, max_timeout=None):
+        super(YMODEM, self).__init__(getc, putc, mode, progress_callback,
+                                     event_callback, min_timeout, max_timeout)
+
+    def send(self, files, retry=16, timeout=60, quiet=0, prefetch=0):
+        '''
+        Send a batch of files via the YMODEM protocol. The files are given
+        as file names, or as tuples of a file name and a stream.
+
+            >>> print modem.send(['/etc/issue', ('motd', stream)])
+            True
+
+        Returns ``True`` upon succesful transmission or ``False`` in case of
+        failure. The ``stats`` cover the whole batch.
+        '''
+        self.stats = TransferStats()
+        for item in files:
+            if isinstance(item, tuple):
+                name, stream = item
+                result = self._send_file(name, stream, retry, timeout,
+                                         prefetch)
+            else:
+                stream = open(item, 'rb')
+                try:
+                    result = self._send_file(item, stream, retry, timeout,
+                                             prefetch)
+                finally:
+                    stream.close()
+
+            if not result:
+                return False
+
+        # an empty header ends the batch
+        machine = Sender(None, self.mode, retry, header=b'',
+                         stats=self.stats)
+        if not self._run(machine, timeout):
+            return False
+        return True
+
+    def _send_file(self, name, stream, retry, timeout, prefetch=0):
+        name = os.path.basename(name)
+        if not isinstance(name, bytes):
+            name = name.encode('latin-1')
+        header = name + b'\x00'
+        size = _stream_size(stream)
+        if size is not None:
+            header += ('%d' % (size,)).encode('ascii')
+
+        machine = Sender(stream, self.mode, retry, header=header,
+                         stats=self.stats, prefetch=prefetch)
+        return self._run(machine, timeout)
+
+    def recv(self, directory, crc_mode=1, retry=16, timeout=60, delay=1,
+             quiet=0, streaming=0):
+        '''
+        Receive a batch of files via the YMODEM protocol and store them in
+        ``directory``. Path components in the received file names are
+        ignored.
+
+            >>> print modem.recv('/tmp')
+            ['/tmp/issue', '/tmp/motd']
+
+        Returns the list of received file paths on success or ``None`` in case
+        of failure. The ``stats`` cover the whole batch.
+        '''
+        self.stats = TransferStats()
+        received = []
+        while True:
+            machine = Receiver(1, streaming, retry, header=1,
+                               stats=self.stats)
+            header = self._run(machine, timeout, delay)
+            if header is None:
+                return None
+
+            name, size = self._parse_header(header)
+            if not name:
+                # end of batch
+                return received
+
+            # request the file data
+            machine = Receiver(1, machine.streaming, retry, size,
+                               stats=self.stats)
+            path = os.path.join(directory, os.path.basename(name))
+            stream = open(path, 'wb')
+            try:
+                result = self._run(machine, timeout, delay, stream)
+            finally:
+                stream.close()
+
+            if result is None:
+                return None
+            received.append(path)
+
+    def _parse_header(self, data):
+        '''
+        Parse the block with sequence number ``0``, returns a tuple of the
+        file name and size. The size is ``None`` if the sender did not supply
+        one.
+        '''
+        name, _, info = data.partition(b'\x00')
+        if not isinstance(name, str):
+            name = name.decode('latin-1')
+        info = info.rstrip(b'\x00').split()
+        size = None
+        if info:
+            try:
+                size = int(info[0])
+            except ValueError:
+                log.warning('invalid file size %r in header' % (info[0],))
+        return name, size
+
+
+class PreparedImage(object):
+    '''
+    A stream framed once, to send the same image to many receivers. The
+    frames for each combination of checksum or CRC mode and block size are
+    built when first needed and stored back to back in one read-only
+    buffer, with an index of their offsets. Sessions share the image and
+    send its frames as they are, without reading, padding or checksumming
+    the blocks again.
+
+    >>> image = PreparedImage(open('firmware.bin', 'rb'))
+    >>> manager = TransferManager(workers=50)
+    >>> futures = [manager.send(port, transport, image, mode='xmodem1k')
+    ...            for port, transport in ports.items()]
+
+    The frames follow the sequence numbers of a transfer starting at the
+    first block. Blocks sent otherwise, like after falling back to 128 byte
+    blocks on a noisy line, are framed by the session as usual.
+    '''
+
+    def __init__(self, stream):
+        if hasattr(stream, 'read'):
+            stream = stream.read()
+        self.data = stream
+        self._layouts = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.data)
+
+    def frame(self, crc_mode, packet_size, sequence, offset):
+        '''
+        Returns the frame of the block at ``offset`` in the stream, sent with
+        the given mode and ``sequence`` number, as a ``memoryview`` on the
+        image, or ``None`` if the image does not hold that frame.
+        '''
+        offsets, positions, frames = self._layout(crc_mode, packet_size)
+        index = bisect.bisect_left(offsets, offset)
+        if (index >= len(positions) - 1 or offsets[index] != offset or
+                (index + 1) % 0x100 != sequence):
+            return None
+        return frames[positions[index]:positions[index + 1]]
+
+    def _layout(self, crc_mode, packet_size):
+        key = crc_mode, packet_size
+        layout = self._layouts.get(key)
+        if layout is None:
+            with self._lock:
+                layout = self._layouts.get(key)
+                if layout is None:
+                    layout = self._layouts[key] = self._prepare(*key)
+        return layout
+
+    def _prepare(self, crc_mode, packet_size):
+        '''
+        Frame the whole stream, returns the stream offsets of the blocks,
+        the positions of their frames and the frames.
+        '''
+        sender = Sender(self.data, 'xmodem1k' if packet_size == 1024
+                        else 'xmodem')
+        sender.crc_mode = crc_mode
+        buffers = {}
+        offsets = array('L', [0])
+        positions = array('L', [0])
+        frames = bytearray()
+        sequence = 1
+        while True:
+            block = sender._read_block(packet_size)
+            if block is None:
+                break
+            start, data, read = block
+            frames += sender._make_frame(buffers, start, sequence, data)
+            offsets.append(offsets[-1] + len(data))
+            positions.append(len(frames))
+            sequence = (sequence + 1) % 0x100
+        log.debug('prepared %d frames for %s mode, %d byte blocks' % \
+            (len(positions) - 1, 'CRC' if crc_mode else 'checksum',
+             packet_size))
+        return offsets, positions, memoryview(bytes(frames))
+
+
+class FrameReader(object):
+    '''
+    Read-ahead buffer for the receiving side of a transfer. Frames are
+    parsed from views on the buffer, without reading the line byte by byte.
+    The ``getc`` passed in waits up to its timeout for the bytes asked for,
+    so it is only asked for the bytes still missing. With ``read1``, a
+    callable taking the same arguments that returns as soon as some bytes
+    arrived, like :meth:`xmodem.transport.TTYTransport.read1`, the line is
+    read ahead in chunks of up to ``size`` bytes instead.
+
+    >>> transport = TTYTransport.open('/dev/ttyUSB0')
+    >>> reader = FrameReader(transport.getc, read1=transport.read1)
+    >>> modem = XMODEM(reader, transport.putc)
+
+    '''
+
+    def __init__(self, getc, size=4096, read1=None):
+        self.getc = getc
+        self.size = size
+        self.line_read1 = read1
+        self.buffer = bytearray(size * 2)
+        self.start = 0
+        self.end = 0
+
+    def __call__(self, size, timeout=1):
+        '''
+        Read ``size`` bytes, returns a string or ``None`` on timeout.
+        '''
+        view = self.getv(size, timeout)
+        if view is None:
+            return None
+        return view.tobytes()
+
+    def getv(self, size, timeout=1):
+        '''
+        Read ``size`` bytes, returns a ``memoryview`` on the buffer, which is
+        only valid until the next read, or ``None`` on timeout. On timeout the
+        bytes read so far stay buffered.
+        '''
+        while self.end - self.start < size:
+            if not self._fill(size - (self.end - self.start), timeout):
+                return None
+
+        view = memoryview(self.buffer)[self.start:self.start + size]
+        self.start += size
+        if self.start == self.end:
+            self.start = self.end = 0
+        return view
+
+    def read1(self, size, timeout=1):
+        '''
+        Read at most ``size`` bytes, with at most one read from the line if
+        nothing is buffered. Returns a ``memoryview`` on the buffer, which is
+        only valid until the next read, or ``None`` on timeout.
+        '''
+        if self.start == self.end and not self._fill(1, timeout):
+            return None
+        return self.getv(min(size, self.end - self.start), timeout)
+
+    def _fill(self, size, timeout):
+        '''
+        Pull the next chunk from the line into the buffer, ``size`` is the
+        number of bytes still missing.
+        '''
+        if self.end + max(size, self.size) > len(self.buffer):
+            pending = self.buffer[self.start:self.end]
+            if len(pending) + max(size, self.size) > len(self.buffer):
+                # outstanding views keep referencing the old buffer
+                self.buffer = bytearray(len(pending) + max(size, self.size))
+            self.buffer[:len(pending)] = pending
+            self.start, self.end = 0, len(pending)
+
+        if self.line_read1 is not None:
+            chunk = self.line_read1(len(self.buffer) - self.end, timeout)
+        else:
+            # asking for more would wait out the timeout every time
+            chunk = self.getc(size, timeout)
+        if not chunk:
+            return False
+
+        self.buffer[self.end:self.end + len(chunk)] = chunk
+        self.end += len(chunk)
+        return True
+
+
+class Checkpoint(object):
+    '''
+    Journal of the last block of a transfer that is known to have arrived,
+    kept in a small sidecar file. The ``key`` identifies the transfer, a
+    journal recorded for another key is ignored.
+
+    >>> stream = open('firmware.bin', 'rb')
+    >>> checkpoint = Checkpoint('firmware.bin.journal', 'firmware.bin')
+    >>> modem.send(stream, checkpoint=checkpoint)
+    True
+
+    The journal is removed once the transfer completes.
+    '''
+
+    def __init__(self, path, key=''):
+        self.path = path
+        self.key = str(key).replace('\n', ' ')
+        self.journal = None
+
+    def load(self):
+        '''
+        Returns a tuple of the sequence number and stream offset of the last
+        recorded block, or ``None`` if there is no journal for this transfer.
+        '''
+        try:
+            journal = open(self.path, 'r')
+            try:
+                lines = journal.read().split('\n')
+            finally:
+                journal.close()
+        except (IOError, OSError):
+            return None
+
+        if len(lines) < 2 or lines[0] != self.key:
+            log.warning('ignoring journal %s of another transfer' % \
+                (self.path,))
+            return None
+
+        try:
+            sequence, offset = [int(field) for field in lines[1].split()]
+        except ValueError:
+            log.warning('ignoring damaged checkpoint journal %s' % \
+                (self.path,))
+            return None
+        return sequence, offset
+
+    def save(self, sequence, offset):
+        '''
+        Record the block with the given sequence number, ending at ``offset``
+        in the stream. The record has a fixed size and is overwritten in
+        place.
+        '''
+        if self.journal is None:
+            self.journal = open(self.path, 'w')
+            self.journal.write(self.key + '\n')
+            self.record = self.journal.tell()
+
+        self.journal.seek(self.record)
+        self.journal.write('%03d %020d\n' % (sequence, offset))
+        self.journal.flush()
+
+    def clear(self):
+        '''
+        Remove the journal.
+        '''
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+class WriteBehind(object):
+    '''
+    Stream wrapper for the receiving side, writing behind the transfer. The
+    data of accepted blocks is collected in memory and handed to a
+    background thread in ``chunk`` sized writes, so blocks are acknowledged
+    without waiting for the disk. At most ``depth`` chunks wait to be
+    written, after that the transfer waits for the disk after all.
+
+    >>> stream = WriteBehind(open('firmware.bin', 'wb'), fsync='eot')
+    >>> modem.recv(stream)
+    2342
+    >>> stream.finish()
+
+    The ``fsync`` policy sets when the data is synced to disk: never with
+    ``None``, once all data is written with ``'eot'``, or every time that
+    number of bytes has been written. An error writing the stream is raised
+    by the next call to :meth:`write`, :meth:`flush` or :meth:`finish`.
+    The wrapped stream is not closed.
+    '''
+
+    def __init__(self, stream, fsync=None, chunk=65536, depth=16):
+        if fsync not in (None, 'eot') and not isinstance(fsync, int):
+            raise ValueError('unknown fsync policy %r' % (fsync,))
+        self.stream = stream
+        self.fsync = fsync
+        self.chunk = chunk
+        self.error = None
+        self._buffer = bytearray()
+        self._queue = queue.Queue(depth)
+        self._unsynced = 0
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def write(self, data):
+        '''
+        Queue ``data`` to be written.
+        '''
+        self._check()
+        self._buffer += data
+        if len(self._buffer) >= self.chunk:
+            self._queue.put(self._buffer)
+            self._buffer = bytearray()
+        return len(data)
+
+    def flush(self):
+        '''
+        Wait until all queued data is written to the stream.
+        '''
+        self._check()
+        if self._buffer:
+            self._queue.put(self._buffer)
+            self._buffer = bytearray()
+        self._queue.join()
+        self._check()
+
+    def finish(self):
+        '''
+        Write all queued data, sync it to disk if the policy asks for it and
+        stop the background thread. Safe to call more than once.
+        '''
+        if self._thread is None:
+            self._check()
+            return
+        try:
+            self.flush()
+            if self.fsync is not None:
+                self._sync()
+        finally:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def _check(self):
+        if self.error is not None:
+            raise self.error
+
+    def _run(self):
+        while True:
+            chunk = self._queue.get()
+            try:
+                if chunk is None:
+                    return
+                elif self.error is None:
+                    self._write(chunk)
+            except Exception as error:
+                log.error('write behind failed: %s' % (error,))
+                self.error = error
+            finally:
+                self._queue.task_done()
+
+    def _write(self, chunk):
+        self.stream.write(chunk)
+        self._unsynced += len(chunk)
+        if self.fsync not in (None, 'eot') and self._unsynced >= self.fsync:
+            self._sync()
+
+    def _sync(self):
+        self._unsynced = 0
+        self.stream.flush()
+        try:
+            fileno = self.stream.fileno()
+        except (AttributeError, IOError, OSError, ValueError):
+            # not backed by a file
+            return
+        os.fsync(fileno)
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
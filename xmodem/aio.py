@@ -0,0 +1,184 @@
+'''
+==============================
+ XMODEM transfers over asyncio
+==============================
+
+:class:`AsyncXMODEM` speaks the same protocol as :class:`xmodem.XMODEM`, but
+its ``send`` and ``recv`` methods are coroutines, awaiting the ``getc`` and
+``putc`` callables instead of blocking on them. Many transfers can thus share
+a single event loop, and a single thread, instead of one thread per line.
+
+Usage
+=====
+
+Either pass coroutine functions to get and put character data::
+
+    >>> async def getc(size, timeout=1):
+    ...     return data or None
+    ...
+    >>> async def putc(data, timeout=1):
+    ...     return size or None
+    ...
+    >>> modem = AsyncXMODEM(getc, putc)
+
+or wrap an asyncio stream pair::
+
+    >>> reader, writer = await asyncio.open_connection(host, port)
+    >>> modem = AsyncXMODEM.from_streams(reader, writer)
+    >>> await modem.send(open('/etc/fstab', 'rb'))
+    True
+
+This module requires Python 3.
+'''
+
+import asyncio
+
+from xmodem import XMODEM, Done, Aborted, _Session, CAN
+
+
+def stream_transport(reader, writer):
+    '''
+    Create a pair of ``getc`` and ``putc`` coroutine functions on top of an
+    asyncio :class:`~asyncio.StreamReader` and :class:`~asyncio.StreamWriter`.
+    Timeouts are enforced with :func:`asyncio.wait_for`, a ``timeout`` of
+    ``0`` only returns data that is already buffered.
+    '''
+
+    async def getc(size, timeout=1):
+        read = asyncio.ensure_future(reader.readexactly(size))
+        if timeout == 0:
+            # poll, give the read a single chance to complete
+            await asyncio.sleep(0)
+            if not read.done():
+                read.cancel()
+                return None
+        try:
+            return await asyncio.wait_for(read, timeout)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError):
+            return None
+
+    async def putc(data, timeout=1):
+        # the writer may hold on to the data, frames are reused buffers
+        writer.write(bytes(data))
+        try:
+            await asyncio.wait_for(writer.drain(), timeout)
+        except asyncio.TimeoutError:
+            return None
+        return len(data)
+
+    return getc, putc
+
+
+class AsyncXMODEM(XMODEM):
+    '''
+    XMODEM protocol implementation for asyncio, expects coroutine functions
+    for ``getc`` and ``putc``. The ``send`` and ``recv`` coroutines take the
+    same arguments and return the same results as their :class:`XMODEM`
+    counterparts.
+    '''
+
+    @classmethod
+    def from_streams(cls, reader, writer, mode='xmodem', **kwargs):
+        '''
+        Create a modem talking over an asyncio stream pair, the keyword
+        arguments are passed on to the constructor.
+        '''
+        getc, putc = stream_transport(reader, writer)
+        return cls(getc, putc, mode, **kwargs)
+
+    async def abort(self, count=2, timeout=60):
+        '''
+        Send an abort sequence using CAN bytes.
+        '''
+        for counter in range(0, count):
+            await self.putc(CAN, timeout)
+
+    async def send(self, stream, retry=16, timeout=60, quiet=0,
+                   checkpoint=None, prefetch=0, compress=0, level=6,
+                   flush=None, delta=0, digest=None, adaptive=1):
+        '''
+        Send a stream via the XMODEM protocol.
+
+            >>> stream = open('/etc/issue', 'rb')
+            >>> print(await modem.send(stream))
+            True
+
+        Returns ``True`` upon succesful transmission or ``False`` in case of
+        failure.
+        '''
+        return await self._drive(self._send_steps(
+            stream, retry, timeout, checkpoint, prefetch, compress, level,
+            flush, delta, digest, adaptive))
+
+    async def recv(self, stream, crc_mode=1, retry=16, timeout=60, delay=1,
+                   quiet=0, streaming=0, checkpoint=None, write_behind=0,
+                   fsync=None, compress=0, delta=0, size=None,
+                   digest=None):
+        '''
+        Receive a stream via the XMODEM protocol.
+
+            >>> stream = open('/etc/issue', 'wb')
+            >>> print(await modem.recv(stream))
+            2342
+
+        Returns the number of bytes received on success or ``None`` in case of
+        failure.
+        '''
+        return await self._drive(self._recv_steps(
+            stream, crc_mode, retry, timeout, delay, streaming, checkpoint,
+            write_behind, fsync, compress, delta, size, digest))
+
+    async def _drive(self, steps):
+        '''
+        Carry out the steps of a transfer laid out by :class:`XMODEM` with
+        the ``getc`` and ``putc`` coroutines.
+        '''
+        step = next(steps)
+        while not isinstance(step, Done):
+            try:
+                if isinstance(step, Aborted):
+                    result = await self.abort()
+                else:
+                    result = await self._run(*step)
+            except Exception as error:
+                step = steps.throw(error)
+            else:
+                step = steps.send(result)
+        steps.close()
+        return step.result
+
+    async def _run(self, machine, timeout, delay=0, stream=None,
+                   checkpoint=None):
+        '''
+        Drive a :class:`~xmodem.Sender` or :class:`~xmodem.Receiver` state
+        machine with the ``getc`` and ``putc`` coroutines.
+        '''
+        session = _Session(self, machine, timeout, stream, checkpoint)
+        try:
+            data, events = machine.start()
+            while True:
+                if events:
+                    session.handle(events)
+                if data:
+                    if not await self.putc(data) and delay:
+                        await asyncio.sleep(delay)
+                    session.wrote()
+
+                size = machine.expect
+                if size is None:
+                    return session.finish()
+                elif size == 0:
+                    # nothing to wait for, poll the line
+                    data, events = machine.feed(await self.getc(1, 0) or
+                                                b'')
+                    continue
+
+                char = await self.getc(size, session.wait())
+                if char is None:
+                    data, events = session.timed_out()
+                else:
+                    data, events = session.read(char)
+        finally:
+            # a failing or cancelled getc or putc leaves the machine
+            # unfinished
+            machine.close()
@@ -0,0 +1,204 @@
+'''
+========================
+ Command line transfers
+========================
+
+The ``xmodem`` command sends and receives a file over a serial port, a
+pseudo terminal or any other file descriptor, so there is no need to write a
+wrapper script around :class:`xmodem.XMODEM` for every job::
+
+    $ xmodem send --line /dev/ttyUSB0 --baud 115200 --mode 1k firmware.bin
+    $ xmodem recv --line /dev/ttyUSB0 --mode crc --size 65536 dump.bin
+
+Use ``-`` as the file to read the data from standard input or write it to
+standard output, the data is passed on block by block, so large pipelines
+never hold a whole file in memory. The line may be inherited from the shell
+as a file descriptor::
+
+    $ tar c config | xmodem send --fd 3 --mode 1k - 3<>/dev/ttyS0
+    $ xmodem recv --fd 3 --mode g - 3<>/dev/ttyS0 | tar x
+
+The receiver picks checksum or CRC mode and streaming, with the ``--mode``
+of ``recv``. The ``--mode`` of ``send`` only selects the block size, which
+``--block-size`` overrides. A summary of the transfer is printed to standard
+error at the end, the exit status is ``0`` if the transfer succeeded.
+'''
+
+import argparse
+import logging
+import os
+import sys
+
+from xmodem import XMODEM
+from xmodem.transport import TTYTransport
+
+
+log = logging.getLogger('xmodem.cli')
+
+# sending mode, CRC mode and streaming of the receiver per mode
+MODES = {
+    'checksum': ('xmodem', 0, 0),
+    'crc': ('xmodem', 1, 0),
+    '1k': ('xmodem1k', 1, 0),
+    'g': ('xmodem1k', 1, 1),
+}
+
+
+def main(argv=None):
+    '''
+    Run the ``xmodem`` command with the arguments in ``argv``, returns the
+    exit status.
+    '''
+    parser = _parser()
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.print_usage(sys.stderr)
+        return 2
+    elif args.fd in (0, 1) and args.file == '-':
+        parser.error('the line and the data can not both use stdin/stdout')
+    elif args.delta and args.file == '-':
+        parser.error('delta transfers need a file')
+
+    logging.basicConfig(format='xmodem: %(message)s',
+                        level=[logging.WARNING, logging.INFO,
+                               logging.DEBUG][min(args.verbose, 2)])
+    try:
+        if args.line is not None:
+            transport = TTYTransport.open(args.line, baudrate=args.baud)
+        else:
+            transport = TTYTransport(args.fd, raw=os.isatty(args.fd),
+                                     baudrate=args.baud)
+    except (IOError, OSError, ValueError) as error:
+        sys.stderr.write('xmodem: %s\n' % (error,))
+        return 1
+
+    try:
+        with transport:
+            if args.command == 'send':
+                result = _send(args, transport)
+            else:
+                result = _recv(args, transport)
+    except (IOError, OSError, ValueError) as error:
+        sys.stderr.write('xmodem: %s\n' % (error,))
+        return 1
+    except KeyboardInterrupt:
+        return 130
+    return 0 if result else 1
+
+
+def _parser():
+    parser = argparse.ArgumentParser(
+        prog='xmodem', description='Send or receive a file using XMODEM.')
+    commands = parser.add_subparsers(dest='command')
+    for name, help in (('send', 'send a file, - for stdin'),
+                       ('recv', 'receive a file, - for stdout')):
+        command = commands.add_parser(name, help=help)
+        command.add_argument('file', help=help)
+        line = command.add_mutually_exclusive_group(required=True)
+        line.add_argument('-l', '--line', metavar='PATH',
+                          help='serial port or terminal to transfer over')
+        line.add_argument('--fd', type=int,
+                          help='inherited file descriptor to transfer over')
+        command.add_argument('--baud', type=int,
+                             help='baud rate of the line')
+        command.add_argument('-m', '--mode', choices=sorted(MODES),
+                             default='crc',
+                             help='transfer mode (default: %(default)s)')
+        command.add_argument('-t', '--timeout', type=float, default=60,
+                             help='seconds to wait for the other side '
+                                  '(default: %(default)s)')
+        command.add_argument('-r', '--retry', type=int, default=16,
+                             help='errors before giving up '
+                                  '(default: %(default)s)')
+        command.add_argument('-z', '--compress', action='store_true',
+                             help='compress the data, if the other side '
+                                  'runs this library as well')
+        command.add_argument('--delta', action='store_true',
+                             help='only transfer what changed from the '
+                                  'copy the receiver has')
+        command.add_argument('--digest', metavar='NAME',
+                             help='print the sha256, crc32 or other digest '
+                                  'of the data')
+        command.add_argument('-v', '--verbose', action='count', default=0,
+                             help='log more, may be repeated')
+        if name == 'send':
+            command.add_argument('-b', '--block-size', type=int,
+                                 choices=(128, 1024),
+                                 help='block size, instead of the one of '
+                                      'the mode')
+            command.add_argument('--prefetch', type=int, default=0,
+                                 metavar='BLOCKS',
+                                 help='blocks to read ahead of the line')
+        else:
+            command.add_argument('-s', '--size', type=int,
+                                 help='size of the file, to drop the '
+                                      'padding of the last block')
+    return parser
+
+
+def _send(args, transport):
+    mode = MODES[args.mode][0]
+    if args.block_size is not None:
+        mode = 'xmodem1k' if args.block_size == 1024 else 'xmodem'
+    modem = XMODEM(transport.getc, transport.putc, mode)
+    if args.file == '-':
+        stream = getattr(sys.stdin, 'buffer', sys.stdin)
+    else:
+        stream = open(args.file, 'rb')
+    try:
+        result = modem.send(stream, args.retry, args.timeout,
+                            prefetch=args.prefetch, compress=args.compress,
+                            delta=args.delta, digest=args.digest)
+    finally:
+        if args.file != '-':
+            stream.close()
+    _summary('sent', modem.stats, result)
+    return result
+
+
+def _recv(args, transport):
+    mode, crc_mode, streaming = MODES[args.mode]
+    modem = XMODEM(transport.getc, transport.putc, mode)
+    if args.file == '-':
+        stream = getattr(sys.stdout, 'buffer', sys.stdout)
+    elif args.delta:
+        # the copy already there is updated in place
+        if not os.path.exists(args.file):
+            open(args.file, 'wb').close()
+        stream = open(args.file, 'r+b')
+    else:
+        stream = open(args.file, 'wb')
+    try:
+        result = modem.recv(stream, crc_mode, args.retry, args.timeout,
+                            streaming=streaming and not args.compress,
+                            compress=args.compress, delta=args.delta,
+                            size=args.size, digest=args.digest)
+    finally:
+        if args.file == '-':
+            stream.flush()
+        else:
+            stream.close()
+    _summary('received', modem.stats, result is not None)
+    return result is not None
+
+
+def _summary(verb, stats, result):
+    '''
+    Print the throughput and the errors of the transfer to stderr.
+    '''
+    if stats is None:
+        return
+    sys.stderr.write(
+        '%s %d bytes in %.1f s, %.1f bytes/s, %d retransmits, %d NAKs, '
+        '%d timeouts%s\n' % (
+            verb if result else 'failed after', stats.bytes, stats.elapsed,
+            stats.bytes_per_second, stats.retransmits, stats.naks,
+            stats.timeouts,
+            ', %d uncompressed' % (stats.uncompressed,)
+            if stats.compressed else ''))
+    if stats.digest is not None and result:
+        sys.stderr.write('%s digest %s\n' % (verb, stats.digest))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,382 @@
+'''
+=================
+ Delta transfers
+=================
+
+Sending an image to a device that already has a slightly different version
+of it only needs to carry the parts that changed. The receiver describes
+its copy with :class:`Signatures`, a rolling weak checksum and a strong
+digest for every block. The sender looks for those blocks in the new data
+at every byte offset, and sends a :class:`DeltaEncoder` stream of
+instructions: copy a run of blocks from the old copy, or insert the literal
+data in between. The receiver rebuilds the data in place with a
+:class:`DeltaPatcher`.
+
+    >>> signatures = Signatures.from_stream(open('old.bin', 'rb'))
+    >>> delta = DeltaEncoder(open('new.bin', 'rb'), signatures)
+    >>> patcher = DeltaPatcher(open('old.bin', 'r+b'))
+    >>> patcher.write(delta.read(65536))
+    >>> patcher.size
+    1048576
+
+:meth:`xmodem.XMODEM.send` and :meth:`xmodem.XMODEM.recv` do all of this
+with the ``delta`` argument, exchanging the signatures as an XMODEM
+transfer from the receiver to the sender first.
+
+The signature stream starts with the block size and the number of blocks
+as two big endian 32 bit integers, followed by the Adler-32 checksum and
+the first 8 bytes of the SHA-256 digest of each block. The instructions are
+a single byte followed by big endian integers:
+
+=====  ======================  ===========================================
+``L``  length (32 bit)         insert the ``length`` bytes that follow
+``C``  offset (64 bit), length copy ``length`` bytes of the old copy
+       (32 bit)                at ``offset``
+``E``  size (64 bit)           the data is complete and ``size`` bytes
+=====  ======================  ===========================================
+
+Anything after the ``E`` instruction, like the padding of the last block of
+a transfer, is ignored. As the data is rebuilt in place, blocks are only
+copied from offsets that have not been written yet, blocks moved towards the
+end of the data are sent again.
+'''
+
+import hashlib
+import io
+import logging
+import math
+import struct
+import zlib
+
+
+log = logging.getLogger('xmodem.delta')
+
+# Modulus of the Adler-32 checksum
+_ADLER = 65521
+
+_SIGNATURES = struct.Struct('>II')
+_BLOCK = struct.Struct('>I8s')
+_LITERAL = struct.Struct('>cI')
+_COPY = struct.Struct('>cQI')
+_END = struct.Struct('>cQ')
+
+
+def block_size(size, minimum=512, maximum=65536):
+    '''
+    Pick the block size for data of ``size`` bytes, the power of two
+    nearest to its square root, which balances the size of the signatures
+    against the data sent again for every changed byte.
+    '''
+    if size <= 0:
+        return minimum
+    size = 1 << int(round(math.log(math.sqrt(size), 2)))
+    return max(minimum, min(maximum, size))
+
+
+def _strong(data):
+    return hashlib.sha256(data).digest()[:8]
+
+
+class Signatures(object):
+    '''
+    The checksums of the blocks of ``block_size`` bytes of some data, as a
+    list of tuples of the weak and strong checksum of each block. A short
+    block at the end of the data has no signature, it is always sent again.
+    '''
+
+    def __init__(self, block_size, blocks):
+        self.block_size = block_size
+        self.blocks = blocks
+        # offsets and strong checksums by weak checksum, in block order
+        self.table = {}
+        for index, (weak, strong) in enumerate(blocks):
+            self.table.setdefault(weak, []).append((index * block_size,
+                                                    strong))
+
+    def __len__(self):
+        return len(self.blocks)
+
+    @classmethod
+    def from_stream(cls, stream, size=None):
+        '''
+        Read the data left in ``stream`` and compute its signatures, the
+        stream is rewound afterwards. The block size is picked for the size
+        of the data, unless given as ``size``.
+        '''
+        offset = stream.tell()
+        if size is None:
+            stream.seek(0, 2)
+            size = block_size(stream.tell() - offset)
+            stream.seek(offset)
+        blocks = []
+        try:
+            while True:
+                data = stream.read(size)
+                if len(data) < size:
+                    break
+                blocks.append((zlib.adler32(data) & 0xffffffff,
+                               _strong(data)))
+        finally:
+            stream.seek(offset)
+        return cls(size, blocks)
+
+    @classmethod
+    def parse(cls, data):
+        '''
+        Parse signatures packed by :meth:`pack`, trailing data is ignored.
+        Raises :class:`ValueError` if the data is cut short.
+        '''
+        if len(data) < _SIGNATURES.size:
+            raise ValueError('signatures cut short')
+        size, count = _SIGNATURES.unpack_from(data)
+        if not size or len(data) < _SIGNATURES.size + count * _BLOCK.size:
+            raise ValueError('signatures cut short')
+        blocks = [
+            _BLOCK.unpack_from(data, _SIGNATURES.size + index * _BLOCK.size)
+            for index in range(count)
+        ]
+        return cls(size, blocks)
+
+    def pack(self):
+        '''
+        Returns the signatures as a string, to send to the other side.
+        '''
+        return _SIGNATURES.pack(self.block_size, len(self.blocks)) + \
+            b''.join(_BLOCK.pack(weak, strong) for weak, strong in self.blocks)
+
+    def find(self, weak, data, minimum=0):
+        '''
+        Returns the offset of the first block at or after ``minimum`` that
+        holds ``data`` with the weak checksum ``weak``, or ``None``.
+        '''
+        candidates = self.table.get(weak)
+        if candidates is None:
+            return None
+        strong = _strong(data)
+        for offset, digest in candidates:
+            if offset >= minimum and digest == strong:
+                return offset
+        return None
+
+
+class DeltaEncoder(object):
+    '''
+    Stream of the instructions to rebuild the data read from ``stream`` out
+    of the copy described by ``signatures``. The stream is read ``chunk``
+    bytes at a time, literal data is sent in instructions of at most that
+    size, so memory use stays bounded. The number of bytes copied and sent
+    as literal data are counted in ``copied`` and ``literal``. The data read
+    is added to the running ``digest``, if any.
+    '''
+
+    def __init__(self, stream, signatures, chunk=65536, digest=None):
+        if not hasattr(stream, 'read'):
+            stream = io.BytesIO(stream)
+        self.stream = stream
+        self.signatures = signatures
+        self.chunk = max(chunk, signatures.block_size)
+        self.digest = digest
+        self.copied = 0
+        self.literal = 0
+        self._window = bytearray()
+        # stream offset of the window, the window index of the block being
+        # looked up and the index where the literal data not yet sent starts
+        self._offset = 0
+        self._scan = 0
+        self._pending = 0
+        self._weak = None
+        self._copy = None
+        self._eof = 0
+        self._done = 0
+        self._buffer = bytearray()
+
+    def read(self, size):
+        while len(self._buffer) < size and not self._done:
+            self._step()
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def _step(self):
+        size = self.signatures.block_size
+        window = self._window
+        if len(window) - self._scan <= size and not self._eof:
+            # a block and the byte after it to roll on with
+            data = self.stream.read(self.chunk)
+            if data:
+                window += data
+                if self.digest is not None:
+                    self.digest.update(data)
+            else:
+                self._eof = 1
+            return
+        if len(window) - self._scan < size:
+            # the tail is too short to be a block
+            self._end()
+            return
+
+        table = self.signatures.table
+        scan = self._scan
+        weak = self._weak
+        if weak is None:
+            weak = zlib.adler32(bytes(window[scan:scan + size])) & 0xffffffff
+        end = min(len(window) - size, self._pending + self.chunk)
+        source = None
+        while True:
+            if weak in table:
+                source = self.signatures.find(
+                    weak, window[scan:scan + size], self._offset + scan)
+                if source is not None:
+                    break
+            if scan >= end:
+                break
+            # roll the checksum on by one byte
+            old, new = window[scan], window[scan + size]
+            low = (weak & 0xffff) - old + new
+            high = (weak >> 16) - size * old + low - 1
+            weak = ((high % _ADLER) << 16) | (low % _ADLER)
+            scan += 1
+
+        self._scan = scan
+        if source is None:
+            self._weak = weak
+            if self._eof and scan == len(window) - size:
+                # no block matches the end of the stream
+                self._end()
+            elif scan - self._pending >= self.chunk:
+                self._emit_literal()
+                self._trim()
+            return
+
+        self._emit_literal()
+        if self._copy is not None and sum(self._copy) == source:
+            self._copy[1] += size
+        else:
+            self._emit_copy()
+            self._copy = [source, size]
+        self._scan = self._pending = scan + size
+        self._weak = None
+        self._trim()
+
+    def _end(self):
+        self._scan = len(self._window)
+        self._emit_literal()
+        self._emit_copy()
+        self._buffer += _END.pack(b'E', self._offset + len(self._window))
+        self._done = 1
+
+    def _emit_literal(self):
+        data = self._window[self._pending:self._scan]
+        if data:
+            self._emit_copy()
+            self._buffer += _LITERAL.pack(b'L', len(data))
+            self._buffer += data
+            self.literal += len(data)
+        self._pending = self._scan
+
+    def _emit_copy(self):
+        if self._copy is not None:
+            self._buffer += _COPY.pack(b'C', *self._copy)
+            self.copied += self._copy[1]
+            self._copy = None
+
+    def _trim(self):
+        # drop the data sent from the window once in a while
+        if self._pending >= self.chunk:
+            del self._window[:self._pending]
+            self._offset += self._pending
+            self._scan -= self._pending
+            self._pending = 0
+
+
+class DeltaPatcher(object):
+    '''
+    Writable stream applying the instructions of a :class:`DeltaEncoder` to
+    the copy in ``stream``, starting at its current position. The stream
+    has to be opened for updating, using mode ``r+b``. Blocks copied to the
+    offset they are at are left alone. Once the data is complete its
+    ``size`` is set and the stream is truncated to it. Invalid instructions
+    raise :class:`ValueError`. The data rebuilt is added to the running
+    ``digest``, if any, reading back the blocks that were left alone.
+    '''
+
+    def __init__(self, stream, chunk=65536, digest=None):
+        self.stream = stream
+        self.chunk = chunk
+        self.digest = digest
+        self.size = None
+        self._base = stream.tell()
+        self._position = 0
+        self._literal = 0
+        self._buffer = bytearray()
+
+    def write(self, data):
+        if self.size is not None:
+            # the padding of the last block
+            return len(data)
+        self._buffer += data
+        while self._buffer and self.size is None:
+            if self._literal:
+                part = self._buffer[:self._literal]
+                del self._buffer[:len(part)]
+                self._literal -= len(part)
+                self._put(part)
+                continue
+
+            kind = bytes(self._buffer[:1])
+            instruction = {b'L': _LITERAL, b'C': _COPY, b'E': _END}.get(kind)
+            if instruction is None:
+                raise ValueError('invalid delta instruction %r' % (kind,))
+            elif len(self._buffer) < instruction.size:
+                break
+            fields = instruction.unpack_from(self._buffer)
+            del self._buffer[:instruction.size]
+            if kind == b'L':
+                self._literal = fields[1]
+            elif kind == b'C':
+                self._copy(*fields[1:])
+            else:
+                self._end(fields[1])
+        return len(data)
+
+    def _put(self, data):
+        self.stream.seek(self._base + self._position)
+        self.stream.write(data)
+        self._position += len(data)
+        if self.digest is not None:
+            self.digest.update(data)
+
+    def _copy(self, offset, length):
+        if offset < self._position:
+            raise ValueError('copy from offset %d, already overwritten' % \
+                (offset,))
+        elif offset == self._position and self.digest is None:
+            # unchanged
+            self._position += length
+            return
+        end = offset + length
+        while offset < end:
+            self.stream.seek(self._base + offset)
+            data = self.stream.read(min(self.chunk, end - offset))
+            if not data:
+                raise ValueError('copy from offset %d, past the end' % \
+                    (offset,))
+            elif offset == self._position:
+                # unchanged, only read for the digest
+                self._position += len(data)
+                self.digest.update(data)
+            else:
+                self._put(data)
+            offset += len(data)
+
+    def _end(self, size):
+        if size != self._position:
+            raise ValueError('delta ends at %d, expected %d' % \
+                (self._position, size))
+        self.stream.seek(self._base + size)
+        if hasattr(self.stream, 'truncate'):
+            self.stream.truncate()
+        self.size = size
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
@@ -0,0 +1,277 @@
+'''
+=========================
+ Multi-port transfer jobs
+=========================
+
+:class:`TransferManager` runs send and receive jobs for many ports on a
+bounded pool of worker threads, instead of a hand written thread per port.
+Each job is bound to a transport, a tuple of the ``getc`` and ``putc``
+callables of its port, and its result comes back as a
+:class:`concurrent.futures.Future`.
+
+    >>> manager = TransferManager(workers=8)
+    >>> futures = [
+    ...     manager.send(port, (getc, putc), open('firmware.bin', 'rb'),
+    ...                  mode='xmodem1k', retries=2)
+    ...     for port, (getc, putc) in ports.items()
+    ... ]
+    >>> [future.result() for future in futures]
+    [True, True, ...]
+    >>> manager.progress()
+    {'jobs': 24, 'pending': 0, 'running': 0, 'done': 24, 'failed': 0, ...}
+    >>> manager.shutdown()
+
+Jobs with a higher ``priority`` are started first. At most ``port_limit``
+jobs run on the same port at a time, one by default, as a serial line can
+only carry a single transfer. A failed job is retried up to ``retries``
+times, waiting ``backoff`` seconds before the first retry and doubling the
+wait for every next one. Streams are rewound to where the job started, or
+resume where they left off when a ``checkpoint`` journal is passed along.
+
+This module requires :mod:`concurrent.futures`, available in Python 3 and as
+the ``futures`` package for Python 2.
+'''
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+from concurrent.futures import Future
+
+from xmodem import XMODEM
+
+
+log = logging.getLogger('xmodem.manager')
+
+
+class TransferJob(object):
+    '''
+    A transfer waiting for, or running on, a worker of the
+    :class:`TransferManager`.
+    '''
+
+    def __init__(self, port, transport, method, args, kwargs, modem=XMODEM,
+                 mode='xmodem', priority=0, retries=0, backoff=1.0):
+        self.port = port
+        self.transport = transport
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        self.modem = modem
+        self.mode = mode
+        self.priority = priority
+        self.retries = retries
+        self.backoff = backoff
+        self.attempts = 0
+        self.bytes = 0
+        self.future = Future()
+        # streams are rewound to this position before a retry
+        self.position = None
+        if args and hasattr(args[0], 'seek'):
+            try:
+                self.position = args[0].tell()
+            except (IOError, OSError):
+                pass
+
+    def run(self, counter):
+        '''
+        Run a single attempt of the transfer, returns its result.
+        '''
+        self.attempts += 1
+        if self.position is not None and self.attempts > 1:
+            self.args[0].seek(self.position)
+
+        getc, putc = self.transport
+        modem = self.modem(getc, putc, self.mode)
+        try:
+            return getattr(modem, self.method)(*self.args, **self.kwargs)
+        finally:
+            # the bytes of the blocks acknowledged, failed attempts included
+            if getattr(modem, 'stats', None) is not None:
+                counter(self, modem.stats.bytes)
+
+
+class TransferManager(object):
+    '''
+    Schedule transfer jobs on ``workers`` threads, running at most
+    ``port_limit`` jobs per port at the same time. Limits for individual
+    ports can be set in the ``port_limits`` mapping.
+    '''
+
+    def __init__(self, workers=4, port_limit=1, port_limits=None):
+        self.workers = workers
+        self.port_limit = port_limit
+        self.port_limits = dict(port_limits or {})
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._queue = []
+        self._order = itertools.count()
+        self._threads = []
+        self._active = {}
+        self._shutdown = 0
+        self._jobs = 0
+        self._running = 0
+        self._done = 0
+        self._failed = 0
+        self._bytes = 0
+        self._started = None
+
+    def send(self, port, transport, stream, **kwargs):
+        '''
+        Queue a job sending ``stream`` on ``port``, returns a future for the
+        result of :meth:`XMODEM.send`. The keyword arguments are passed to
+        :meth:`submit`.
+        '''
+        return self.submit(port, transport, 'send', stream, **kwargs)
+
+    def recv(self, port, transport, stream, **kwargs):
+        '''
+        Queue a job receiving ``stream`` on ``port``, returns a future for the
+        result of :meth:`XMODEM.recv`. The keyword arguments are passed to
+        :meth:`submit`.
+        '''
+        return self.submit(port, transport, 'recv', stream, **kwargs)
+
+    def submit(self, port, transport, method, *args, **kwargs):
+        '''
+        Queue a job calling ``method`` of a modem talking over ``transport``.
+        The ``modem`` class, its ``mode``, and the ``priority``, ``retries``
+        and ``backoff`` of the job are taken from the keyword arguments, the
+        other arguments are passed on to the modem method.
+        '''
+        options = {}
+        for name in ('modem', 'mode', 'priority', 'retries', 'backoff'):
+            if name in kwargs:
+                options[name] = kwargs.pop(name)
+        job = TransferJob(port, transport, method, args, kwargs, **options)
+
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError('cannot submit jobs after shutdown')
+            self._jobs += 1
+            self._push(job, 0)
+            if len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._worker)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+        return job.future
+
+    def progress(self):
+        '''
+        Returns a dictionary with the number of jobs, the number of jobs
+        pending, running, done and failed, the number of bytes transferred and
+        the throughput in bytes per second since the first job started. The
+        bytes of a job are counted from its ``stats`` once it ran, they are
+        those of the blocks acknowledged, padding included.
+        '''
+        with self._lock:
+            elapsed = 0.0
+            if self._started is not None:
+                elapsed = time.time() - self._started
+            return {
+                'jobs': self._jobs,
+                'pending': self._jobs - self._running - self._done -
+                           self._failed,
+                'running': self._running,
+                'done': self._done,
+                'failed': self._failed,
+                'bytes': self._bytes,
+                'elapsed': elapsed,
+                'throughput': self._bytes / elapsed if elapsed else 0.0,
+            }
+
+    def shutdown(self, wait=True):
+        '''
+        Stop the workers once the queued jobs are finished.
+        '''
+        with self._lock:
+            self._shutdown = 1
+            self._wakeup.notify_all()
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+    def _push(self, job, delay):
+        # the heap orders on priority first, then on submission order
+        heapq.heappush(self._queue, (-job.priority, next(self._order),
+                                     time.time() + delay, job))
+        self._wakeup.notify_all()
+
+    def _pop(self):
+        '''
+        Take the first job that may be started from the queue, returns the
+        job and ``None``, or ``None`` and the number of seconds until a job
+        may be retried.
+        '''
+        now = time.time()
+        wait = None
+        for entry in sorted(self._queue):
+            job = entry[3]
+            limit = self.port_limits.get(job.port, self.port_limit)
+            if self._active.get(job.port, 0) >= limit:
+                continue
+            elif entry[2] > now:
+                if wait is None or entry[2] - now < wait:
+                    wait = entry[2] - now
+                continue
+            self._queue.remove(entry)
+            heapq.heapify(self._queue)
+            return job, None
+        return None, wait
+
+    def _worker(self):
+        while True:
+            with self._lock:
+                while True:
+                    job, wait = self._pop()
+                    if job is not None:
+                        break
+                    if self._shutdown and not self._queue:
+                        return
+                    self._wakeup.wait(wait)
+
+                if job.attempts == 0 and \
+                        not job.future.set_running_or_notify_cancel():
+                    # cancelled while waiting in the queue
+                    self._jobs -= 1
+                    continue
+                self._active[job.port] = self._active.get(job.port, 0) + 1
+                self._running += 1
+                if self._started is None:
+                    self._started = time.time()
+
+            try:
+                result = job.run(self._count)
+            except Exception as error:
+                log.exception('job on port %s failed' % (job.port,))
+                result = error
+
+            with self._lock:
+                self._active[job.port] -= 1
+                self._running -= 1
+                self._wakeup.notify_all()
+                success = result is not None and result is not False and \
+                    not isinstance(result, Exception)
+                if not success and job.attempts <= job.retries:
+                    delay = job.backoff * 2 ** (job.attempts - 1)
+                    log.info('retrying job on port %s in %.1f seconds' % \
+                        (job.port, delay))
+                    self._push(job, delay)
+                    continue
+                if success:
+                    self._done += 1
+                else:
+                    self._failed += 1
+
+            if isinstance(result, Exception):
+                job.future.set_exception(result)
+            else:
+                job.future.set_result(result)
+
+    def _count(self, job, size):
+        with self._lock:
+            job.bytes += size
+            self._bytes += size
+
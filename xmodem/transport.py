@@ -0,0 +1,267 @@
+'''
+=====================
+ POSIX tty transports
+=====================
+
+:class:`TTYTransport` provides the ``getc`` and ``putc`` callables for a
+serial port, pseudo terminal or any other file descriptor, so there is no
+need to write them around ``select`` and single byte reads.
+
+    >>> transport = TTYTransport.open('/dev/ttyUSB0', baudrate=115200)
+    >>> modem = XMODEM(transport.getc, transport.putc)
+    >>> modem.send(open('firmware.bin', 'rb'))
+    True
+    >>> transport.close()
+
+The terminal is put in raw mode and the descriptor in nonblocking mode, both
+are restored by :meth:`TTYTransport.close`. Reads pull whatever the line has
+into an internal buffer in large chunks, waits use ``poll`` and each call
+returns within its timeout.
+'''
+
+import errno
+import fcntl
+import logging
+import os
+import select
+import sys
+import termios
+import time
+
+
+log = logging.getLogger('xmodem.transport')
+
+# never goes back, unlike the time of day
+_clock = getattr(time, 'monotonic', time.time)
+
+# poll events, also used with select where there is no poll
+POLLIN = getattr(select, 'POLLIN', 1)
+POLLOUT = getattr(select, 'POLLOUT', 4)
+
+
+class TTYTransport(object):
+    '''
+    Transport over the file descriptor ``fd``, or an object with a
+    ``fileno`` method. With ``raw`` enabled the terminal settings are
+    changed to raw mode, at the given ``baudrate`` if any. Reads from the
+    line are done in chunks of up to ``size`` bytes.
+    '''
+
+    def __init__(self, fd, raw=1, baudrate=None, size=65536):
+        if hasattr(fd, 'fileno'):
+            fd = fd.fileno()
+        self.fd = fd
+        self.size = size
+        self.buffer = bytearray()
+        self._owner = 0
+        self._flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+        fcntl.fcntl(fd, fcntl.F_SETFL, self._flags | os.O_NONBLOCK)
+        self._attributes = None
+        if raw:
+            self._attributes = termios.tcgetattr(fd)
+            termios.tcsetattr(fd, termios.TCSANOW,
+                              self._raw(self._attributes, baudrate))
+
+        # poll does not work on devices on macOS
+        if hasattr(select, 'poll') and sys.platform != 'darwin':
+            self._poller = select.poll()
+            self._poller.register(fd)
+        else:
+            self._poller = None
+
+    @classmethod
+    def open(cls, path, *args, **kwargs):
+        '''
+        Open the device at ``path``, it is closed again by :meth:`close`.
+        '''
+        fd = os.open(path, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+        try:
+            transport = cls(fd, *args, **kwargs)
+        except Exception:
+            os.close(fd)
+            raise
+        transport._owner = 1
+        return transport
+
+    def getc(self, size, timeout=1):
+        '''
+        Read ``size`` bytes, returns a string, or ``None`` if nothing arrived
+        within ``timeout`` seconds. Like a serial port, fewer bytes are
+        returned if only part of them arrived in time.
+        '''
+        deadline = _clock() + timeout
+        while len(self.buffer) < size:
+            chunk = self._read()
+            if chunk:
+                self.buffer += chunk
+                continue
+            wait = deadline - _clock()
+            if wait <= 0 or not self._wait(POLLIN, wait):
+                break
+
+        if not self.buffer:
+            return None
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def read1(self, size, timeout=1):
+        '''
+        Read at most ``size`` bytes, returns as soon as any bytes arrived,
+        or ``None`` if nothing arrived within ``timeout`` seconds. For read
+        ahead buffers like :class:`xmodem.FrameReader`, which should not
+        wait for more than the line has.
+        '''
+        deadline = _clock() + timeout
+        while not self.buffer:
+            chunk = self._read()
+            if chunk:
+                self.buffer += chunk
+                break
+            wait = deadline - _clock()
+            if wait <= 0 or not self._wait(POLLIN, wait):
+                return None
+
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def putc(self, data, timeout=1):
+        '''
+        Write ``data``, returns the number of bytes written, or ``None`` if
+        they could not all be written within ``timeout`` seconds.
+        '''
+        return self.putv([data], timeout)
+
+    def putv(self, buffers, timeout=1):
+        '''
+        Write a sequence of buffers with as few system calls as possible,
+        returns the number of bytes written, or ``None`` if they could not
+        all be written within ``timeout`` seconds.
+        '''
+        deadline = _clock() + timeout
+        buffers = [memoryview(data) for data in buffers if len(data)]
+        total = sum(len(data) for data in buffers)
+        while buffers:
+            written = self._write(buffers)
+            if written is None:
+                wait = deadline - _clock()
+                if wait <= 0 or not self._wait(POLLOUT, wait):
+                    log.warning('timeout writing to fd %d' % (self.fd,))
+                    return None
+                continue
+
+            # drop what went out
+            while written:
+                if written >= len(buffers[0]):
+                    written -= len(buffers.pop(0))
+                else:
+                    buffers[0] = buffers[0][written:]
+                    written = 0
+        return total
+
+    def flush(self):
+        '''
+        Discard the data waiting to be read.
+        '''
+        del self.buffer[:]
+        termios.tcflush(self.fd, termios.TCIFLUSH)
+
+    def close(self):
+        '''
+        Restore the terminal settings and the blocking mode, closes the file
+        descriptor if it was opened by :meth:`open`.
+        '''
+        if self.fd is None:
+            return
+        try:
+            if self._attributes is not None:
+                termios.tcsetattr(self.fd, termios.TCSADRAIN,
+                                  self._attributes)
+            fcntl.fcntl(self.fd, fcntl.F_SETFL, self._flags)
+        finally:
+            if self._owner:
+                os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _raw(self, attributes, baudrate):
+        '''
+        Returns the terminal ``attributes`` for raw 8N1 mode, like
+        ``cfmakeraw`` does, where reads return whatever is available.
+        '''
+        iflag, oflag, cflag, lflag, ispeed, ospeed, cc = attributes
+        iflag &= ~(termios.IGNBRK | termios.BRKINT | termios.PARMRK |
+                   termios.ISTRIP | termios.INLCR | termios.IGNCR |
+                   termios.ICRNL | termios.IXON | termios.IXOFF |
+                   termios.INPCK)
+        oflag &= ~termios.OPOST
+        lflag &= ~(termios.ECHO | termios.ECHONL | termios.ICANON |
+                   termios.ISIG | termios.IEXTEN)
+        cflag &= ~(termios.CSIZE | termios.PARENB | termios.CSTOPB)
+        cflag |= termios.CS8 | termios.CREAD | termios.CLOCAL
+        cc = list(cc)
+        cc[termios.VMIN] = 0
+        cc[termios.VTIME] = 0
+        if baudrate is not None:
+            speed = getattr(termios, 'B%d' % (baudrate,), None)
+            if speed is None:
+                raise ValueError('unsupported baud rate %r' % (baudrate,))
+            ispeed = ospeed = speed
+        return [iflag, oflag, cflag, lflag, ispeed, ospeed, cc]
+
+    def _read(self):
+        '''
+        Read what the line has, returns an empty string if nothing is
+        available.
+        '''
+        try:
+            return os.read(self.fd, self.size)
+        except OSError as error:
+            if error.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return b''
+            elif error.errno == errno.EIO:
+                # the other end of a pseudo terminal is closed
+                return b''
+            raise
+
+    def _write(self, buffers):
+        '''
+        Write as much of the buffers as the line takes, returns the number
+        of bytes written or ``None`` if the line is full.
+        '''
+        try:
+            if hasattr(os, 'writev'):
+                return os.writev(self.fd, buffers)
+            return os.write(self.fd, buffers[0])
+        except OSError as error:
+            if error.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return None
+            raise
+
+    def _wait(self, event, timeout):
+        '''
+        Wait up to ``timeout`` seconds for the descriptor to become readable
+        or writable, returns whether it did.
+        '''
+        if self._poller is not None:
+            self._poller.modify(self.fd, event)
+            try:
+                return bool(self._poller.poll(timeout * 1000))
+            except (IOError, OSError, select.error):
+                # interrupted by a signal, the caller tries again
+                return True
+
+        readers = [self.fd] if event == POLLIN else []
+        writers = [self.fd] if event == POLLOUT else []
+        try:
+            readable, writable, failed = select.select(readers, writers, [],
+                                                       timeout)
+        except (IOError, OSError, select.error):
+            return True
+        return bool(readable or writable)
@@ -0,0 +1,694 @@
+'''
+===============================
+ ZMODEM file transfer protocol
+===============================
+
+This is an implementation of the ZMODEM protocol as described in
+ZMODEM.TXT by Chuck Forsberg, using the same ``getc`` and ``putc`` callables
+as :class:`xmodem.XMODEM`.
+
+File data is streamed in data subpackets without waiting for
+acknowledgements, the receiver asks the sender to reposition with a
+``ZRPOS`` frame if a subpacket is damaged. The same mechanism is used to
+resume an interrupted transfer at the size of the partially received file.
+
+Frame flow
+==========
+
+::
+
+    SENDER                                      RECEIVER
+
+    rz\\r ZRQINIT                                -->
+                                            <-- ZRINIT
+    ZFILE ZCRCW(name NUL size)              -->
+                                            <-- ZRPOS(0)
+    ZDATA(0) ZCRCG(1024) ... ZCRCE(100)     -->
+    ZEOF(size)                              -->
+                                            <-- ZRINIT
+    ZFIN                                    -->
+                                            <-- ZFIN
+    OO                                      -->
+
+'''
+
+import binascii
+import os
+import re
+import struct
+
+from xmodem import calc_crc, log, _stream_size
+
+# Protocol bytes
+ZPAD = b'*'
+ZDLE = b'\x18'
+ZBIN = b'A'
+ZHEX = b'B'
+ZBIN32 = b'C'
+
+# Frame types
+ZRQINIT = 0
+ZRINIT = 1
+ZSINIT = 2
+ZACK = 3
+ZFILE = 4
+ZSKIP = 5
+ZNAK = 6
+ZABORT = 7
+ZFIN = 8
+ZRPOS = 9
+ZDATA = 10
+ZEOF = 11
+ZFERR = 12
+ZCRC = 13
+ZCHALLENGE = 14
+ZCOMPL = 15
+ZCAN = 16
+ZFREECNT = 17
+ZCOMMAND = 18
+
+# Data subpacket frame ends
+ZCRCE = 0x68
+ZCRCG = 0x69
+ZCRCQ = 0x6a
+ZCRCW = 0x6b
+ZRUB0 = 0x6c
+ZRUB1 = 0x6d
+
+# ZRINIT capability flags
+CANFDX = 0x01
+CANOVIO = 0x02
+CANFC32 = 0x20
+
+# ZFILE conversion options
+ZCBIN = 1
+ZCRESUM = 3
+
+# Bytes that have to be escaped with ZDLE on the line, everything else is
+# copied as is
+_escape_re = re.compile(b'[\x10\x11\x13\x18\x90\x91\x93]')
+_escaped = dict(
+    (struct.pack('B', char), ZDLE + struct.pack('B', char ^ 0x40))
+    for char in bytearray(b'\x10\x11\x13\x18\x90\x91\x93')
+)
+
+# Flow control bytes the receiver ignores
+_flow_control = b'\x11\x13\x91\x93'
+_flow_control_set = frozenset(bytearray(_flow_control))
+
+
+def escape(data):
+    '''
+    ZDLE escape a block of data, runs without any bytes that need escaping
+    are copied without further processing.
+
+        >>> escape(b'\\x18hello')
+        '\\x18Xhello'
+
+    '''
+    if _escape_re.search(data) is None:
+        return bytes(data)
+    return _escape_re.sub(lambda match: _escaped[match.group()], bytes(data))
+
+
+class ZMODEM(object):
+    '''
+    ZMODEM Protocol handler, expects an object to read from and an object to
+    write to.
+
+    >>> modem = ZMODEM(getc, putc)
+    >>> modem.send(['/etc/fstab'])
+    True
+
+    Wrapping ``getc`` in a :class:`xmodem.FrameReader`, given the ``read1``
+    of the transport, allows the receiver to decode whole runs of data at
+    once, instead of reading the line byte by byte.
+    '''
+
+    # maximum number of bytes in a data subpacket
+    packet_size = 1024
+
+    def __init__(self, getc, putc):
+        self.getc = getc
+        self.putc = putc
+        self._read1 = getattr(getc, 'read1', None)
+        self._rx = bytearray()
+        self._rxpos = 0
+        self._rxcrc32 = 0
+        self._txcrc32 = 0
+
+    def abort(self, timeout=60):
+        '''
+        Send an abort sequence using CAN bytes.
+        '''
+        self.putc(b'\x18' * 8 + b'\x08' * 8, timeout)
+
+    def send(self, files, retry=16, timeout=60, resume=0):
+        '''
+        Send a batch of files via the ZMODEM protocol. The files are given
+        as file names, or as tuples of a file name and a stream.
+
+            >>> print modem.send(['/etc/issue', ('motd', stream)])
+            True
+
+        With ``resume`` enabled, the receiver is asked to continue with files
+        it already partially received.
+
+        Returns ``True`` upon succesful transmission or ``False`` in case of
+        failure.
+        '''
+
+        # initialize protocol
+        flags = self._send_init(retry, timeout)
+        if flags is None:
+            return False
+        self._txcrc32 = flags & CANFC32
+
+        for item in files:
+            if isinstance(item, tuple):
+                name, stream = item
+                result = self._send_file(name, stream, retry, timeout, resume)
+            else:
+                stream = open(item, 'rb')
+                try:
+                    result = self._send_file(item, stream, retry, timeout,
+                                             resume)
+                finally:
+                    stream.close()
+
+            if not result:
+                return False
+
+        # end of session
+        for counter in range(retry):
+            self._send_hex_header(ZFIN)
+            header = self._recv_header(timeout)
+            if header is None:
+                continue
+            elif header[0] == ZFIN:
+                self.putc(b'OO')
+                return True
+            elif header[0] in (ZCAN, ZABORT):
+                return False
+
+        log.error('no ZFIN from receiver')
+        return False
+
+    def _send_init(self, retry, timeout):
+        '''
+        Wake up the receiver, returns the capability flags from its ZRINIT
+        or ``None`` in case of failure.
+        '''
+        self.putc(b'rz\r')
+        for counter in range(retry):
+            self._send_hex_header(ZRQINIT)
+            header = self._recv_header(timeout)
+            if header is None:
+                continue
+
+            frame_type, data = header
+            if frame_type == ZRINIT:
+                return data[3]
+            elif frame_type == ZCHALLENGE:
+                self._send_hex_header(ZACK, data)
+            elif frame_type in (ZCAN, ZABORT):
+                return None
+
+        self.abort(timeout)
+        log.error('no ZRINIT from receiver')
+        return None
+
+    def _send_file(self, name, stream, retry, timeout, resume):
+        name = os.path.basename(name)
+        if not isinstance(name, bytes):
+            name = name.encode('latin-1')
+        info = name + b'\x00'
+        size = _stream_size(stream)
+        if size is not None:
+            info += ('%d' % (size,)).encode('ascii')
+        info += b'\x00'
+
+        # offer the file until the receiver tells us where to start
+        error_count = 0
+        while True:
+            options = ZCRESUM if resume else ZCBIN
+            self._send_bin_header(ZFILE, struct.pack('<BBBB', 0, 0, 0,
+                                                     options))
+            self._send_data(info, ZCRCW)
+            header = self._recv_header(timeout)
+            while header is not None and header[0] == ZRINIT:
+                # repeated ZRINIT from the start of the session
+                header = self._recv_header(timeout)
+            if header is not None:
+                frame_type, data = header
+                if frame_type == ZRPOS:
+                    offset, = struct.unpack('<I', data)
+                    break
+                elif frame_type == ZSKIP:
+                    log.info('receiver skipped %s' % (name,))
+                    return True
+                elif frame_type in (ZCAN, ZABORT, ZFIN):
+                    log.error('transfer cancelled by receiver')
+                    return False
+
+            error_count += 1
+            if error_count >= retry:
+                self.abort(timeout)
+                return False
+
+        # stream the file, starting over at each ZRPOS
+        error_count = 0
+        progress = offset
+        start = stream.tell()
+        while True:
+            stream.seek(start + offset)
+            self._send_bin_header(ZDATA, struct.pack('<I', offset))
+            header = None
+            while True:
+                data = stream.read(self.packet_size)
+                if len(data) < self.packet_size:
+                    self._send_data(data, ZCRCE)
+                    offset += len(data)
+                    break
+
+                self._send_data(data, ZCRCG)
+                offset += len(data)
+                if self._poll():
+                    header = self._recv_header(timeout)
+                    if header is not None and header[0] != ZACK:
+                        break
+                    header = None
+
+            if header is None:
+                self._send_bin_header(ZEOF, struct.pack('<I', offset))
+                header = self._recv_header(timeout)
+                while header is not None and header[0] == ZACK:
+                    header = self._recv_header(timeout)
+
+            if header is not None:
+                frame_type, data = header
+                if frame_type == ZRINIT:
+                    return True
+                elif frame_type == ZSKIP:
+                    return True
+                elif frame_type == ZRPOS:
+                    offset, = struct.unpack('<I', data)
+                    log.debug('receiver asks for position %d' % (offset,))
+                    if offset > progress:
+                        # only count errors that keep us from progressing
+                        progress = offset
+                        error_count = 0
+                elif frame_type in (ZCAN, ZABORT, ZFIN):
+                    log.error('transfer cancelled by receiver')
+                    return False
+
+            error_count += 1
+            if error_count >= retry:
+                self.abort(timeout)
+                log.warning('excessive errors, transfer aborted')
+                return False
+
+    def recv(self, directory, retry=16, timeout=60, resume=0):
+        '''
+        Receive a batch of files via the ZMODEM protocol and store them in
+        ``directory``. Path components in the received file names are
+        ignored.
+
+            >>> print modem.recv('/tmp')
+            ['/tmp/issue', '/tmp/motd']
+
+        Files that already exist and are smaller than the file offered are
+        resumed at their current size if either ``resume`` is enabled or the
+        sender asks for it.
+
+        Returns the list of received file paths on success or ``None`` in case
+        of failure.
+        '''
+        received = []
+        stream = None
+        path = None
+        offset = 0
+        resync = 0
+        error_count = 0
+        self._send_zrinit()
+        while True:
+            header = self._recv_header(timeout)
+            if header is None:
+                error_count += 1
+                if error_count >= retry:
+                    self.abort(timeout)
+                    if stream is not None:
+                        stream.close()
+                    return None
+                if stream is None:
+                    self._send_zrinit()
+                else:
+                    self._send_hex_header(ZRPOS, struct.pack('<I', offset))
+                continue
+
+            frame_type, data = header
+            if frame_type == ZRQINIT:
+                self._send_zrinit()
+
+            elif frame_type == ZSINIT:
+                self._recv_data(timeout)
+                self._send_hex_header(ZACK)
+
+            elif frame_type == ZFILE:
+                packet = self._recv_data(timeout)
+                if packet is None:
+                    self._send_hex_header(ZNAK)
+                    continue
+                if stream is None:
+                    stream, path, offset = self._open_file(
+                        directory, packet[0], resume or data[3] == ZCRESUM)
+                self._send_hex_header(ZRPOS, struct.pack('<I', offset))
+
+            elif frame_type == ZDATA:
+                position, = struct.unpack('<I', data)
+                if stream is None or position != offset:
+                    # skip the data until the sender repositioned
+                    if not resync and stream is not None:
+                        self._send_hex_header(ZRPOS,
+                                              struct.pack('<I', offset))
+                        resync = 1
+                    continue
+
+                resync = 0
+                while True:
+                    packet = self._recv_data(timeout)
+                    if packet is None:
+                        error_count += 1
+                        log.debug('bad data subpacket at %d' % (offset,))
+                        self._send_hex_header(ZRPOS,
+                                              struct.pack('<I', offset))
+                        resync = 1
+                        break
+
+                    error_count = 0
+                    packet_data, end = packet
+                    stream.write(bytes(packet_data))
+                    offset += len(packet_data)
+                    if end in (ZCRCQ, ZCRCW):
+                        self._send_hex_header(ZACK,
+                                              struct.pack('<I', offset))
+                    if end in (ZCRCE, ZCRCW):
+                        break
+
+            elif frame_type == ZEOF:
+                position, = struct.unpack('<I', data)
+                if stream is not None and position == offset:
+                    stream.close()
+                    received.append(path)
+                    stream = None
+                    self._send_zrinit()
+
+            elif frame_type == ZFIN:
+                if stream is not None:
+                    stream.close()
+                self._send_hex_header(ZFIN)
+                # the sender ends with an over and out
+                self._getbyte(1)
+                self._getbyte(1)
+                return received
+
+            elif frame_type in (ZCAN, ZABORT):
+                log.error('transfer cancelled by sender')
+                if stream is not None:
+                    stream.close()
+                return None
+
+    def _send_zrinit(self):
+        flags = CANFDX | CANOVIO | CANFC32
+        self._send_hex_header(ZRINIT, struct.pack('<HBB', 0, 0, flags))
+
+    def _open_file(self, directory, info, resume):
+        '''
+        Open the destination for a ZFILE, returns a tuple of the stream, its
+        path and the offset to start receiving at.
+        '''
+        name, _, info = bytes(info).partition(b'\x00')
+        if not isinstance(name, str):
+            name = name.decode('latin-1')
+        name = os.path.basename(name)
+        path = os.path.join(directory, name)
+        fields = info.rstrip(b'\x00').split()
+        size = None
+        if fields:
+            try:
+                size = int(fields[0])
+            except ValueError:
+                log.warning('invalid file size %r in header' % (fields[0],))
+
+        if resume and os.path.exists(path):
+            offset = os.path.getsize(path)
+            if size is None or offset <= size:
+                log.info('resuming %s at %d' % (path, offset))
+                stream = open(path, 'r+b')
+                stream.seek(offset)
+                return stream, path, offset
+
+        return open(path, 'wb'), path, 0
+
+    def _send_hex_header(self, frame_type, data=b'\x00\x00\x00\x00'):
+        header = struct.pack('B', frame_type) + bytes(data)
+        frame = (ZPAD + ZPAD + ZDLE + ZHEX +
+                 binascii.hexlify(header) +
+                 binascii.hexlify(struct.pack('>H', calc_crc(header))) +
+                 b'\r\x8a')
+        if frame_type not in (ZACK, ZFIN):
+            frame += b'\x11'
+        self.putc(frame)
+
+    def _send_bin_header(self, frame_type, data=b'\x00\x00\x00\x00'):
+        header = struct.pack('B', frame_type) + bytes(data)
+        if self._txcrc32:
+            crc = binascii.crc32(header) & 0xffffffff
+            frame = ZPAD + ZDLE + ZBIN32 + escape(
+                header + struct.pack('<I', crc))
+        else:
+            frame = ZPAD + ZDLE + ZBIN + escape(
+                header + struct.pack('>H', calc_crc(header)))
+        self.putc(frame)
+
+    def _send_data(self, data, end):
+        '''
+        Send a data subpacket with the given frame end.
+        '''
+        if self._txcrc32:
+            crc = binascii.crc32(data)
+            crc = binascii.crc32(struct.pack('B', end), crc) & 0xffffffff
+            trailer = struct.pack('<I', crc)
+        else:
+            crc = calc_crc(struct.pack('B', end), calc_crc(data))
+            trailer = struct.pack('>H', crc)
+        self.putc(escape(data) + ZDLE + struct.pack('B', end) +
+                  escape(trailer))
+
+    def _fill(self, timeout):
+        '''
+        Read more data from the line into the receive buffer.
+        '''
+        if self._rxpos > 4096:
+            del self._rx[:self._rxpos]
+            self._rxpos = 0
+
+        if self._read1 is not None:
+            chunk = self._read1(4096, timeout)
+        else:
+            chunk = self.getc(1, timeout)
+        if not chunk:
+            return False
+        self._rx += chunk
+        return True
+
+    def _poll(self):
+        '''
+        Check if the other side started sending a header or a cancel sequence,
+        without waiting. Anything else received is discarded.
+        '''
+        if self._rxpos >= len(self._rx) and not self._fill(0):
+            return False
+        if (self._rx.find(ZPAD, self._rxpos) < 0 and
+                self._rx.find(ZDLE, self._rxpos) < 0):
+            self._rxpos = len(self._rx)
+            return False
+        return True
+
+    def _getbyte(self, timeout):
+        if self._rxpos >= len(self._rx) and not self._fill(timeout):
+            return None
+        char = self._rx[self._rxpos]
+        self._rxpos += 1
+        return char
+
+    def _getzdle(self, timeout):
+        '''
+        Read a ZDLE escaped byte, frame ends are returned with bit 8 set and
+        a cancel sequence as ``-1``.
+        '''
+        while True:
+            char = self._getbyte(timeout)
+            if char is None or char != 0x18:
+                if char in _flow_control_set:
+                    continue
+                return char
+
+            char = self._getbyte(timeout)
+            if char is None:
+                return None
+            elif char in (ZCRCE, ZCRCG, ZCRCQ, ZCRCW):
+                return char | 0x100
+            elif char == ZRUB0:
+                return 0x7f
+            elif char == ZRUB1:
+                return 0xff
+            elif char == 0x18:
+                # five CAN bytes in a row cancel the session
+                count = 2
+                while count < 5 and self._getbyte(timeout) == 0x18:
+                    count += 1
+                if count == 5:
+                    return -1
+                return None
+            elif char & 0x60 == 0x40:
+                return char ^ 0x40
+            return None
+
+    def _recv_header(self, timeout):
+        '''
+        Wait for the next frame header, skipping anything else on the line.
+        Returns a tuple of the frame type and the four header data bytes,
+        ``(ZCAN, ...)`` on a cancel sequence or ``None`` in case of failure.
+        '''
+        while True:
+            index = self._rx.find(ZPAD, self._rxpos)
+            if self._rx.find(b'\x18' * 5, self._rxpos,
+                             len(self._rx) if index < 0 else index) >= 0:
+                self._rxpos = len(self._rx)
+                return ZCAN, bytearray(4)
+
+            if index < 0:
+                # keep a possible partial cancel sequence
+                self._rxpos = max(self._rxpos, len(self._rx) - 4)
+                if not self._fill(timeout):
+                    return None
+                continue
+
+            self._rxpos = index + 1
+            char = self._getbyte(timeout)
+            while char == 0x2a:
+                char = self._getbyte(timeout)
+            if char != 0x18:
+                continue
+
+            char = self._getbyte(timeout)
+            if char == 0x41:
+                return self._recv_bin_header(timeout, 0)
+            elif char == 0x43:
+                return self._recv_bin_header(timeout, 1)
+            elif char == 0x42:
+                return self._recv_hex_header(timeout)
+            elif char is None:
+                return None
+
+    def _recv_bin_header(self, timeout, crc32):
+        header = bytearray()
+        for counter in range(9 if crc32 else 7):
+            char = self._getzdle(timeout)
+            if char is None or char < 0 or char > 0xff:
+                return None
+            header.append(char)
+
+        if crc32:
+            crc, = struct.unpack_from('<I', header, 5)
+            valid = crc == binascii.crc32(bytes(header[:5])) & 0xffffffff
+        else:
+            crc, = struct.unpack_from('>H', header, 5)
+            valid = crc == calc_crc(header[:5])
+
+        if not valid:
+            log.debug('header CRC error')
+            return None
+
+        self._rxcrc32 = crc32
+        return header[0], header[1:5]
+
+    def _recv_hex_header(self, timeout):
+        digits = bytearray()
+        while len(digits) < 14:
+            char = self._getbyte(timeout)
+            if char is None:
+                return None
+            digits.append(char)
+
+        try:
+            header = bytearray(binascii.unhexlify(bytes(digits)))
+        except (TypeError, ValueError):
+            log.debug('invalid hex header')
+            return None
+
+        crc, = struct.unpack_from('>H', header, 5)
+        if crc != calc_crc(header[:5]):
+            log.debug('header CRC error')
+            return None
+
+        # throw away the CR/LF trailer
+        for counter in range(2):
+            if (self._rxpos < len(self._rx) and
+                    self._rx[self._rxpos] in (0x0d, 0x8d, 0x0a, 0x8a)):
+                self._rxpos += 1
+
+        return header[0], header[1:5]
+
+    def _recv_data(self, timeout):
+        '''
+        Receive a data subpacket, returns a tuple of the data and the frame
+        end, or ``None`` in case of failure. Runs between ZDLE bytes are
+        copied from the receive buffer at once.
+        '''
+        data = bytearray()
+        while True:
+            index = self._rx.find(ZDLE, self._rxpos)
+            end = len(self._rx) if index < 0 else index
+            if end > self._rxpos:
+                data += self._rx[self._rxpos:end].translate(
+                    None, _flow_control)
+                self._rxpos = end
+
+            if len(data) > self.packet_size * 8:
+                log.debug('data subpacket too long')
+                return None
+
+            if index < 0:
+                if not self._fill(timeout):
+                    return None
+                continue
+
+            char = self._getzdle(timeout)
+            if char is None or char < 0:
+                return None
+            elif char > 0xff:
+                end = char & 0xff
+                break
+            data.append(char)
+
+        trailer = bytearray()
+        for counter in range(4 if self._rxcrc32 else 2):
+            char = self._getzdle(timeout)
+            if char is None or char < 0 or char > 0xff:
+                return None
+            trailer.append(char)
+
+        if self._rxcrc32:
+            crc = binascii.crc32(bytes(data))
+            crc = binascii.crc32(struct.pack('B', end), crc) & 0xffffffff
+            valid = crc == struct.unpack('<I', bytes(trailer))[0]
+        else:
+            crc = calc_crc(struct.pack('B', end), calc_crc(data))
+            valid = crc == struct.unpack('>H', bytes(trailer))[0]
+
+        if not valid:
+            log.debug('data subpacket CRC error')
+            return None
+        return data, end